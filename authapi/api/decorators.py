@@ -16,7 +16,10 @@
 from django.contrib.auth.models import User
 from django.http import HttpResponseForbidden
 import json
+import time
 import functools
+import threading
+from collections import OrderedDict
 from utils import verifyhmac, HMACToken
 from django.conf import settings
 
@@ -28,6 +31,78 @@ def get_auth_key(request):
             key = request.META.get('HTTP_HTTP_AUTH', None)
     return key
 
+
+class VerifiedTokenCache(object):
+    '''
+    Process-wide LRU cache of the auth tokens already verified, so that the
+    same token sent again within its lifetime doesn't need to be parsed and
+    its HMAC verified again.
+
+    Each raw token is mapped to the id of its user, the parsed HMACToken and
+    the time at which the entry expires, which is never later than the
+    expiration of the token itself (settings.TIMEOUT).
+    '''
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, user_id, hmac_token):
+        max_size = settings.HMAC_TOKEN_CACHE_SIZE
+        if max_size <= 0:
+            return
+
+        expires_at = min(
+            int(hmac_token.timestamp) + settings.TIMEOUT,
+            time.time() + settings.HMAC_TOKEN_CACHE_TTL
+        )
+        with self.lock:
+            self.entries[key] = (user_id, hmac_token, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+VERIFIED_TOKENS = VerifiedTokenCache()
+
+
+def get_cached_login_user(key):
+    '''
+    Returns the user and the HMACToken of an already verified token, or
+    (None, None) if it's not in the cache.
+    '''
+    entry = VERIFIED_TOKENS.get(key)
+    if entry is None:
+        return None, None
+
+    user_id, hmac_token, _ = entry
+    user = User.objects.filter(pk=user_id).first()
+    # the user might have been removed since the token was verified
+    if user is None or user.username != hmac_token.get_userid():
+        VERIFIED_TOKENS.delete(key)
+        return None, None
+
+    return user, hmac_token
+
+
 def get_login_user(request):
     key = get_auth_key(request)
     hmac_token = None
@@ -35,6 +110,10 @@ def get_login_user(request):
     if not key:
         return None, dict(error_codename="empty_hmac"), hmac_token
 
+    user, hmac_token = get_cached_login_user(key)
+    if user is not None:
+        return user, None, hmac_token
+
     try:
       hmac_token = HMACToken(key)
       if not hmac_token.check_expiration(settings.TIMEOUT):
@@ -49,6 +128,7 @@ def get_login_user(request):
     except:
         return None, dict(error_codename="invalid_hmac_userid"), hmac_token
 
+    VERIFIED_TOKENS.set(key, user.pk, hmac_token)
     return user, None, hmac_token
 
 
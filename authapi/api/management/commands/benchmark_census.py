@@ -0,0 +1,226 @@
+# This file is part of authapi.
+# Copyright (C) 2014-2020  Agora Voting SL <contact@nvotes.com>
+
+# authapi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+
+# authapi  is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with authapi.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import RequestFactory
+import time
+
+from api.models import ACL, AuthEvent
+from api.views import filter_census_query
+
+
+class Rollback(Exception):
+  pass
+
+
+class Command(BaseCommand):
+  '''
+  Benchmarks the census listing queries, comparing the current
+  implementation with the previous one over a synthetic census of the given
+  size. Everything is done inside a transaction that is rolled back at the
+  end, so it doesn't leave any data behind.
+  '''
+  help = 'benchmark the census listing queries'
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      '--voters',
+      type=int,
+      default=1000000,
+      help='number of voters of the synthetic census'
+    )
+    parser.add_argument(
+      '--runs',
+      type=int,
+      default=5,
+      help='number of times each query is executed'
+    )
+    parser.add_argument(
+      '--voted',
+      type=float,
+      default=0.5,
+      help='ratio of the voters of the synthetic census that have voted'
+    )
+    parser.add_argument(
+      '--filter',
+      default='voter12345@',
+      help='filter string used in the census search'
+    )
+
+  def timeit(self, name, func):
+    '''
+    Executes func self.runs times and prints the timings
+    '''
+    times = []
+    for i in range(self.runs):
+      timer = time.perf_counter()
+      ret = func()
+      times.append(time.perf_counter() - timer)
+    print(
+      "%s: min %.4f secs, avg %.4f secs (returned %r)" % (
+        name,
+        min(times),
+        sum(times) / len(times),
+        ret
+      )
+    )
+
+  def create_census(self, voters, voted):
+    '''
+    Creates an auth event with a census of the given number of voters, of
+    which the given ratio have voted
+    '''
+    auth_event = AuthEvent(
+      auth_method='email',
+      auth_method_config=dict(config=dict(), pipeline=dict()),
+      extra_fields=[dict(name='name', type='text')]
+    )
+    auth_event.save()
+
+    print("\nCreating a census of %d voters..." % voters)
+    timer = time.perf_counter()
+    with connection.cursor() as cursor:
+      cursor.execute(
+        '''
+        WITH new_users AS (
+          INSERT INTO auth_user (
+            password, is_superuser, username, first_name, last_name, email,
+            is_staff, is_active, date_joined
+          )
+          SELECT
+            '', false, 'benchmark-' || %(event_id)s || '-' || i, '', '',
+            'voter' || i || '@example.com', false, true, now()
+          FROM generate_series(1, %(voters)s) AS i
+          RETURNING id, username, email
+        ),
+        new_userdata AS (
+          INSERT INTO api_userdata (
+            user_id, event_id, tlf, metadata, status, draft_election,
+            search_text
+          )
+          SELECT
+            id, %(event_id)s, '+34' || (600000000 + id),
+            jsonb_build_object('name', 'Voter ' || id), 'act', '{}'::jsonb,
+            lower(concat_ws(
+              E'\n', username, email, '+34' || (600000000 + id), 'Voter ' || id
+            ))
+          FROM new_users
+          RETURNING id
+        )
+        INSERT INTO api_acl (user_id, perm, object_type, object_id, created)
+        SELECT id, 'vote', 'AuthEvent', %(event_id)s, now()
+        FROM new_userdata
+        ''',
+        dict(event_id=auth_event.id, voters=voters)
+      )
+      cursor.execute(
+        '''
+        INSERT INTO api_successfullogin (user_id, created, is_active, auth_event_id)
+        SELECT id, now(), true, %(event_id)s
+        FROM api_userdata
+        WHERE event_id = %(event_id)s AND random() < %(voted)s
+        ''',
+        dict(event_id=auth_event.id, voted=voted)
+      )
+      cursor.execute(
+        'ANALYZE auth_user, api_userdata, api_acl, api_successfullogin'
+      )
+    print("... done in %.2f secs" % (time.perf_counter() - timer))
+    return auth_event
+
+  def legacy_filter(self, auth_event, filter_str):
+    '''
+    Previous implementation of the census filter, with a LIKE scan that
+    materializes the matching ids
+    '''
+    filter_str = "%" + filter_str + "%"
+    raw_sql = '''
+      SELECT "api_acl"."id"
+      FROM "api_acl"
+      INNER JOIN "api_userdata"
+      ON ("api_acl"."user_id" = "api_userdata"."id")
+      INNER JOIN "auth_user"
+      ON ("api_userdata"."user_id" = "auth_user"."id")
+      WHERE
+        ("api_acl"."object_id"::int = %s
+        AND "api_acl"."perm" = 'vote'
+        AND "api_acl"."object_type" = 'AuthEvent'
+        AND (UPPER("auth_user"."username"::text) LIKE UPPER(%s)
+        OR UPPER("auth_user"."email"::text) LIKE UPPER(%s)
+        OR UPPER("api_userdata"."tlf"::text) LIKE UPPER(%s)'''
+    params_array = [auth_event.id, filter_str, filter_str, filter_str]
+    for field in auth_event.extra_fields:
+      raw_sql += '''
+        OR UPPER(api_userdata.metadata::jsonb->>%s) LIKE UPPER(%s)'''
+      params_array += [field['name'], filter_str]
+    raw_sql += '''
+        ))'''
+    id_list = [
+      obj.id
+      for obj in ACL.objects.raw(raw_sql, params=params_array)
+    ]
+    return auth_event.get_census_query().filter(id__in=id_list)
+
+  def run_query(self, query):
+    '''
+    Executes what paginate() does for the first page of the census listing
+    '''
+    count = query.count()
+    list(query.select_related('user__user', 'user__event')[:10])
+    return count
+
+  def benchmark_filter(self, auth_event, filter_str):
+    print("\nCensus filter '%s':" % filter_str)
+    self.timeit(
+      'legacy LIKE scan',
+      lambda: self.run_query(self.legacy_filter(auth_event, filter_str))
+    )
+    request = RequestFactory().get('/', dict(filter=filter_str))
+    self.timeit(
+      'trigram search text',
+      lambda: self.run_query(filter_census_query(request, auth_event))
+    )
+
+  def benchmark_has_voted(self, auth_event):
+    for has_voted in ['true', 'false']:
+      print("\nCensus has_voted__equals=%s:" % has_voted)
+      legacy_query = auth_event.get_census_query()\
+        .annotate(logins=Count('user__successful_logins'))
+      if has_voted == 'true':
+        legacy_query = legacy_query.filter(logins__gt=0)
+      else:
+        legacy_query = legacy_query.filter(logins__exact=0)
+      self.timeit(
+        'legacy Count annotation',
+        lambda: self.run_query(legacy_query)
+      )
+      request = RequestFactory().get('/', dict(has_voted__equals=has_voted))
+      self.timeit(
+        'EXISTS subquery',
+        lambda: self.run_query(filter_census_query(request, auth_event))
+      )
+
+  def handle(self, *args, **options):
+    self.runs = options['runs']
+    try:
+      with transaction.atomic():
+        auth_event = self.create_census(options['voters'], options['voted'])
+        self.benchmark_filter(auth_event, options['filter'])
+        self.benchmark_has_voted(auth_event)
+        raise Rollback()
+    except Rollback:
+      pass
@@ -0,0 +1,222 @@
+# This file is part of authapi.
+# Copyright (C) 2014-2020  Agora Voting SL <contact@nvotes.com>
+
+# authapi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+
+# authapi  is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with authapi.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+import time
+
+from api.models import AuthEvent, UserData
+from authmethods.models import Code
+from utils import generate_code, generate_codes
+
+
+class Rollback(Exception):
+  pass
+
+
+class Command(BaseCommand):
+  '''
+  Benchmarks the generation of codes when sending them in bulk, and the
+  lookup of the latest code of a voter done when authenticating, with and
+  without the authmethods_code_latest index, over a synthetic table of
+  codes of the given size. Everything is done inside a transaction that is
+  rolled back at the end, so it doesn't leave any data behind.
+  '''
+  help = 'benchmark the generation and lookup of authentication codes'
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      '--voters',
+      type=int,
+      default=100000,
+      help='number of voters of the synthetic census'
+    )
+    parser.add_argument(
+      '--codes',
+      type=int,
+      default=10000000,
+      help='number of codes of the synthetic codes table'
+    )
+    parser.add_argument(
+      '--lookups',
+      type=int,
+      default=100,
+      help='number of voters whose latest code is looked up in each run'
+    )
+    parser.add_argument(
+      '--generate',
+      type=int,
+      default=1000,
+      help='number of codes generated in each run of the generation benchmark'
+    )
+    parser.add_argument(
+      '--runs',
+      type=int,
+      default=5,
+      help='number of times each benchmark is executed'
+    )
+
+  def timeit(self, name, func, num):
+    '''
+    Executes func self.runs times and prints the timings, also divided by
+    the num operations that func does
+    '''
+    times = []
+    for i in range(self.runs):
+      timer = time.perf_counter()
+      func()
+      times.append(time.perf_counter() - timer)
+    print(
+      "%s: min %.4f secs, avg %.4f secs (%.3f ms per operation)" % (
+        name,
+        min(times),
+        sum(times) / len(times),
+        1000 * min(times) / num
+      )
+    )
+
+  def create_codes(self, voters, codes):
+    '''
+    Creates an auth event with a census of the given number of voters, and
+    the given number of codes spread among them over the last 30 days
+    '''
+    auth_event = AuthEvent(
+      auth_method='email',
+      auth_method_config=dict(config=dict(), pipeline=dict())
+    )
+    auth_event.save()
+
+    print(
+      "\nCreating a census of %d voters with %d codes..." % (voters, codes)
+    )
+    timer = time.perf_counter()
+    with connection.cursor() as cursor:
+      cursor.execute(
+        '''
+        WITH new_users AS (
+          INSERT INTO auth_user (
+            password, is_superuser, username, first_name, last_name, email,
+            is_staff, is_active, date_joined
+          )
+          SELECT
+            '', false, 'benchmark-' || %(event_id)s || '-' || i, '', '',
+            'voter' || i || '@example.com', false, true, now()
+          FROM generate_series(1, %(voters)s) AS i
+          RETURNING id
+        )
+        INSERT INTO api_userdata (
+          user_id, event_id, metadata, status, draft_election, search_text
+        )
+        SELECT id, %(event_id)s, '{}'::jsonb, 'act', '{}'::jsonb, ''
+        FROM new_users
+        ''',
+        dict(event_id=auth_event.id, voters=voters)
+      )
+      cursor.execute(
+        '''
+        WITH census AS (
+          SELECT
+            id,
+            row_number() OVER (ORDER BY id) - 1 AS position
+          FROM api_userdata
+          WHERE event_id = %(event_id)s
+        )
+        INSERT INTO authmethods_code (user_id, code, created, auth_event_id)
+        SELECT
+          census.id,
+          lpad((random() * 99999999)::int::text, 8, '2'),
+          now() - random() * interval '30 days',
+          %(event_id)s
+        FROM generate_series(0, %(codes)s - 1) AS i
+        INNER JOIN census ON census.position = i %% %(voters)s
+        ''',
+        dict(event_id=auth_event.id, voters=voters, codes=codes)
+      )
+      cursor.execute('ANALYZE api_userdata, authmethods_code')
+    print("... done in %.2f secs" % (time.perf_counter() - timer))
+    return auth_event
+
+  def lookup_codes(self, userdata_list):
+    '''
+    Executes the queries done by the email and email-otp authenticate()
+    '''
+    created_gt = timezone.now() - timedelta(
+      seconds=settings.SMS_OTP_EXPIRE_SECONDS
+    )
+    for userdata in userdata_list:
+      Code.objects\
+        .filter(user=userdata, code='22222222')\
+        .order_by('-created')\
+        .first()
+      Code.objects\
+        .filter(user=userdata, created__gt=created_gt)\
+        .order_by('-created')\
+        .first()
+
+  def benchmark_lookup(self, auth_event, lookups):
+    userdata_list = list(
+      UserData.objects\
+        .filter(event=auth_event)\
+        .order_by('?')[:lookups]
+    )
+    print("\nLatest code lookup of %d voters:" % lookups)
+    self.timeit(
+      'authmethods_code_latest index',
+      lambda: self.lookup_codes(userdata_list),
+      2 * lookups
+    )
+    with connection.cursor() as cursor:
+      cursor.execute('DROP INDEX authmethods_code_latest')
+    self.timeit(
+      'user_id index only',
+      lambda: self.lookup_codes(userdata_list),
+      2 * lookups
+    )
+
+  def benchmark_generate(self, auth_event, generate):
+    userdata_list = list(
+      UserData.objects\
+        .filter(event=auth_event)\
+        .select_related('event')[:generate]
+    )
+    print("\nGeneration of %d codes:" % generate)
+    self.timeit(
+      'generate_code per voter',
+      lambda: [generate_code(userdata) for userdata in userdata_list],
+      generate
+    )
+    batch_size = max(settings.SEND_CODES_BATCH_SIZE, 1)
+    self.timeit(
+      'generate_codes in batches of %d' % batch_size,
+      lambda: [
+        generate_codes(userdata_list[i:i + batch_size])
+        for i in range(0, len(userdata_list), batch_size)
+      ],
+      generate
+    )
+
+  def handle(self, *args, **options):
+    self.runs = options['runs']
+    try:
+      with transaction.atomic():
+        auth_event = self.create_codes(options['voters'], options['codes'])
+        self.benchmark_generate(auth_event, options['generate'])
+        self.benchmark_lookup(auth_event, options['lookups'])
+        raise Rollback()
+    except Rollback:
+      pass
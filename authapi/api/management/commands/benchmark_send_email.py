@@ -0,0 +1,123 @@
+# This file is part of authapi.
+# Copyright (C) 2014-2020  Agora Voting SL <contact@nvotes.com>
+
+# authapi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+
+# authapi  is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with authapi.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncore
+import smtpd
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from utils import send_email, BatchEmailSender
+
+
+class SinkServer(smtpd.SMTPServer):
+  '''
+  Local SMTP server that accepts and discards all the messages
+  '''
+  def process_message(self, *args, **kwargs):
+    self.received += 1
+
+  def __init__(self, *args, **kwargs):
+    self.received = 0
+    super(SinkServer, self).__init__(*args, **kwargs)
+
+
+class Command(BaseCommand):
+  '''
+  Benchmarks sending emails to an in-process SMTP server, opening a
+  connection per email with send_email() as before, or reusing it with
+  BatchEmailSender.
+  '''
+  help = 'benchmark sending emails through SMTP'
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      '--messages',
+      type=int,
+      default=1000,
+      help='number of emails sent in each benchmark'
+    )
+
+  def get_emails(self, messages):
+    return [
+      EmailMessage(
+        'Vote now',
+        'Your authentication code is %d' % i,
+        settings.DEFAULT_FROM_EMAIL,
+        ['voter%d@example.com' % i]
+      )
+      for i in range(messages)
+    ]
+
+  def timeit(self, name, server, messages, func):
+    received = server.received
+    timer = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - timer
+    print(
+      "%s: %d emails in %.2f secs, %.1f emails/sec (received %d)" % (
+        name,
+        messages,
+        elapsed,
+        messages / elapsed,
+        server.received - received
+      )
+    )
+
+  def send_batch(self, emails):
+    with BatchEmailSender() as email_sender:
+      for email in emails:
+        email_sender.send(email)
+
+  def handle(self, *args, **options):
+    messages = options['messages']
+    server = SinkServer(('127.0.0.1', 0), None)
+    port = server.socket.getsockname()[1]
+    thread = threading.Thread(
+      target=asyncore.loop,
+      kwargs=dict(timeout=0.1)
+    )
+    thread.daemon = True
+    thread.start()
+
+    with override_settings(
+      EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+      EMAIL_HOST='127.0.0.1',
+      EMAIL_PORT=port,
+      EMAIL_HOST_USER='',
+      EMAIL_HOST_PASSWORD='',
+      EMAIL_USE_TLS=False,
+      EMAIL_USE_SSL=False
+    ):
+      emails = self.get_emails(messages)
+      self.timeit(
+        'connection per email',
+        server,
+        messages,
+        lambda: [send_email(email) for email in emails]
+      )
+      emails = self.get_emails(messages)
+      self.timeit(
+        'reused connection',
+        server,
+        messages,
+        lambda: self.send_batch(emails)
+      )
+
+    server.close()
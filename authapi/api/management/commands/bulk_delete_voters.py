@@ -17,6 +17,8 @@ from django.core.management.base import BaseCommand, CommandError
 from django.db import connection
 import time
 
+from api.models import AuthEvent, bump_auth_event_version
+
 
 class Command(BaseCommand):
   '''
@@ -71,6 +73,11 @@ class Command(BaseCommand):
       ON U.id = M.user_id
       WHERE M.event_id=%(event_id)d
     ),
+    delete_successful_logins AS (
+      DELETE FROM api_successfullogin
+      USING users_to_delete
+      WHERE api_successfullogin.user_id = users_to_delete.userdata_id
+    ),
     delete_acls AS (
       DELETE FROM api_acl
       USING users_to_delete
@@ -98,6 +105,9 @@ class Command(BaseCommand):
     COMMIT TRANSACTION;
     ''' % dict(event_id=event_id)
     self.exec_sql(delete_acls)
+    bump_auth_event_version(event_id)
+    # the votes were deleted without the signals that update the counters
+    AuthEvent.objects.get(pk=event_id).reset_vote_counts()
 
     vacuum_statement = "VACUUM FULL ANALYZE VERBOSE;"
     self.exec_sql(vacuum_statement)
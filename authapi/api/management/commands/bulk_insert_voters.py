@@ -280,7 +280,7 @@ class Command(BaseCommand):
         , ', "%(column)s": "', csv_data.%(column)s, '"'
         """ % dict(column=column)
       
-    sql_options['metadata'] += ", '}')::jsonb AS metadata"
+    sql_options['metadata'] += ", '}')::jsonb"
 
     # Allow to set children_event_id_list
     if 'children_event_id_list'in self.columns:
@@ -339,15 +339,27 @@ class Command(BaseCommand):
         event_id,
         user_id,
         tlf,
-        children_event_id_list
+        children_event_id_list,
+        search_text
       )
       SELECT
-        %(metadata)s,
+        %(metadata)s AS metadata,
         'act' AS status,
         %(event_id)d AS event_id,
         user_insert.user_id AS user_id,
         %(tlf)s AS tlf,
-        %(children_event_id_list)s AS children_event_id_list
+        %(children_event_id_list)s AS children_event_id_list,
+        -- same text as UserData.get_search_text(), see migration 0047
+        lower(concat_ws(
+          E'\\n',
+          NULLIF(user_insert.username, ''),
+          NULLIF(csv_data.email, ''),
+          NULLIF(%(tlf)s, ''),
+          (
+            SELECT string_agg(NULLIF(value, ''), E'\\n')
+            FROM jsonb_each_text(%(metadata)s)
+          )
+        )) AS search_text
       FROM user_insert
       LEFT JOIN csv_data ON csv_data.username = user_insert.username
       RETURNING id AS userdata_id
@@ -0,0 +1,97 @@
+# This file is part of authapi.
+# Copyright (C) 2014-2020  Agora Voting SL <contact@nvotes.com>
+
+# authapi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+
+# authapi  is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with authapi.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from api.models import AuthEvent, VoteCount, HourlyVoteCount
+
+
+class Command(BaseCommand):
+  '''
+  Recounts the unique voters (total and per hour) of the given auth events,
+  or of all of them, scanning their successful logins. Creates the
+  materialized vote counters that don't exist yet, which backfills them,
+  and fixes those that have drifted.
+  '''
+  help = 'backfill and recount the vote counters of the auth events'
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      'event-id',
+      nargs='*',
+      type=int,
+      help='auth events to reconcile, all of them if none is given'
+    )
+
+  def reconcile(self, auth_event):
+    '''
+    Recounts the votes of the auth event, returning True if its counters
+    had to be fixed
+    '''
+    with transaction.atomic():
+      # locking the counter makes new logins wait until we are done
+      vote_count = VoteCount.objects\
+        .select_for_update()\
+        .get(auth_event_id=auth_event.id)
+      total_votes = auth_event.count_num_votes()
+      votes_per_hour = auth_event.count_votes_per_hour()
+      hourly_vote_counts = HourlyVoteCount.objects\
+        .filter(auth_event_id=auth_event.id)
+      stored_votes_per_hour = list(
+        hourly_vote_counts\
+          .filter(votes__gt=0)\
+          .order_by('hour')\
+          .values_list('hour', 'votes')
+      )
+      if (
+        vote_count.total_votes == total_votes and
+        stored_votes_per_hour == votes_per_hour
+      ):
+        return False
+
+      print(
+        "auth event %d: counted %d votes, stored %d" % (
+          auth_event.id,
+          total_votes,
+          vote_count.total_votes
+        )
+      )
+      vote_count.total_votes = total_votes
+      vote_count.updated = timezone.now()
+      vote_count.save()
+      hourly_vote_counts.delete()
+      HourlyVoteCount.objects.bulk_create([
+        HourlyVoteCount(auth_event_id=auth_event.id, hour=hour, votes=votes)
+        for hour, votes in votes_per_hour
+      ])
+      return True
+
+  def handle(self, *args, **options):
+    auth_events = AuthEvent.objects.order_by('id')
+    if options['event-id']:
+      auth_events = auth_events.filter(id__in=options['event-id'])
+
+    created = 0
+    fixed = 0
+    for auth_event in auth_events.iterator():
+      if not VoteCount.objects.filter(auth_event_id=auth_event.id).exists():
+        auth_event.init_vote_counts()
+        created += 1
+      elif self.reconcile(auth_event):
+        fixed += 1
+
+    print("%d vote counters created, %d fixed" % (created, fixed))
@@ -0,0 +1,87 @@
+# This file is part of authapi.
+# Copyright (C) 2014-2020  Agora Voting SL <contact@nvotes.com>
+
+# authapi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+
+# authapi  is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with authapi.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from api.models import SendCodesChunk
+from utils import send_codes_chunk
+
+
+class Command(BaseCommand):
+  '''
+  Shows the progress of the unfinished send_codes chunks and resumes those
+  that failed or haven't made any progress for a while (for example because
+  their worker died). Resumed chunks continue from the first user that was
+  not sent its code.
+  '''
+  help = 'resume the failed or stalled send_codes chunks'
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      '--batch',
+      help='only resume the chunks of this send_codes batch'
+    )
+    parser.add_argument(
+      '--stale',
+      type=int,
+      default=3600,
+      help='seconds without progress after which a chunk is resumed'
+    )
+    parser.add_argument(
+      '--list',
+      action='store_true',
+      help='only show the progress, without resuming anything'
+    )
+
+  def handle(self, *args, **options):
+    chunks = SendCodesChunk.objects\
+      .exclude(status='done')\
+      .order_by('id')
+    if options['batch']:
+      chunks = chunks.filter(batch=options['batch'])
+
+    stale = timezone.now() - timedelta(seconds=options['stale'])
+    resumed = 0
+    for chunk in chunks:
+      print(
+        "chunk %d of batch %s (auth event %r): %d/%d sent, %s since %s" % (
+          chunk.id,
+          chunk.batch,
+          chunk.auth_event_id,
+          chunk.sent,
+          len(chunk.users),
+          chunk.status,
+          chunk.updated.isoformat()
+        )
+      )
+      if options['list']:
+        continue
+      if chunk.status == 'failed' or chunk.updated < stale:
+        # only if it's still in the same state, in case it's running now
+        updated = SendCodesChunk.objects\
+          .filter(
+            Q(pk=chunk.pk),
+            Q(status='failed') | Q(updated__lt=stale)
+          )\
+          .update(status='pending', updated=timezone.now())
+        if updated:
+          send_codes_chunk.apply_async(args=[chunk.id])
+          resumed += 1
+
+    print("%d chunks resumed" % resumed)
@@ -0,0 +1,42 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+
+# Same text as UserData.get_search_text()
+FILL_SEARCH_TEXT = r'''
+UPDATE api_userdata
+SET search_text = lower(concat_ws(
+    E'\n',
+    NULLIF(auth_user.username, ''),
+    NULLIF(auth_user.email, ''),
+    NULLIF(api_userdata.tlf, ''),
+    CASE WHEN jsonb_typeof(api_userdata.metadata) = 'object' THEN (
+        SELECT string_agg(NULLIF(value, ''), E'\n')
+        FROM jsonb_each_text(api_userdata.metadata)
+    ) END
+))
+FROM auth_user
+WHERE auth_user.id = api_userdata.user_id
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0046_authevent_tally_status'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='userdata',
+            name='search_text',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunSQL(FILL_SEARCH_TEXT, migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='userdata',
+            index=GinIndex(fields=['search_text'], name='api_userdata_search_trgm', opclasses=['gin_trgm_ops']),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0047_userdata_search_text'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='successfullogin',
+            index=models.Index(fields=['user', 'auth_event', 'is_active'], name='api_successfullogin_voted'),
+        ),
+    ]
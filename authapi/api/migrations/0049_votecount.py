@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0048_successfullogin_voted_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VoteCount',
+            fields=[
+                ('auth_event', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='vote_count', serialize=False, to='api.AuthEvent')),
+                ('total_votes', models.PositiveIntegerField(default=0)),
+                ('updated', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0049_votecount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HourlyVoteCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('votes', models.IntegerField(default=0)),
+                ('auth_event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hourly_vote_counts', to='api.AuthEvent')),
+            ],
+            options={
+                'unique_together': {('auth_event', 'hour')},
+            },
+        ),
+    ]
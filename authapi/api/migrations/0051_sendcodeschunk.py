@@ -0,0 +1,33 @@
+from django.conf import settings
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0050_hourlyvotecount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SendCodesChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch', models.CharField(db_index=True, max_length=255)),
+                ('ip', models.CharField(max_length=255)),
+                ('auth_method', models.CharField(max_length=255, null=True)),
+                ('config', django.contrib.postgres.fields.jsonb.JSONField(null=True)),
+                ('users', django.contrib.postgres.fields.jsonb.JSONField(default=list)),
+                ('sent', models.IntegerField(default=0)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=255)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated', models.DateTimeField(default=django.utils.timezone.now)),
+                ('auth_event', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='send_codes_chunks', to='api.AuthEvent')),
+                ('sender', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='send_codes_chunks', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
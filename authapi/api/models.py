@@ -14,20 +14,24 @@
 # along with authapi.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
+import uuid
+import hashlib
 import itertools
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
 
 from django.contrib.postgres import fields
+from django.contrib.postgres.indexes import GinIndex
 from jsonfield import JSONField
 
 from django.dispatch import receiver
-from django.db.models.signals import post_save
-from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.db.models import Q, F, Count
+from django.db.models.functions import TruncHour
 from django.conf import settings
-from utils import genhmac
+from utils import genhmac, get_shared_cache, reproducible_json_dumps
 from django.utils import timezone
 
 from contracts.base import check_contract
@@ -338,20 +342,40 @@ class AuthEvent(models.Model):
            isinstance(self.auth_method_config.get('config', None), dict) and\
            True == self.auth_method_config['config'].get('allow_user_resend', None)
 
-    def serialize(self, restrict=False):
+    def get_stats(self, restrict=False):
+        '''
+        Returns the stats of this event used by serialize(). See
+        get_auth_events_stats() to get them for a list of events at once.
+        '''
+        # auth codes sent by authmethod
+        from authmethods.models import Code
+
+        stats = {'users': self.len_census()}
+        if not restrict:
+            stats.update({
+                'codes': Code.objects.filter(auth_event_id=self.id).count(),
+                'total_votes': self.get_num_votes(),
+                'children_tally_status': self.children_tally_status()
+            })
+        return stats
+
+    def serialize(self, restrict=False, stats=None):
         '''
         Used to serialize data when the user has priviledges to see all the data
         (for example, admins). This includes auth method config, stats, and
         access to private extra_fields.
+
+        The stats can be given already calculated (see get_stats()), otherwise
+        they are queried.
         '''
-        # auth codes sent by authmethod
-        from authmethods.models import Code
+        if stats is None:
+            stats = self.get_stats(restrict)
 
         d = {
             'id': self.id,
             'auth_method': self.auth_method,
             'census': self.census,
-            'users': self.len_census(),
+            'users': stats['users'],
             'has_ballot_boxes': self.has_ballot_boxes,
             'tally_status': self.tally_status,
             'allow_public_census_query': self.allow_public_census_query,
@@ -361,7 +385,7 @@ class AuthEvent(models.Model):
             'based_in': self.based_in,
             'num_successful_logins_allowed': self.num_successful_logins_allowed,
             'hide_default_login_lookup_field': self.hide_default_login_lookup_field,
-            'parent_id': self.parent.id if self.parent is not None else None,
+            'parent_id': self.parent_id,
             'children_election_info': self.children_election_info,
             'auth_method_config': {
                'config': {
@@ -396,21 +420,21 @@ class AuthEvent(models.Model):
                 'extra_fields': self.extra_fields,
                 'auth_method_config': self.auth_method_config,
                 'auth_method_stats': {
-                    self.auth_method: Code.objects.filter(auth_event_id=self.id).count()
+                    self.auth_method: stats['codes']
                 },
                 'admin_fields': self.admin_fields,
-                'total_votes': self.get_num_votes(),
-                'children_tally_status': self.children_tally_status()
+                'total_votes': stats['total_votes'],
+                'children_tally_status': stats['children_tally_status']
             })
 
         return d
 
-    def serialize_restrict(self):
+    def serialize_restrict(self, stats=None):
         '''
         Used to serialize public data that anyone should be able to see about an
         AuthEvent.
         '''
-        return self.serialize(restrict=True)
+        return self.serialize(restrict=True, stats=stats)
 
     def get_census_query(self):
         '''
@@ -437,10 +461,10 @@ class AuthEvent(models.Model):
             ) & sub_query
         )
 
-    def get_num_votes(self):
+    def get_votes_query(self):
         '''
-        Returns the number of votes in this election and in
-        children elections (if any).
+        Returns a query with all the successful logins that count as votes in
+        this election and in children elections (if any).
         '''
         if self.children_election_info:
             children_election_ids = self.children_election_info['natural_order']
@@ -452,10 +476,125 @@ class AuthEvent(models.Model):
                 Q(auth_event_id=self.pk) |
                 Q(auth_event__parent_id=self.pk) |
                 Q(auth_event__parent_id__in=children_election_ids)
-            )\
+            )
+
+    def count_num_votes(self):
+        '''
+        Counts the number of unique voters in this election and in children
+        elections (if any), scanning all the successful logins.
+        '''
+        return self.get_votes_query()\
             .order_by('user_id', '-created')\
             .distinct('user_id')\
             .count()
+
+    def count_votes_per_hour(self):
+        '''
+        Counts the number of unique voters in this election and in children
+        elections (if any) per hour of their last successful login, scanning
+        all the successful logins. Returns a list of (hour, votes) tuples.
+        '''
+        last_logins = self.get_votes_query()\
+            .order_by('user_id', '-created')\
+            .distinct('user_id')
+        return list(
+            self.get_votes_query()\
+                .filter(id__in=last_logins)\
+                .annotate(hour=TruncHour('created'))\
+                .values_list('hour')\
+                .annotate(votes=Count('user_id'))\
+                .order_by('hour')
+        )
+
+    def init_vote_counts(self):
+        '''
+        Creates the VoteCount and the HourlyVoteCounts of this election, and
+        returns the former. If they already exist, nothing is done.
+
+        The logins that commit after the votes are counted but before the
+        new VoteCount is visible can't update it in register_vote(), so once
+        created the votes are counted again holding its lock. The logins that
+        commit later wait for the lock and update the new counts.
+        '''
+        try:
+            with transaction.atomic():
+                VoteCount.objects.create(
+                    auth_event_id=self.pk,
+                    total_votes=self.count_num_votes()
+                )
+                HourlyVoteCount.objects.bulk_create([
+                    HourlyVoteCount(auth_event_id=self.pk, hour=hour, votes=votes)
+                    for hour, votes in self.count_votes_per_hour()
+                ])
+        except IntegrityError:
+            return VoteCount.objects.get(auth_event_id=self.pk)
+
+        with transaction.atomic():
+            vote_count = VoteCount.objects\
+                .select_for_update()\
+                .get(auth_event_id=self.pk)
+            vote_count.total_votes = self.count_num_votes()
+            vote_count.updated = timezone.now()
+            vote_count.save()
+            HourlyVoteCount.objects.filter(auth_event_id=self.pk).delete()
+            HourlyVoteCount.objects.bulk_create([
+                HourlyVoteCount(auth_event_id=self.pk, hour=hour, votes=votes)
+                for hour, votes in self.count_votes_per_hour()
+            ])
+        return vote_count
+
+    def get_num_votes(self):
+        '''
+        Returns the number of votes in this election and in
+        children elections (if any), read from its VoteCount. The counter is
+        created with count_num_votes() the first time it's needed.
+        '''
+        vote_count = VoteCount.objects\
+            .filter(auth_event_id=self.pk)\
+            .values_list('total_votes', flat=True)\
+            .first()
+        if vote_count is not None:
+            return vote_count
+
+        return self.init_vote_counts().total_votes
+
+    def get_votes_per_hour(self):
+        '''
+        Returns the same as count_votes_per_hour(), read from the
+        HourlyVoteCounts of this election.
+        '''
+        if not VoteCount.objects.filter(auth_event_id=self.pk).exists():
+            self.init_vote_counts()
+
+        # in the current timezone, as returned by TruncHour
+        return [
+            (timezone.localtime(hour), votes)
+            for hour, votes in HourlyVoteCount.objects\
+                .filter(auth_event_id=self.pk, votes__gt=0)\
+                .order_by('hour')\
+                .values_list('hour', 'votes')
+        ]
+
+    def reset_vote_counts(self):
+        '''
+        Removes the vote counters (total and per hour) of this election and of its parents and
+        children elections, so that they are counted again the next time
+        they are needed. Used when successful logins are deleted.
+        '''
+        auth_event_ids = []
+        auth_event = self
+        while auth_event is not None:
+            auth_event_ids.append(auth_event.pk)
+            auth_event = auth_event.parent
+
+        q = (
+            Q(auth_event_id__in=auth_event_ids) |
+            Q(auth_event__parent_id=self.pk) |
+            Q(auth_event__parent__parent_id=self.pk)
+        )
+        with transaction.atomic():
+            VoteCount.objects.filter(q).delete()
+            HourlyVoteCount.objects.filter(q).delete()
     
     def children_tally_status(self):
         '''
@@ -504,6 +643,121 @@ STATUSES = (
 )
 
 
+def get_auth_event_cache():
+    '''
+    Returns the cache used to keep the public data of the auth events, or
+    None if it's disabled.
+    '''
+    return get_shared_cache(settings.AUTH_EVENT_CACHE)
+
+
+def auth_event_version_key(auth_event_id):
+    return 'auth_event_version:%s' % auth_event_id
+
+
+def bump_auth_event_version(auth_event_id):
+    '''
+    Invalidates the cached public data of the auth event, and of its
+    children elections, by changing its version. The versions of its parent
+    elections are also changed, as their census include the one of their
+    children.
+    '''
+    cache = get_auth_event_cache()
+    if cache is None:
+        return
+
+    auth_event_ids = []
+    while (
+        auth_event_id is not None and
+        str(auth_event_id) not in auth_event_ids
+    ):
+        auth_event_ids.append(str(auth_event_id))
+        auth_event_id = AuthEvent.objects\
+            .filter(pk=auth_event_id)\
+            .values_list('parent_id', flat=True)\
+            .first()
+
+    version = uuid.uuid4().hex
+    cache.set_many(
+        dict(
+            (auth_event_version_key(auth_event_id), version)
+            for auth_event_id in auth_event_ids
+        ),
+        None
+    )
+
+
+def get_auth_event_version(cache, auth_event_id):
+    version = cache.get(auth_event_version_key(auth_event_id))
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(auth_event_version_key(auth_event_id), version, None):
+            version = cache.get(auth_event_version_key(auth_event_id))
+    return version
+
+
+def get_serialized_restrict(auth_event_id):
+    '''
+    Returns the AuthEvent.serialize_restrict() data of the given auth event
+    and its ETag, using the cache if enabled. The cached data is valid while
+    the versions of the auth event and of its parent (whose census is also
+    counted in the children elections) don't change.
+    '''
+    cache = get_auth_event_cache()
+    if cache is None:
+        data = AuthEvent.objects.get(pk=auth_event_id).serialize_restrict()
+        return data, None
+
+    version = get_auth_event_version(cache, auth_event_id)
+    data_key = 'auth_event_restrict:%s:%s' % (auth_event_id, version)
+    entry = cache.get(data_key)
+    if (
+        entry is not None and
+        entry['parent_id'] is not None and
+        entry['parent_version'] != get_auth_event_version(cache, entry['parent_id'])
+    ):
+        entry = None
+
+    if entry is None:
+        auth_event = AuthEvent.objects.get(pk=auth_event_id)
+        data = auth_event.serialize_restrict()
+        entry = dict(
+            data=data,
+            etag='"%s"' % hashlib.sha1(
+                reproducible_json_dumps(data).encode('utf-8')
+            ).hexdigest(),
+            parent_id=auth_event.parent_id,
+            parent_version=(
+                get_auth_event_version(cache, auth_event.parent_id)
+                if auth_event.parent_id is not None
+                else None
+            )
+        )
+        cache.set(data_key, entry, settings.AUTH_EVENT_CACHE_TIMEOUT)
+    return entry['data'], entry['etag']
+
+
+@receiver(post_save, sender=AuthEvent)
+@receiver(post_delete, sender=AuthEvent)
+def clear_auth_event_cache(sender, instance, *args, **kwargs):
+    bump_auth_event_version(instance.pk)
+    # once deleted, its parent can't be looked up by bump_auth_event_version
+    if instance.parent_id is not None:
+        bump_auth_event_version(instance.parent_id)
+
+
+def get_acl_cache():
+    '''
+    Returns the cache used to share the permissions of the users, or None if
+    it's disabled.
+    '''
+    return get_shared_cache(settings.ACL_CACHE)
+
+
+def acl_cache_key(userdata_id):
+    return 'acl_perms:%d' % userdata_id
+
+
 class UserData(models.Model):
     '''
     This is a class attached one to one to a user, that stores extra user
@@ -526,6 +780,58 @@ class UserData(models.Model):
         null=True, 
         validators=[children_event_id_list_validator])
 
+    # Lowercase text with the username, email, tlf and metadata values of the
+    # user, separated by new lines. It's updated on save() and indexed with
+    # trigrams, to search the census with LIKE '%...%'
+    search_text = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            GinIndex(
+                fields=['search_text'],
+                name='api_userdata_search_trgm',
+                opclasses=['gin_trgm_ops']
+            ),
+        ]
+
+    def get_search_text(self):
+        values = [self.user.username, self.user.email, self.tlf]
+        if isinstance(self.metadata, dict):
+            for value in self.metadata.values():
+                if value is None:
+                    continue
+                if not isinstance(value, str):
+                    value = json.dumps(value)
+                values.append(value)
+        return '\n'.join(value for value in values if value).lower()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(UserData, cls).from_db(db, field_names, values)
+        instance._loaded_children_event_id_list = instance.__dict__.get(
+            'children_event_id_list'
+        )
+        return instance
+
+    def save(self, *args, **kwargs):
+        if self.user_id is not None:
+            self.search_text = self.get_search_text()
+        children_changed = (
+            'children_event_id_list' in self.__dict__ and
+            self.children_event_id_list != getattr(
+                self,
+                '_loaded_children_event_id_list',
+                None
+            )
+        )
+        super(UserData, self).save(*args, **kwargs)
+
+        # the census of the children elections depends on it
+        if children_changed:
+            self._loaded_children_event_id_list = self.children_event_id_list
+            if self.event_id is not None:
+                bump_auth_event_version(self.event_id)
+
     def get_perms(self, obj, permission, object_id=0):
         q = Q(object_type=obj, perm=permission)
         q2 = Q(object_id=object_id)
@@ -534,8 +840,55 @@ class UserData(models.Model):
 
         return self.acls.filter(q & q2)
 
+    def get_perms_snapshot(self):
+        '''
+        Returns the set of (object_type, perm, object_id) tuples granted to
+        this user. It's loaded with a single query the first time it's needed
+        and kept in this instance, so that all the permission checks done
+        during a request over the same user data share it.
+
+        If settings.ACL_CACHE is set, the snapshot is also shared between
+        requests and processes through that cache.
+        '''
+        snapshot = getattr(self, '_perms_snapshot', None)
+        if snapshot is not None:
+            return snapshot
+
+        cache = get_acl_cache()
+        if cache is not None:
+            snapshot = cache.get(acl_cache_key(self.pk))
+
+        if snapshot is None:
+            snapshot = set(
+                self.acls.values_list('object_type', 'perm', 'object_id')
+            )
+            if cache is not None:
+                cache.set(
+                    acl_cache_key(self.pk),
+                    snapshot,
+                    settings.ACL_CACHE_TIMEOUT
+                )
+
+        self._perms_snapshot = snapshot
+        return snapshot
+
+    def clear_perms_snapshot(self):
+        self._perms_snapshot = None
+        cache = get_acl_cache()
+        if cache is not None:
+            cache.delete(acl_cache_key(self.pk))
+
     def has_perms(self, obj, permission, object_id=0):
-        return bool(self.get_perms(obj, permission, object_id).count())
+        # same matching rules as get_perms(), but using the snapshot
+        object_ids = [str(object_id)]
+        if not object_id:
+            object_ids.append('')
+
+        snapshot = self.get_perms_snapshot()
+        return any(
+            (obj, permission, acl_object_id) in snapshot
+            for acl_object_id in object_ids
+        )
 
     def serialize_draft(self):
         d = {}
@@ -574,25 +927,7 @@ class UserData(models.Model):
         return d
 
     def serialize_children_voted_elections(self, auth_event):
-        if auth_event.children_election_info:
-            return list(set([
-                successful_login.auth_event.pk
-                for successful_login in self.successful_logins.filter(
-                    Q(is_active=True) & 
-                    (
-                        Q(auth_event__parent_id=auth_event.pk) |
-                        Q(auth_event__parent__parent_id=auth_event.pk)
-                    )
-                )
-            ]))
-        else:
-            return list(set([
-                successful_login.auth_event.pk
-                for successful_login in self.successful_logins.filter(
-                    is_active=True, 
-                    auth_event_id=auth_event.pk
-                )
-            ]))
+        return get_voted_elections(auth_event, [self.pk])[self.pk]
 
     def serialize_data(self):
         d = self.serialize()
@@ -614,6 +949,8 @@ class UserData(models.Model):
 @receiver(post_save, sender=User)
 def create_user_data(sender, instance, created, *args, **kwargs):
     ud, _ = UserData.objects.get_or_create(user=instance)
+    # also updates the search text with the user data
+    ud.user = instance
     ud.save()
 
 
@@ -726,6 +1063,33 @@ class ACL(models.Model):
         return "%s - %s - %s - %s" % (self.user.user.username, self.perm,
                                       self.object_type, self.object_id)
 
+@receiver(post_save, sender=ACL)
+@receiver(post_delete, sender=ACL)
+def clear_acl_user_perms(sender, instance, *args, **kwargs):
+    '''
+    Invalidates the permissions snapshot of the user data object related to
+    the ACL, both in the cache and in the instance if it's already loaded,
+    so that it doesn't get stale.
+    '''
+    if ACL.user.is_cached(instance):
+        instance.user.clear_perms_snapshot()
+        return
+
+    cache = get_acl_cache()
+    if cache is not None:
+        cache.delete(acl_cache_key(instance.user_id))
+
+
+@receiver(post_save, sender=ACL)
+@receiver(post_delete, sender=ACL)
+def clear_acl_auth_event_cache(sender, instance, *args, **kwargs):
+    '''
+    The census size is part of the cached public data of the auth event.
+    '''
+    if instance.object_type == 'AuthEvent' and instance.perm == 'vote':
+        bump_auth_event_version(instance.object_id)
+
+
 class SuccessfulLogin(models.Model):
     '''
     Each successful login attempt is recorded with an object of this type, and
@@ -743,9 +1107,247 @@ class SuccessfulLogin(models.Model):
         null=True,
         default=None)
 
+    class Meta:
+        indexes = [
+            # used to find if a voter has voted in an election
+            models.Index(
+                fields=['user', 'auth_event', 'is_active'],
+                name='api_successfullogin_voted'
+            ),
+        ]
+
     def __str__(self):
         return "%d: %s - %s" % (self.id, self.user.user.username, str(self.created),)
 
+def get_auth_events_stats(auth_events, restrict=False):
+    '''
+    Returns a dict mapping the id of each of the given auth events to its
+    stats, the same as AuthEvent.get_stats() but with a few grouped queries
+    for all the events instead of some queries per event.
+    '''
+    from authmethods.models import Code
+
+    stats = dict((auth_event.id, dict()) for auth_event in auth_events)
+    if not auth_events:
+        return stats
+
+    # census size, see AuthEvent.get_census_query(). First the vote ACLs
+    # of each election, including the children of parent elections
+    census_ids = set()
+    for auth_event in auth_events:
+        census_ids.add(auth_event.id)
+        if auth_event.children_election_info and auth_event.parent_id is None:
+            census_ids.update(auth_event.children_election_info['natural_order'])
+    census_acls = ACL.objects.filter(object_type='AuthEvent', perm='vote')
+    census_counts = dict(
+        census_acls\
+            .filter(object_id__in=[str(i) for i in census_ids])\
+            .values_list('object_id')\
+            .annotate(total=models.Count('id'))\
+            .order_by()
+    )
+
+    # then the voters of the parent election that are in the census of each
+    # child election
+    children = [
+        auth_event
+        for auth_event in auth_events
+        if not auth_event.children_election_info and auth_event.parent_id
+    ]
+    children_counts = dict()
+    if children:
+        children_counts = census_acls\
+            .filter(object_id__in=[str(child.parent_id) for child in children])\
+            .aggregate(**dict(
+                (
+                    'child_%d' % child.id,
+                    models.Count('id', filter=Q(
+                        object_id=str(child.parent_id),
+                        user__children_event_id_list__contains=child.id
+                    ))
+                )
+                for child in children
+            ))
+
+    for auth_event in auth_events:
+        users = census_counts.get(str(auth_event.id), 0)
+        if auth_event.children_election_info:
+            if auth_event.parent_id is None:
+                users += sum(
+                    census_counts.get(str(i), 0)
+                    for i in auth_event.children_election_info['natural_order']
+                )
+        elif auth_event.parent_id:
+            users += children_counts['child_%d' % auth_event.id]
+        stats[auth_event.id]['users'] = users
+
+    if restrict:
+        return stats
+
+    auth_event_ids = list(stats.keys())
+    codes = dict(
+        Code.objects\
+            .filter(auth_event_id__in=auth_event_ids)\
+            .values_list('auth_event_id')\
+            .annotate(total=models.Count('id'))\
+            .order_by()
+    )
+    vote_counts = dict(
+        VoteCount.objects\
+            .filter(auth_event_id__in=auth_event_ids)\
+            .values_list('auth_event_id', 'total_votes')
+    )
+    children_tally_status = dict(
+        (auth_event_id, []) for auth_event_id in auth_event_ids
+    )
+    for child in AuthEvent.objects\
+            .filter(parent_id__in=auth_event_ids)\
+            .values('tally_status', 'id', 'parent_id'):
+        children_tally_status[child.pop('parent_id')].append(child)
+
+    for auth_event in auth_events:
+        total_votes = vote_counts.get(auth_event.id)
+        if total_votes is None:
+            # the counter is created the first time
+            total_votes = auth_event.get_num_votes()
+        stats[auth_event.id].update({
+            'codes': codes.get(auth_event.id, 0),
+            'total_votes': total_votes,
+            'children_tally_status': children_tally_status[auth_event.id]
+        })
+    return stats
+
+class VoteCount(models.Model):
+    '''
+    Materialized number of unique voters of an auth event, as returned by
+    AuthEvent.count_num_votes(), so that reading it doesn't depend on the
+    number of votes. It's updated with each successful login by
+    register_vote(), and can be reconciled with the reconcile_vote_counts
+    management command.
+    '''
+    auth_event = models.OneToOneField(
+        AuthEvent,
+        models.CASCADE,
+        primary_key=True,
+        related_name="vote_count")
+    total_votes = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return "%d: %d" % (self.auth_event_id, self.total_votes)
+
+class HourlyVoteCount(models.Model):
+    '''
+    Materialized number of unique voters of an auth event whose last
+    successful login was in a given hour, as returned by
+    AuthEvent.count_votes_per_hour(). Exists and is maintained along with
+    the VoteCount of the auth event.
+    '''
+    auth_event = models.ForeignKey(
+        AuthEvent,
+        models.CASCADE,
+        related_name="hourly_vote_counts")
+    hour = models.DateTimeField()
+    votes = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (
+            ("auth_event", "hour"),
+        )
+
+    def __str__(self):
+        return "%d: %s - %d" % (self.auth_event_id, str(self.hour), self.votes)
+
+def truncate_hour(date):
+    '''
+    Same as TruncHour() in the database
+    '''
+    return timezone.localtime(date).replace(minute=0, second=0, microsecond=0)
+
+def register_vote(successful_login):
+    '''
+    Updates the vote counters affected by a new successful login, which are
+    those of its auth event and of its parents. The voter is only counted in
+    the total of those where this is its first successful login, and is
+    moved to the hour of this login in the hourly counts.
+
+    Should be called within a transaction that locks the voter, so that
+    concurrent logins of the same voter are not counted twice. Counters that
+    don't exist yet are not created: they will include this login when
+    they're first read.
+    '''
+    auth_event = successful_login.auth_event
+    hour = truncate_hour(successful_login.created)
+    while auth_event is not None:
+        previous_login = auth_event.get_votes_query()\
+            .filter(user_id=successful_login.user_id)\
+            .exclude(pk=successful_login.pk)\
+            .order_by('-created')\
+            .values_list('created', flat=True)\
+            .first()
+        vote_count = VoteCount.objects.filter(auth_event_id=auth_event.pk)
+        if previous_login is None:
+            counted = vote_count.update(
+                total_votes=F('total_votes') + 1,
+                updated=timezone.now()
+            )
+        else:
+            counted = vote_count.update(updated=timezone.now())
+
+        # updating the VoteCount locks it, so the hourly counts of the auth
+        # event can't be updated concurrently
+        if counted:
+            hourly_vote_counts = HourlyVoteCount.objects\
+                .filter(auth_event_id=auth_event.pk)
+            if previous_login is not None:
+                hourly_vote_counts\
+                    .filter(hour=truncate_hour(previous_login))\
+                    .update(votes=F('votes') - 1)
+            updated = hourly_vote_counts\
+                .filter(hour=hour)\
+                .update(votes=F('votes') + 1)
+            if not updated:
+                HourlyVoteCount.objects.create(
+                    auth_event_id=auth_event.pk,
+                    hour=hour,
+                    votes=1
+                )
+        auth_event = auth_event.parent
+
+def get_voted_logins_q(auth_event):
+    '''
+    Returns the filter of the active successful logins that count as votes in
+    the auth event: those of its children elections if it has any, or those
+    of the auth event itself otherwise.
+    '''
+    if auth_event.children_election_info:
+        q = (
+            Q(auth_event__parent_id=auth_event.pk) |
+            Q(auth_event__parent__parent_id=auth_event.pk)
+        )
+    else:
+        q = Q(auth_event_id=auth_event.pk)
+    return q & Q(is_active=True)
+
+def get_voted_elections(auth_event, userdata_ids):
+    '''
+    Returns a dict mapping each of the given user data ids to the list of ids
+    of the elections in which it has voted (see get_voted_logins_q()). Uses
+    a single query for all the users.
+    '''
+    voted = dict((userdata_id, set()) for userdata_id in userdata_ids)
+    successful_logins = SuccessfulLogin.objects\
+        .filter(get_voted_logins_q(auth_event), user_id__in=userdata_ids)\
+        .values_list('user_id', 'auth_event_id')\
+        .distinct()
+    for userdata_id, auth_event_id in successful_logins:
+        voted[userdata_id].add(auth_event_id)
+
+    return dict(
+        (userdata_id, list(election_ids))
+        for userdata_id, election_ids in voted.items()
+    )
+
 class BallotBox(models.Model):
     '''
     Registers the list of ballot boxes related to a ballot box auth_event
@@ -809,3 +1411,54 @@ class TallySheet(models.Model):
             self.ballot_box.auth_event.id,
             str(self.created)
         )
+
+
+SEND_CODES_CHUNK_STATUSES = (
+    ('pending', 'Pending'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+)
+
+class SendCodesChunk(models.Model):
+    '''
+    Chunk of the users to which a send_codes task sends the authentication
+    codes, sent by an independent send_codes_chunk task. It records how many
+    of its users have already been sent their code, so that it can be
+    resumed without sending them twice.
+    '''
+    # identifies all the chunks of the same send_codes task
+    batch = models.CharField(max_length=255, db_index=True)
+    auth_event = models.ForeignKey(
+        AuthEvent,
+        models.CASCADE,
+        related_name="send_codes_chunks",
+        null=True)
+    sender = models.ForeignKey(
+        User,
+        models.SET_NULL,
+        related_name="send_codes_chunks",
+        null=True)
+    ip = models.CharField(max_length=255)
+    auth_method = models.CharField(max_length=255, null=True)
+    config = fields.JSONField(null=True)
+
+    # list of user ids
+    users = fields.JSONField(default=list)
+    sent = models.IntegerField(default=0)
+    status = models.CharField(
+        max_length=255,
+        choices=SEND_CODES_CHUNK_STATUSES,
+        default='pending',
+        db_index=True)
+    created = models.DateTimeField(default=timezone.now)
+    updated = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return "%d: %s - %d/%d - %s" % (
+            self.id,
+            self.batch,
+            self.sent,
+            len(self.users),
+            self.status
+        )
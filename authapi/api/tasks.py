@@ -15,15 +15,18 @@
 
 import requests
 import json
+from datetime import timedelta
 from djcelery import celery
 from django.conf import settings
 from django.core.mail import send_mail
-from django.db.models import Count, OuterRef, Subquery, Q
+from django.db.models import Count, Max, OuterRef, Subquery, Q
+from django.utils import timezone
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.models import User
 from celery.utils.log import get_task_logger
 
 import plugins
+from authmethods.models import Code, Connection, Message, MsgLog
 from authmethods.sms_provider import SMSProvider
 from utils import send_codes, genhmac, reproducible_json_dumps
 from .models import Action, AuthEvent, BallotBox, TallySheet
@@ -936,3 +939,95 @@ def allow_tally_task(user_id, auth_event_id, parent_auth_event=None):
             )
         )
         action.save()
+
+
+# models pruned by prune_authmethods_tables, with their auth event id field
+RETENTION_MODELS = (
+    (Code, 'auth_event_id'),
+    (Message, 'auth_event_id'),
+    (MsgLog, 'authevent_id'),
+    (Connection, 'auth_event_id'),
+)
+
+def get_finished_auth_event_ids(days):
+    '''
+    Returns the ids of the stopped auth events that were stopped more than the
+    given number of days ago. Children elections are stopped with their
+    parent, and the action is then registered with the parent.
+    '''
+    threshold = timezone.now() - timedelta(days=days)
+    stop_dates = dict(
+        Action.objects\
+            .filter(action_name='authevent:stop')\
+            .values('event_id')\
+            .annotate(stopped=Max('created'))\
+            .values_list('event_id', 'stopped')
+    )
+    stopped_events = AuthEvent.objects\
+        .filter(status='stopped')\
+        .values_list('id', 'parent_id', 'parent__parent_id')
+    finished_ids = []
+    for event_ids in stopped_events:
+        dates = [
+            stop_dates[event_id]
+            for event_id in event_ids
+            if event_id in stop_dates
+        ]
+        if dates and max(dates) < threshold:
+            finished_ids.append(event_ids[0])
+    return finished_ids
+
+def delete_in_batches(query, batch_size):
+    '''
+    Deletes the rows of the query with one query per batch_size rows, so that
+    no long lock is held. Returns the number of rows deleted.
+    '''
+    deleted = 0
+    while True:
+        ids = list(
+            query.order_by('id').values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return deleted
+        deleted += query.model.objects.filter(id__in=ids).delete()[0]
+
+@celery.task(name='tasks.prune_authmethods_tables')
+def prune_authmethods_tables():
+    '''
+    Deletes the codes, messages, message logs and connections that are not
+    kept anymore by the retention policy in settings.AUTHMETHODS_RETENTION.
+    Returns the number of rows deleted from each table.
+    '''
+    batch_size = max(settings.AUTHMETHODS_RETENTION_BATCH_SIZE, 1)
+    finished_ids = dict()
+    report = dict()
+    for model, event_field in RETENTION_MODELS:
+        policy = settings.AUTHMETHODS_RETENTION.get(model.__name__, {})
+        deleted = 0
+
+        days = policy.get('days')
+        if days is not None:
+            deleted += delete_in_batches(
+                model.objects.filter(
+                    created__lt=timezone.now() - timedelta(days=days)
+                ),
+                batch_size
+            )
+
+        finished_days = policy.get('finished_days')
+        if finished_days is not None:
+            if finished_days not in finished_ids:
+                finished_ids[finished_days] = \
+                    get_finished_auth_event_ids(finished_days)
+            if finished_ids[finished_days]:
+                deleted += delete_in_batches(
+                    model.objects.filter(**{
+                        event_field + '__in': finished_ids[finished_days]
+                    }),
+                    batch_size
+                )
+
+        report[model.__name__] = deleted
+
+    logger.info('tasks.prune_authmethods_tables: deleted rows %r' % report)
+    return report
@@ -551,6 +551,70 @@ class ApiTestCase(TestCase):
         r = parse_json_response(response)
         self.assertEqual(r['perm'], False)
 
+    def test_perms_snapshot(self):
+        userdata = User.objects.get(pk=self.userid).userdata
+        with self.assertNumQueries(1):
+            self.assertTrue(userdata.has_perms('AuthEvent', 'create'))
+            self.assertTrue(userdata.has_perms('AuthEvent', 'edit', self.aeid))
+            self.assertFalse(userdata.has_perms('AuthEvent', 'edit', self.aeid + 1))
+            self.assertFalse(userdata.has_perms('AuthEvent', 'delete', self.aeid))
+
+        # saving or deleting an acl invalidates the snapshot
+        acl = ACL(user=userdata, object_type='AuthEvent', perm='delete', object_id=self.aeid)
+        acl.save()
+        self.assertTrue(userdata.has_perms('AuthEvent', 'delete', self.aeid))
+        acl.delete()
+        self.assertFalse(userdata.has_perms('AuthEvent', 'delete', self.aeid))
+
+    @override_settings(ACL_CACHE='default')
+    def test_perms_shared_cache(self):
+        from django.core.cache import caches
+        caches['default'].clear()
+        userdata = User.objects.get(pk=self.userid).userdata
+        with self.assertNumQueries(1):
+            self.assertTrue(userdata.has_perms('AuthEvent', 'create'))
+
+        # another instance of the same user data reuses the cached perms
+        userdata = User.objects.get(pk=self.userid).userdata
+        with self.assertNumQueries(0):
+            self.assertTrue(userdata.has_perms('AuthEvent', 'create'))
+            self.assertFalse(userdata.has_perms('AuthEvent', 'delete', self.aeid))
+
+        acl = ACL(user_id=userdata.pk, object_type='AuthEvent', perm='delete', object_id=self.aeid)
+        acl.save()
+        userdata = User.objects.get(pk=self.userid).userdata
+        self.assertTrue(userdata.has_perms('AuthEvent', 'delete', self.aeid))
+
+        ACL.objects.filter(pk=acl.pk).delete()
+        userdata = User.objects.get(pk=self.userid).userdata
+        self.assertFalse(userdata.has_perms('AuthEvent', 'delete', self.aeid))
+        caches['default'].clear()
+
+    @override_settings(
+        ACL_CACHE='default',
+        LOCAL_CACHE_BACKENDS=['django.core.cache.backends.locmem.LocMemCache']
+    )
+    def test_perms_local_cache_not_used(self):
+        from django.core.cache import caches
+        caches['default'].clear()
+        userdata = User.objects.get(pk=self.userid).userdata
+        self.assertTrue(userdata.has_perms('AuthEvent', 'create'))
+
+        # a cache that is not shared by all the processes is not used
+        userdata = User.objects.get(pk=self.userid).userdata
+        with self.assertNumQueries(1):
+            self.assertTrue(userdata.has_perms('AuthEvent', 'create'))
+        caches['default'].clear()
+
+    def test_permission_required_global_perm(self):
+        from utils import permission_required
+        user = User.objects.get(pk=self.userid)
+        # the global 'view' perm applies to any auth event
+        self.assertTrue(permission_required(
+            user, 'AuthEvent', ['edit', 'view'], self.aeid + 1, return_bool=True))
+        self.assertFalse(permission_required(
+            user, 'AuthEvent', ['delete', 'census-add'], self.aeid, return_bool=True))
+
     def test_acl_mine(self):
         c = JClient()
         response = c.authenticate(self.aeid_special, self.admin_auth_data)
@@ -604,6 +668,244 @@ class ApiTestCase(TestCase):
         r = parse_json_response(response)
         self.assertEqual(len(r['perms']), 2)
 
+    @override_settings(PAGINATION_COUNT_STRATEGY='cached')
+    def test_pagination_cached_count(self):
+        from django.core.cache import cache
+        cache.clear()
+        c = JClient()
+        response = c.authenticate(self.aeid_special, self.admin_auth_data)
+        self.assertEqual(response.status_code, 200)
+
+        response = c.get('/api/acl/mine/', {'n': 2})
+        r = parse_json_response(response)
+        self.assertEqual(r['total_count'], 7)
+        self.assertEqual(r['total_count_strategy'], 'cached')
+
+        acl = ACL(user=self.testuser.userdata, object_type='AuthEvent', perm='delete', object_id=0)
+        acl.save()
+        response = c.get('/api/acl/mine/', {'n': 2})
+        r = parse_json_response(response)
+        self.assertEqual(r['total_count'], 7)
+
+        # the cache key depends on the filters
+        response = c.get('/api/acl/mine/', {'n': 2, 'object_type': 'AuthEvent'})
+        r = parse_json_response(response)
+        self.assertEqual(r['total_count'], 4)
+
+        cache.clear()
+        response = c.get('/api/acl/mine/', {'n': 2})
+        r = parse_json_response(response)
+        self.assertEqual(r['total_count'], 8)
+
+    def test_pagination_estimated_count(self):
+        from unittest import mock
+        from django.db import connection
+        c = JClient()
+        response = c.authenticate(self.aeid_special, self.admin_auth_data)
+        self.assertEqual(response.status_code, 200)
+
+        with override_settings(PAGINATION_COUNT_STRATEGY='estimate'):
+            # small tables use the exact count
+            response = c.get('/api/auth-event/', {'n': 2})
+            r = parse_json_response(response)
+            self.assertEqual(r['total_count_strategy'], 'exact')
+            self.assertEqual(r['total_count'], AuthEvent.objects.count())
+
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE api_authevent')
+            with override_settings(PAGINATION_COUNT_ESTIMATE_MIN=0):
+                response = c.get('/api/auth-event/', {'n': 2})
+                r = parse_json_response(response)
+                self.assertEqual(r['total_count_strategy'], 'estimate')
+                self.assertEqual(r['total_count'], AuthEvent.objects.count())
+
+                # filtered listings are never estimated
+                response = c.get('/api/auth-event/', {'n': 2, 'ids': str(self.aeid)})
+                r = parse_json_response(response)
+                self.assertEqual(r['total_count_strategy'], 'exact')
+                self.assertEqual(r['total_count'], 1)
+
+                # an estimate lower than the real count doesn't hide the last
+                # rows
+                num_events = AuthEvent.objects.count()
+                with mock.patch('utils.estimate_table_count', lambda model: 1):
+                    response = c.get('/api/auth-event/', {'n': 1, 'page': num_events})
+                    self.assertEqual(response.status_code, 200)
+                    r = parse_json_response(response)
+                    self.assertEqual(r['total_count_strategy'], 'estimate')
+                    self.assertEqual(r['total_count'], 1)
+                    self.assertEqual(len(r['events']), 1)
+                    self.assertFalse(r['has_next'])
+                    self.assertTrue(r['has_previous'])
+
+    def test_batch_email_sender_reconnects(self):
+        from django.core.mail import get_connection, EmailMessage
+        from utils import BatchEmailSender
+        connection = get_connection('django.core.mail.backends.locmem.EmailBackend')
+        send_messages = connection.send_messages
+        calls = []
+        def failing_send_messages(messages):
+            calls.append(messages)
+            if len(calls) == 1:
+                raise ConnectionError()
+            return send_messages(messages)
+        connection.send_messages = failing_send_messages
+
+        sent = len(mail.outbox)
+        with BatchEmailSender(connection) as email_sender:
+            email_sender.send(EmailMessage('subject', 'body', 'a@a.com', ['b@b.com']))
+            # queued until flushed
+            self.assertEqual(len(mail.outbox), sent)
+        self.assertEqual(len(mail.outbox), sent + 1)
+        self.assertEqual(len(calls), 2)
+
+        # the queued emails are discarded if the with block fails
+        try:
+            with BatchEmailSender(connection) as email_sender:
+                email_sender.send(EmailMessage('subject', 'body', 'a@a.com', ['b@b.com']))
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(len(mail.outbox), sent + 1)
+
+    def test_token_bucket(self):
+        from unittest import mock
+        from django.core.cache import cache
+        from utils import TokenBucket
+        cache.delete('token_bucket:test')
+        now = [1000.0]
+        with mock.patch('utils.time.time', lambda: now[0]):
+            bucket = TokenBucket('test', rate=2, burst=3)
+            # the burst is available at once
+            self.assertEqual([bucket.try_take() for i in range(3)], [0, 0, 0])
+            self.assertEqual(bucket.try_take(), 0.5)
+
+            # and then it's refilled at the given rate
+            now[0] += 0.5
+            self.assertEqual(bucket.try_take(), 0)
+            self.assertEqual(bucket.try_take(), 0.5)
+            now[0] += 10
+            self.assertEqual([bucket.try_take() for i in range(4)], [0, 0, 0, 0.5])
+
+        # the limits can't be kept in a cache of each process
+        with override_settings(
+            LOCAL_CACHE_BACKENDS=['django.core.cache.backends.locmem.LocMemCache']
+        ):
+            from django.core.exceptions import ImproperlyConfigured
+            with self.assertRaises(ImproperlyConfigured):
+                TokenBucket('test', rate=2, burst=3)
+
+    def test_batch_email_sender_rate_limit(self):
+        from unittest import mock
+        from django.core.mail import get_connection, EmailMessage
+        from utils import BatchEmailSender
+        connection = get_connection('django.core.mail.backends.locmem.EmailBackend')
+        sent = len(mail.outbox)
+        tokens = []
+        def take_message_token(provider, auth_event_id=None):
+            tokens.append((provider, auth_event_id, len(mail.outbox) - sent))
+        with mock.patch('utils.take_message_token', take_message_token):
+            with BatchEmailSender(connection) as email_sender:
+                for i in range(2):
+                    email_sender.send(
+                        EmailMessage('subject', 'body', 'a@a.com', ['b@b.com']),
+                        self.aeid
+                    )
+                # the tokens are taken when sending, not when queueing
+                self.assertEqual(tokens, [])
+        self.assertEqual(tokens, [('email', self.aeid, 0), ('email', self.aeid, 1)])
+
+    @override_settings(RATE_LIMIT_COUNTER_CACHE='default')
+    def test_sliding_window_counter(self):
+        from unittest import mock
+        from django.core.cache import cache
+        from authmethods.models import Message
+        from authmethods.utils import count_message, get_message_counter
+        cache.clear()
+        tlf = '+34666666666'
+        for i in range(2):
+            Message(ip='127.0.0.1', tlf=tlf, auth_event_id=self.aeid).save()
+
+        start = (int(time.time()) // 60) * 60
+        now = [start]
+        with mock.patch('utils.time.time', lambda: now[0]):
+            counter = get_message_counter(self.aeid, 'tlf', tlf)
+            # messages sent before the counters existed are counted from the
+            # database
+            self.assertEqual(counter.count(3600), 2)
+            self.assertEqual(counter.count(), 2)
+
+            now[0] += 30
+            for i in range(3):
+                message = Message(ip='127.0.0.1', tlf=tlf, auth_event_id=self.aeid)
+                message.save()
+                count_message(message)
+            self.assertEqual(counter.count(), 5)
+            self.assertEqual(counter.count(3600), 5)
+
+            # the window is then taken from the counters, weighting the part
+            # of the oldest bucket within it
+            now[0] = start + 3600
+            self.assertEqual(counter.count(3600), 3)
+            now[0] = start + 3630
+            self.assertEqual(counter.count(3600), 1.5)
+            self.assertEqual(counter.count(2 * 3600), 5)
+
+        # the counters are not kept in a cache of each process
+        with override_settings(
+            LOCAL_CACHE_BACKENDS=['django.core.cache.backends.locmem.LocMemCache']
+        ):
+            counter = get_message_counter(self.aeid, 'tlf', tlf)
+            self.assertEqual(counter.cache, None)
+            self.assertEqual(counter.count(), 5)
+
+    def test_cursor_pagination(self):
+        c = JClient()
+        response = c.authenticate(self.aeid_special, self.admin_auth_data)
+        self.assertEqual(response.status_code, 200)
+
+        response = c.get('/api/acl/mine/', {'cursor': '', 'n': 3, 'count': 'true'})
+        self.assertEqual(response.status_code, 200)
+        r = parse_json_response(response)
+        self.assertEqual(len(r['perms']), 3)
+        self.assertEqual(r['total_count'], 7)
+        self.assertTrue(r['has_next'])
+        perms = r['perms']
+
+        response = c.get('/api/acl/mine/', {'cursor': r['next_cursor'], 'n': 3})
+        self.assertEqual(response.status_code, 200)
+        r = parse_json_response(response)
+        self.assertEqual(len(r['perms']), 3)
+        self.assertTrue('total_count' not in r)
+        perms += r['perms']
+
+        response = c.get('/api/acl/mine/', {'cursor': r['next_cursor'], 'n': 3})
+        self.assertEqual(response.status_code, 200)
+        r = parse_json_response(response)
+        self.assertEqual(len(r['perms']), 1)
+        self.assertFalse(r['has_next'])
+        self.assertEqual(r['next_cursor'], None)
+        perms += r['perms']
+
+        response = c.get('/api/acl/mine/', {'n': 10})
+        r = parse_json_response(response)
+        self.assertEqual(
+            sorted(json.dumps(perm, sort_keys=True) for perm in perms),
+            sorted(json.dumps(perm, sort_keys=True) for perm in r['perms']))
+
+    def test_cursor_pagination_invalid_cursor(self):
+        from utils import encode_cursor
+        c = JClient()
+        response = c.authenticate(self.aeid_special, self.admin_auth_data)
+        self.assertEqual(response.status_code, 200)
+
+        # malformed or tampered cursors don't restart from the first page
+        for cursor in ['not-a-cursor', encode_cursor('abc'), encode_cursor([1])]:
+            response = c.get('/api/acl/mine/', {'cursor': cursor, 'n': 3})
+            self.assertEqual(response.status_code, 400)
+            r = parse_json_response(response)
+            self.assertEqual(r['error_codename'], 'invalid_cursor')
+
     def test_get_user_info(self):
         c = JClient()
         response = c.authenticate(self.aeid_special, self.admin_auth_data)
@@ -1198,6 +1500,158 @@ class TestRegisterAndAuthenticateEmail(TestCase):
         r = parse_json_response(response)
         self.assertEqual(len(r['object_list']), 4)
 
+    def test_census_filter(self):
+        c = JClient()
+        c.authenticate(self.aeid, test_data.auth_email_default)
+        response = c.census(self.aeid, test_data.census_email_fields)
+        self.assertEqual(response.status_code, 200)
+
+        url = '/api/auth-event/%d/census/' % self.aeid
+        for filter_str, emails in [
+            ('CAAA@', ['caaa@aaa.com']),
+            ('daaa', ['daaa@aaa.com', 'eaaa@aaa.com']),
+            ('aaaa', ['baaa@aaa.com']),
+            ('nobody', [])
+        ]:
+            response = c.get(url, {'filter': filter_str})
+            self.assertEqual(response.status_code, 200)
+            r = parse_json_response(response)
+            self.assertEqual(
+                sorted(element['metadata']['email'] for element in r['object_list']),
+                emails)
+
+        # the search text is updated when the user changes
+        user = User.objects.get(email='baaa@aaa.com')
+        user.email = 'zzzz@aaa.com'
+        user.save()
+        response = c.get(url, {'filter': 'zzzz'})
+        r = parse_json_response(response)
+        self.assertEqual(len(r['object_list']), 1)
+
+    def test_census_has_voted_filter(self):
+        c = JClient()
+        c.authenticate(self.aeid, test_data.auth_email_default)
+        response = c.census(self.aeid, test_data.census_email_fields)
+        self.assertEqual(response.status_code, 200)
+
+        voter = User.objects.get(email='baaa@aaa.com')
+        SuccessfulLogin(user=voter.userdata, auth_event=self.ae).save()
+        other = User.objects.get(email='caaa@aaa.com')
+        SuccessfulLogin(
+            user=other.userdata, auth_event=self.ae, is_active=False).save()
+
+        url = '/api/auth-event/%d/census/' % self.aeid
+        response = c.get(url, {'has_voted__equals': 'true'})
+        self.assertEqual(response.status_code, 200)
+        r = parse_json_response(response)
+        self.assertEqual(
+            [element['metadata']['email'] for element in r['object_list']],
+            ['baaa@aaa.com'])
+        self.assertEqual(r['object_list'][0]['voted_children_elections'], [self.aeid])
+
+        response = c.get(url, {'has_voted__equals': 'false'})
+        r = parse_json_response(response)
+        emails = [element['metadata']['email'] for element in r['object_list']]
+        self.assertNotIn('baaa@aaa.com', emails)
+        self.assertIn('caaa@aaa.com', emails)
+
+    def test_census_list_num_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        c = JClient()
+        c.authenticate(self.aeid, test_data.auth_email_default)
+        response = c.census(self.aeid, test_data.census_email_default1)
+        self.assertEqual(response.status_code, 200)
+
+        url = '/api/auth-event/%d/census/' % self.aeid
+        with CaptureQueriesContext(connection) as one_voter_queries:
+            response = c.get(url, {})
+        self.assertEqual(response.status_code, 200)
+
+        census = {
+            "field-validation": "enabled",
+            "census": [{"email": "voter%d@aaa.com" % i} for i in range(20)]
+        }
+        response = c.census(self.aeid, census)
+        self.assertEqual(response.status_code, 200)
+        voter = User.objects.get(email='voter0@aaa.com')
+        SuccessfulLogin(user=voter.userdata, auth_event=self.ae).save()
+
+        # the number of queries doesn't depend on the page size
+        with CaptureQueriesContext(connection) as many_voters_queries:
+            response = c.get(url, {'n': 50})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(many_voters_queries), len(one_voter_queries))
+
+        r = parse_json_response(response)
+        self.assertEqual(len(r['object_list']), 21)
+        voted = dict(
+            (element['username'], element['voted_children_elections'])
+            for element in r['object_list']
+        )
+        self.assertEqual(voted[voter.username], [self.aeid])
+
+    @override_settings(CENSUS_EXPORT_BATCH_SIZE=3)
+    def test_census_export(self):
+        c = JClient()
+        c.authenticate(self.aeid, test_data.auth_email_default)
+        response = c.census(self.aeid, test_data.census_email_default)
+        self.assertEqual(response.status_code, 200)
+
+        response = c.get('/api/auth-event/%d/census/export/' % self.aeid, {})
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        elements = [json.loads(line) for line in lines]
+        self.assertEqual(
+            sorted(element['metadata']['email'] for element in elements),
+            sorted(voter['email'] for voter in test_data.census_email_default['census']))
+        self.assertEqual(elements[0]['voted_children_elections'], [])
+
+        response = c.get(
+            '/api/auth-event/%d/census/export/' % self.aeid,
+            {'format': 'csv', 'filter': 'baaa'})
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('id,username,active,date_joined,email,tlf'))
+        self.assertTrue('baaa@aaa.com' in lines[1])
+
+        response = c.get(
+            '/api/auth-event/%d/census/export/' % self.aeid, {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(CENSUS_BULK_CHUNK_SIZE=7)
+    def test_add_census_authevent_email_bulk(self):
+        c = JClient()
+        c.authenticate(self.aeid, test_data.auth_email_default)
+        census = {
+            "field-validation": "disabled",
+            "census": [{"email": "bulk%d@aaa.com" % i} for i in range(30)] + [
+                # repeated in the census and already existing
+                {"email": "bulk0@aaa.com"},
+                {"email": test_data.auth_email_default['email']}
+            ]
+        }
+        response = c.census(self.aeid, census)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(User.objects.filter(userdata__event=self.aeid).count(), 32)
+
+        users = User.objects.filter(email__startswith='bulk', is_active=True)
+        self.assertEqual(users.count(), 30)
+        self.assertEqual(
+            ACL.objects.filter(
+                user__user__in=users,
+                object_type='AuthEvent',
+                perm='vote',
+                object_id=str(self.aeid)).count(),
+            30)
+        self.assertEqual(
+            Action.objects.filter(
+                receiver__in=users,
+                executer=self.uid,
+                action_name='user:added-to-census').count(),
+            30)
+
     def test_add_census_authevent_email_fields(self):
         c = JClient()
         c.authenticate(self.aeid, test_data.auth_email_default)
@@ -1228,6 +1682,23 @@ class TestRegisterAndAuthenticateEmail(TestCase):
         r = parse_json_response(response)
         self.assertEqual(r['error_codename'], 'invalid_credentials')
 
+    def test_census_duplicates(self):
+        from authmethods.utils import check_census_duplicates
+        census = [{"email": "new%d@aaa.com" % i} for i in range(100)]
+        with self.assertNumQueries(1):
+            self.assertEqual(check_census_duplicates(census, self.ae, ['email']), '')
+
+        census += [
+            {"email": "new0@aaa.com"},
+            {"email": test_data.auth_email_default['email']}
+        ]
+        with self.assertNumQueries(1):
+            msg = check_census_duplicates(census, self.ae, ['email'])
+        self.assertEqual(
+            msg,
+            "Email new0@aaa.com repeat in this census." +
+            "Email %s repeat." % test_data.auth_email_default['email'])
+
     def test_add_census_authevent_email_with_spaces(self):
         c = JClient()
         c.authenticate(self.aeid, test_data.auth_email_default)
@@ -1352,6 +1823,217 @@ class TestRegisterAndAuthenticateEmail(TestCase):
         response = c.post('/api/auth-event/%d/census/send_auth/' % self.aeid, incorrect_tpl)
         self.assertEqual(response.status_code, 400)
 
+    @override_settings(SEND_CODES_CHUNK_SIZE=3, **override_celery_data)
+    def test_send_auth_email_chunks(self):
+        from django.core.management import call_command
+        from .models import SendCodesChunk
+        self.test_add_census_authevent_email_default() # Add census
+
+        c = JClient()
+        response = c.authenticate(self.aeid, test_data.auth_email_default)
+        response = c.post('/api/auth-event/%d/census/send_auth/' % self.aeid, {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(MsgLog.objects.count(), 4)
+        chunks = SendCodesChunk.objects.order_by('id')
+        self.assertEqual(
+            [(len(chunk.users), chunk.sent, chunk.status) for chunk in chunks],
+            [(3, 3, 'done'), (1, 1, 'done')]
+        )
+
+        # a failed chunk is resumed from the first user not sent
+        users = chunks[0].users + chunks[1].users
+        chunk = SendCodesChunk(
+            batch='failed',
+            auth_event=self.ae,
+            ip='127.0.0.1',
+            auth_method='email',
+            users=users,
+            sent=3,
+            status='failed'
+        )
+        chunk.save()
+        call_command('resume_send_codes', batch='failed')
+        self.assertEqual(MsgLog.objects.count(), 5)
+        chunk.refresh_from_db()
+        self.assertEqual((chunk.sent, chunk.status), (4, 'done'))
+
+    @override_settings(SEND_CODES_BATCH_SIZE=3, **override_celery_data)
+    def test_send_auth_codes_batch(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from utils import send_codes_chunk, format_code
+        from .models import SendCodesChunk
+        self.test_add_census_authevent_email_default() # Add census
+
+        users = list(
+            self.ae.get_census_query()\
+                .order_by('id')\
+                .values_list('user__user_id', flat=True)
+        )
+        chunk = SendCodesChunk(
+            batch='codes',
+            auth_event=self.ae,
+            ip='127.0.0.1',
+            auth_method='email',
+            users=users
+        )
+        chunk.save()
+        num_codes = Code.objects.count()
+        with CaptureQueriesContext(connection) as queries:
+            send_codes_chunk(chunk.id)
+
+        # 4 codes generated in batches of 3
+        code_inserts = [
+            query for query in queries.captured_queries
+            if query['sql'].startswith('INSERT INTO "authmethods_code"')
+        ]
+        self.assertEqual(len(code_inserts), 2)
+        self.assertEqual(Code.objects.count(), num_codes + 4)
+        for user in User.objects.filter(pk__in=users):
+            code = Code.objects\
+                .filter(user=user.userdata)\
+                .order_by('-created')\
+                .first()
+            msg_log = MsgLog.objects.filter(receiver=user.email).last()
+            self.assertTrue(format_code(code.code) in msg_log.msg['msg'])
+
+    @override_settings(
+        SEND_CODES_CHUNK_SIZE=3,
+        LOCAL_CACHE_BACKENDS=[
+            'django.core.cache.backends.locmem.LocMemCache',
+            'django.core.cache.backends.dummy.DummyCache',
+        ],
+        **override_celery_data
+    )
+    def test_send_auth_plugin_delay_local(self):
+        from unittest import mock
+        import plugins
+        from .models import SendCodesChunk
+        self.test_add_census_authevent_email_default() # Add census
+
+        # without a shared cache, the delay of the plugins is waited between
+        # the codes of a single chunk
+        plugins_call = plugins.call
+        def call(name, *args, **kwargs):
+            if name == 'extend_send_codes':
+                return [0.01]
+            return plugins_call(name, *args, **kwargs)
+        c = JClient()
+        response = c.authenticate(self.aeid, test_data.auth_email_default)
+        with mock.patch('utils.plugins.call', call):
+            with mock.patch('utils.sleep') as sleep:
+                response = c.post('/api/auth-event/%d/census/send_auth/' % self.aeid, {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(MsgLog.objects.count(), 4)
+        chunks = SendCodesChunk.objects.order_by('id')
+        self.assertEqual(
+            [(len(chunk.users), chunk.sent, chunk.status) for chunk in chunks],
+            [(4, 4, 'done')]
+        )
+        self.assertTrue(sleep.called)
+
+    @override_settings(**override_celery_data)
+    def test_send_auth_chunk_sms_progress(self):
+        from unittest import mock
+        from utils import send_codes_chunk
+        from .models import SendCodesChunk, UserData
+        self.test_add_census_authevent_email_default() # Add census
+        UserData.objects.filter(event=self.ae).update(tlf='+34666666666')
+
+        users = list(
+            self.ae.get_census_query()\
+                .order_by('id')\
+                .values_list('user__user_id', flat=True)
+        )
+        chunk = SendCodesChunk(
+            batch='sms',
+            auth_event=self.ae,
+            ip='127.0.0.1',
+            auth_method='email',
+            users=users
+        )
+        chunk.save()
+
+        # the emails of each user are not left queued once its SMS is sent
+        sent = len(mail.outbox)
+        sms_outbox = []
+        def send_sms_code(receiver, msg):
+            sms_outbox.append(len(mail.outbox) - sent)
+        with mock.patch('utils.send_sms_code', send_sms_code):
+            send_codes_chunk(chunk.id)
+        self.assertEqual(sms_outbox, [0, 1, 2, 3])
+        self.assertEqual(len(mail.outbox), sent + 4)
+
+    @override_settings(
+        AUTHMETHODS_RETENTION_BATCH_SIZE=2,
+        AUTHMETHODS_RETENTION={
+            'Code': {'days': None, 'finished_days': 30},
+            'Message': {'days': 30, 'finished_days': 30},
+            'MsgLog': {'days': None, 'finished_days': 30},
+            'Connection': {'days': 30, 'finished_days': 30},
+        }
+    )
+    def test_prune_authmethods_tables(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from authmethods.models import Connection, Message
+        from .models import Action
+        from .tasks import prune_authmethods_tables
+
+        # a stopped election with a child, stopped 40 days ago
+        old = timezone.now() - timedelta(days=40)
+        stopped_ae = AuthEvent(
+            auth_method="email",
+            auth_method_config=test_data.authmethod_config_email_default,
+            status='stopped')
+        stopped_ae.save()
+        child_ae = AuthEvent(
+            auth_method="email",
+            auth_method_config=test_data.authmethod_config_email_default,
+            status='stopped',
+            parent=stopped_ae)
+        child_ae.save()
+        Action(action_name='authevent:stop', event=stopped_ae, created=old).save()
+
+        for event_id in [self.aeid, stopped_ae.id, child_ae.id]:
+            Code(user=self.u, code='AAAAAAAA', auth_event_id=event_id).save()
+            for i in range(3):
+                Message(ip='127.0.0.1', tlf='+34666666666', auth_event_id=event_id).save()
+                MsgLog(authevent_id=event_id, receiver='a@a.com', msg=dict()).save()
+                Connection(ip='127.0.0.1', tlf='+34666666666', auth_event_id=event_id).save()
+        for model, event_field in [(Message, 'auth_event_id'), (MsgLog, 'authevent_id')]:
+            old_ids = model.objects\
+                .filter(**{event_field: self.aeid})\
+                .values_list('id', flat=True)[:2]
+            model.objects.filter(id__in=list(old_ids)).update(created=old)
+
+        # nothing is deleted by default
+        with override_settings(AUTHMETHODS_RETENTION=dict(
+                (model, dict(days=None, finished_days=None))
+                for model in ['Code', 'Message', 'MsgLog', 'Connection'])):
+            self.assertEqual(
+                prune_authmethods_tables(),
+                dict(Code=0, Message=0, MsgLog=0, Connection=0)
+            )
+
+        # only the old messages of the running election are deleted, while
+        # everything is deleted for the stopped ones
+        report = prune_authmethods_tables()
+        self.assertEqual(
+            report,
+            dict(Code=2, Message=2 + 6, MsgLog=6, Connection=6)
+        )
+        self.assertEqual(Message.objects.filter(auth_event_id=self.aeid).count(), 1)
+        self.assertEqual(MsgLog.objects.filter(authevent_id=self.aeid).count(), 3)
+        self.assertEqual(Connection.objects.filter(auth_event_id=self.aeid).count(), 3)
+        self.assertEqual(Code.objects.filter(auth_event_id=self.aeid).count(), 1)
+
+        # the election is not finished for long enough
+        with override_settings(AUTHMETHODS_RETENTION=dict(
+                Message=dict(days=None, finished_days=60))):
+            Message(ip='127.0.0.1', tlf='+34666666666', auth_event_id=stopped_ae.id).save()
+            self.assertEqual(prune_authmethods_tables()['Message'], 0)
+
     @override_settings(**override_celery_data)
     def test_send_auth_email_url2_home_url(self):
         # Add census
@@ -2263,6 +2945,47 @@ class TestVoteStats(TestCase):
                 ]
             })
         )
+
+
+    def test_vote_stats_incremental(self):
+        from django.utils import timezone
+        from .models import register_vote
+        auth_event = AuthEvent.objects.get(pk=self.auth_event_id)
+        # the counters are created from the previous votes
+        self.assertEqual(auth_event.get_num_votes(), 12)
+
+        # a revote moves the voter to the hour of the new vote
+        date = timezone.make_aware(datetime(2010, 10, 10, 4, 10, 0, 0))
+        user = User(username='user12', email='user12@aaa.com')
+        user.save()
+        user.userdata.event = auth_event
+        user.userdata.save()
+        for userdata in [self.users[0].userdata, user.userdata]:
+            vote = SuccessfulLogin(
+                created=date,
+                user=userdata,
+                auth_event=auth_event
+            )
+            vote.save()
+            register_vote(vote)
+
+        self.assertEqual(auth_event.get_num_votes(), 13)
+        self.assertEqual(
+            [
+                (str(hour), votes)
+                for hour, votes in auth_event.get_votes_per_hour()
+            ],
+            [
+                ("2010-10-10 01:00:00+00:00", 3),
+                ("2010-10-10 02:00:00+00:00", 3),
+                ("2010-10-10 03:00:00+00:00", 5),
+                ("2010-10-10 04:00:00+00:00", 2)
+            ]
+        )
+        self.assertEqual(
+            auth_event.get_votes_per_hour(),
+            auth_event.count_votes_per_hour()
+        )
             
 
 # Check the allowed number of revotes, using AuthEvent's
@@ -2390,6 +3113,48 @@ class TestRevotes(TestCase):
         response = c.authenticate(self.aeid, test_data.auth_email_default1)
         self.assertEqual(response.status_code, 400)
 
+    def test_vote_count(self):
+        from unittest import mock
+        from django.core.management import call_command
+        from .models import VoteCount
+        c = JClient()
+        c.authenticate(self.aeid, test_data.auth_email_default)
+        response = c.census(self.aeid, test_data.census_email_default1)
+        self.assertEqual(response.status_code, 200)
+        cuser = User.objects.get(email=test_data.auth_email_default1['email'])
+        self.assertEqual(self.ae.get_num_votes(), 0)
+        self.assertEqual(VoteCount.objects.get(auth_event=self.ae).total_votes, 0)
+
+        # voting twice counts once
+        for i in range(2):
+            auth_token = self.genhmac(settings.SHARED_SECRET, "%s:AuthEvent:%d:RegisterSuccessfulLogin" % (cuser.username, self.aeid))
+            c.set_auth_token(auth_token)
+            response = c.post('/api/auth-event/%d/successful_login/%s' % (self.aeid, cuser.username), {})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.ae.get_num_votes(), 1)
+
+        # votes committed while the counter is being created are counted
+        # again once it's visible
+        VoteCount.objects.filter(auth_event=self.ae).delete()
+        with mock.patch.object(
+            AuthEvent,
+            'count_num_votes',
+            side_effect=[0, 1]
+        ):
+            self.assertEqual(self.ae.init_vote_counts().total_votes, 1)
+        self.assertEqual(self.ae.get_num_votes(), 1)
+
+        # drifted counters are fixed by the reconcile command
+        VoteCount.objects.filter(auth_event=self.ae).update(total_votes=5)
+        call_command('reconcile_vote_counts', str(self.aeid))
+        self.assertEqual(self.ae.get_num_votes(), 1)
+
+        # deleting the voter resets the counter
+        c.authenticate(self.aeid, test_data.auth_email_default)
+        response = c.post('/api/auth-event/%d/census/delete/' % self.aeid, {'user-ids': [cuser.id]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.ae.get_num_votes(), 0)
+
 class TestAdminFields(TestCase):
     def setUpTestData():
         flush_db_load_fixture()
@@ -4747,3 +5512,111 @@ class TestAuthEventList(TestCase):
         self.assertEqual(response.status_code, 200)
         r = parse_json_response(response)
         self.assertEqual(len(r['events']), 1)
+
+    @override_settings(AUTH_EVENT_CACHE='default')
+    def test_cached_public_data(self):
+        from django.core.cache import caches
+        from api.models import get_auth_event_cache, get_auth_event_version
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        caches['default'].clear()
+        client = Client()
+        url = '/api/auth-event/%d/' % self.ae2.id
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(parse_json_response(response)['events']['users'], 0)
+        etag = response['ETag']
+
+        # cached, and revalidated with the ETag
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['ETag'], etag)
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries.captured_queries), 0)
+
+        # changes in the census of the parent election invalidate it
+        voter = User(username='voter', email='voter@aaa.com')
+        voter.save()
+        voter.userdata.event = self.ae
+        voter.userdata.children_event_id_list = [self.ae2.id]
+        voter.userdata.save()
+        ACL(user=voter.userdata, object_type='AuthEvent', perm='vote',
+            object_id=self.ae.id).save()
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(parse_json_response(response)['events']['users'], 1)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # and so do changes in the children elections of its voters
+        voter.userdata.children_event_id_list = []
+        voter.userdata.save()
+        response = client.get(url)
+        self.assertEqual(parse_json_response(response)['events']['users'], 0)
+
+        # changes in the census of a child election invalidate its parent
+        cache = get_auth_event_cache()
+        parent_version = get_auth_event_version(cache, self.ae.id)
+        ACL(user=voter.userdata, object_type='AuthEvent', perm='vote',
+            object_id=self.ae2.id).save()
+        self.assertNotEqual(
+            get_auth_event_version(cache, self.ae.id),
+            parent_version
+        )
+
+        # and so do changes in the auth event
+        self.ae2.census = 'open'
+        self.ae2.save()
+        response = client.get(url)
+        self.assertEqual(parse_json_response(response)['events']['census'], 'open')
+
+    def test_list_serialization(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        voter = User(username='voter', email='voter@aaa.com')
+        voter.save()
+        voter.userdata.event = self.ae
+        voter.userdata.children_event_id_list = [self.ae2.id]
+        voter.userdata.save()
+        ACL(user=voter.userdata, object_type='AuthEvent', perm='vote',
+            object_id=self.ae.id).save()
+        Code(user=voter.userdata, code='AAAA', auth_event_id=self.aeid).save()
+        SuccessfulLogin(user=voter.userdata, auth_event=self.ae2).save()
+        self.ae.get_num_votes()
+        self.ae2.get_num_votes()
+
+        client = JClient()
+        response = client.authenticate(self.aeid_special, self.admin_auth_data)
+        self.assertEqual(response.status_code, 200)
+        url = '/api/auth-event/?has_perms=edit|view'
+        with CaptureQueriesContext(connection) as two_events_queries:
+            response = client.get(url, {})
+        self.assertEqual(response.status_code, 200)
+        r = parse_json_response(response)
+        self.assertEqual(len(r['events']), 2)
+        for event in r['events']:
+            ae = AuthEvent.objects.get(pk=event['id'])
+            self.assertEqual(
+                event,
+                json.loads(json.dumps(ae.serialize()))
+            )
+
+        # the number of queries doesn't depend on the number of events
+        for i in range(5):
+            ae = AuthEvent(
+                auth_method=test_data.auth_event4['auth_method'],
+                auth_method_config=test_data.authmethod_config_email_default
+            )
+            ae.save()
+            ACL(user=self.testuser.userdata, object_type='AuthEvent',
+                perm='view', object_id=ae.id).save()
+            ae.get_num_votes()
+        with CaptureQueriesContext(connection) as seven_events_queries:
+            response = client.get(url, {})
+        r = parse_json_response(response)
+        self.assertEqual(len(r['events']), 7)
+        self.assertEqual(
+            len(seven_events_queries.captured_queries),
+            len(two_events_queries.captured_queries)
+        )
@@ -38,6 +38,7 @@ urlpatterns = [
     url(r'^auth-event/(?P<pk>\d+)/vote-stats/$', views.vote_stats, name='vote_stats'),
     url(r'^auth-event/(?P<pk>\d+)/activity/$', views.activity, name='activity'),
     url(r'^auth-event/(?P<pk>\d+)/census/$', views.census, name='census'),
+    url(r'^auth-event/(?P<pk>\d+)/census/export/$', views.census_export, name='census_export'),
     url(r'^auth-event/(?P<pk>\d+)/census/delete/$', views.census_delete, name='census_delete'),
     url(r'^auth-event/(?P<pk>\d+)/census/activate/$', views.census_activate, name='census_activate'),
     url(r'^auth-event/(?P<pk>\d+)/census/deactivate/$', views.census_deactivate, name='census_deactivate'),
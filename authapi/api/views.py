@@ -15,6 +15,7 @@
 
 # This file contains all the API views
 import os
+import csv
 import json
 import requests
 import mimetypes
@@ -22,15 +23,16 @@ from datetime import datetime
 from django import forms
 from django.conf import settings
 from django.http import Http404
+from django.db import transaction
 from django.db.models import Q, IntegerField
-from django.db.models.functions import TruncHour, Cast
+from django.db.models.functions import Cast
 from django.contrib.auth.models import User
 from django.views.generic import View
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from base64 import encodestring
 from django.utils.text import slugify
-from django.db.models import Count, OuterRef, Subquery
+from django.db.models import Count, Exists, OuterRef, Subquery
 
 import plugins
 from authmethods import (
@@ -49,6 +51,7 @@ from utils import (
     check_pipeline,
     genhmac,
     HMACToken,
+    InvalidCursor,
     json_response,
     paginate,
     permission_required,
@@ -72,7 +75,12 @@ from .models import (
     UserData,
     BallotBox,
     TallySheet,
-    children_election_info_validator
+    children_election_info_validator,
+    get_auth_events_stats,
+    get_serialized_restrict,
+    get_voted_elections,
+    get_voted_logins_q,
+    register_vote
 )
 from .tasks import (
     census_send_auth_task,
@@ -318,6 +326,10 @@ class CensusDelete(View):
             for acl in u.userdata.acls.all():
                 acl.delete()
             u.delete()
+
+        # the successful logins of the deleted users are gone too
+        if user_ids:
+            ae.reset_vote_counts()
         return json_response()
 census_delete = login_required(CensusDelete.as_view())
 
@@ -397,6 +409,70 @@ class CensusDeactivate(CensusActivate):
 census_deactivate = login_required(CensusDeactivate.as_view())
 
 
+def filter_census_query(request, auth_event):
+    '''
+    Returns the census query of the auth event, filtered and ordered with the
+    request params used by the census listing
+    '''
+    filter_str = request.GET.get('filter', None)
+    query = auth_event.get_census_query()
+
+    if filter_str is not None:
+        # uses the trigram index of the search text
+        query = query.filter(user__search_text__contains=filter_str.lower())
+
+    has_voted_str = request.GET.get('has_voted__equals', None)
+    if has_voted_str in ['true', 'false']:
+        # correlated subquery served by the api_successfullogin_voted index,
+        # instead of grouping the whole census to count the logins
+        voted_logins = SuccessfulLogin.objects.filter(
+            get_voted_logins_q(auth_event),
+            user_id=OuterRef('user_id')
+        )
+        query = query\
+            .annotate(has_voted=Exists(voted_logins))\
+            .filter(has_voted=('true' == has_voted_str))
+
+    # filter, with constraints
+    query = filter_query(
+        filters=request.GET,
+        query=query,
+        constraints=dict(
+            filters=dict(
+                user__user__id=dict(
+                    lt=int,
+                    gt=int,
+                ),
+                user__user__is_active=dict(
+                    equals=bool
+                ),
+                user__user__date_joined=dict(
+                    lt=datetime,
+                    gt=datetime
+                )
+            ),
+            order_by=[
+                'user__user__id',
+                'user__user__is_active',
+                'user__user__date_joined'
+            ]
+        ),
+        prefix='census__',
+        contraints_policy='ignore_invalid')
+    return query
+
+
+def serialize_census_acl(acl, voted_children_elections):
+    return {
+        "id": acl.user.user.pk,
+        "username": acl.user.user.username,
+        "active": acl.user.user.is_active,
+        "date_joined": acl.user.user.date_joined.isoformat(),
+        "metadata": acl.user.serialize_data(),
+        "voted_children_elections": voted_children_elections
+    }
+
+
 class Census(View):
     '''
     Add census in the auth-event
@@ -422,101 +498,137 @@ class Census(View):
     def get(self, request, pk):
         permission_required(request.user, 'AuthEvent', ['edit', 'view-census'], pk)
         auth_event = get_object_or_404(AuthEvent, pk=pk)
+        query = filter_census_query(request, auth_event)\
+            .select_related('user__user', 'user__event')
 
-        filter_str = request.GET.get('filter', None)
-        query = auth_event.get_census_query()
+        try:
+            acls = paginate(
+              request,
+              query,
+              elements_name='object_list')
+        except InvalidCursor:
+            return json_response(status=400, error_codename="invalid_cursor")
+
+        # the voted elections of the whole page are fetched with one query
+        voted = get_voted_elections(
+            auth_event,
+            set(acl.user_id for acl in acls['object_list'])
+        )
+        acls['object_list'] = [
+            serialize_census_acl(acl, voted[acl.user_id])
+            for acl in acls['object_list']
+        ]
+        return json_response(acls)
+census = login_required(Census.as_view())
 
-        if filter_str is not None:
-            if len(auth_event.extra_fields):
-                filter_str = "%" + filter_str + "%"
-                raw_sql = '''
-                             SELECT "api_acl"."id", "api_acl"."user_id", "api_acl"."perm",
-                                    "api_acl"."object_type", "api_acl"."object_id", "api_acl"."created",
-                                    "api_userdata"."id", "api_userdata"."user_id",
-                                    "api_userdata"."event_id", "api_userdata"."tlf",
-                                    "api_userdata"."metadata", "api_userdata"."status"
-                            FROM "api_acl"
-                            INNER JOIN "api_userdata"
-                            ON ("api_acl"."user_id" = "api_userdata"."id")
-                            INNER JOIN "auth_user"
-                            ON ("api_userdata"."user_id" = "auth_user"."id")
-                            WHERE
-                                ("api_acl"."object_id"::int = %s
-                                AND "api_acl"."perm" = 'vote'
-                                AND "api_acl"."object_type" = 'AuthEvent'
-                                AND (UPPER("auth_user"."username"::text) LIKE UPPER(%s)
-                                OR UPPER("auth_user"."email"::text) LIKE UPPER(%s)
-                                OR UPPER("api_userdata"."tlf"::text) LIKE UPPER(%s)'''
-                params_array = [pk, filter_str, filter_str, filter_str]
-                for field in auth_event.extra_fields:
-                    raw_sql += '''
-                                OR UPPER(api_userdata.metadata::jsonb->>%s) LIKE UPPER(%s)'''
-                    params_array += [field['name'], filter_str]
-                raw_sql += '''
-                                ))'''
-                raw_query = ACL.objects.raw(raw_sql, params=params_array)
-                id_list = [obj.id for obj in raw_query]
-                query = query.filter(id__in=id_list)
 
-            else:
-                q = (
-                    Q(user__user__username__icontains=filter_str) |
-                    Q(user__user__email__icontains=filter_str) |
-                    Q(user__tlf__icontains=filter_str)
-                )
-                query = query.filter(q)
+def iter_census(query, auth_event):
+    '''
+    Yields the serialized census elements of the query, fetching them in
+    batches of settings.CENSUS_EXPORT_BATCH_SIZE with keyset pagination over
+    the ACL id, instead of using offsets.
+    '''
+    query = query\
+        .select_related('user__user', 'user__event')\
+        .order_by('id')
+    last_id = 0
+    while True:
+        batch = list(
+            query.filter(id__gt=last_id)[:settings.CENSUS_EXPORT_BATCH_SIZE]
+        )
+        if not batch:
+            return
 
-        has_voted_str = request.GET.get('has_voted__equals', None)
-        if has_voted_str is not None:
-            if 'false' == has_voted_str:
-                query = query.annotate(logins=Count('user__successful_logins')).filter(logins__exact=0)
-            elif 'true' == has_voted_str:
-                query = query.annotate(logins=Count('user__successful_logins')).filter(logins__gt=0)
+        voted = get_voted_elections(
+            auth_event,
+            set(acl.user_id for acl in batch)
+        )
+        for acl in batch:
+            yield serialize_census_acl(acl, voted[acl.user_id])
+        last_id = batch[-1].id
 
-        # filter, with constraints
-        query = filter_query(
-            filters=request.GET,
-            query=query,
-            constraints=dict(
-                filters=dict(
-                    user__user__id=dict(
-                        lt=int,
-                        gt=int,
-                    ),
-                    user__user__is_active=dict(
-                        equals=bool
-                    ),
-                    user__user__date_joined=dict(
-                        lt=datetime,
-                        gt=datetime
-                    )
-                ),
-                order_by=[
-                    'user__user__id',
-                    'user__user__is_active',
-                    'user__user__date_joined'
-                ]
-            ),
-            prefix='census__',
-            contraints_policy='ignore_invalid')
 
-        def serializer(acl):
-          return {
-            "id": acl.user.user.pk,
-            "username": acl.user.user.username,
-            "active": acl.user.user.is_active,
-            "date_joined": acl.user.user.date_joined.isoformat(),
-            "metadata": acl.user.serialize_data(),
-            "voted_children_elections": acl.user.serialize_children_voted_elections(auth_event)
-          }
+class EchoBuffer(object):
+    '''
+    File-like object that returns what is written into it, used to stream
+    the lines written by a csv writer
+    '''
+    def write(self, value):
+        return value
 
-        acls = paginate(
-          request,
-          query,
-          serialize_method=serializer,
-          elements_name='object_list')
-        return json_response(acls)
-census = login_required(Census.as_view())
+
+def census_csv_lines(elements, auth_event):
+    '''
+    Yields the lines of the csv export of the census elements
+    '''
+    metadata_columns = ['email', 'tlf'] + [
+        field['name']
+        for field in auth_event.extra_fields or []
+        if field.get('name') not in ['email', 'tlf']
+    ]
+    writer = csv.writer(EchoBuffer())
+    yield writer.writerow(
+        ['id', 'username', 'active', 'date_joined'] +
+        metadata_columns +
+        ['voted_children_elections']
+    )
+
+    def to_str(value):
+        if value is None:
+            return ''
+        if isinstance(value, str):
+            return value
+        return json.dumps(value)
+
+    for element in elements:
+        metadata = element['metadata']
+        yield writer.writerow(
+            [
+                element['id'],
+                element['username'],
+                element['active'],
+                element['date_joined']
+            ] +
+            [to_str(metadata.get(column)) for column in metadata_columns] +
+            [' '.join(str(i) for i in element['voted_children_elections'])]
+        )
+
+
+class CensusExport(View):
+    '''
+    Streams the census of an auth event as csv or ndjson (one json object per
+    line), using ?format=csv|ndjson. Accepts the same filters as the census
+    listing, and the memory used doesn't grow with the size of the census.
+    '''
+
+    def get(self, request, pk):
+        permission_required(request.user, 'AuthEvent', ['edit', 'view-census'], pk)
+        auth_event = get_object_or_404(AuthEvent, pk=pk)
+
+        export_format = request.GET.get('format', 'ndjson')
+        if export_format not in ['csv', 'ndjson']:
+            return json_response(
+                status=400,
+                error_codename=ErrorCodes.BAD_REQUEST)
+
+        elements = iter_census(
+            filter_census_query(request, auth_event),
+            auth_event
+        )
+        if export_format == 'csv':
+            content = census_csv_lines(elements, auth_event)
+            content_type = 'text/csv'
+        else:
+            content = (json.dumps(element) + '\n' for element in elements)
+            content_type = 'application/x-ndjson'
+
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="census-%d.%s"' % (
+            auth_event.pk,
+            export_format
+        )
+        return response
+census_export = login_required(CensusExport.as_view())
 
 
 class Authenticate(View):
@@ -644,12 +756,16 @@ class SuccessfulLoginView(View):
             khmac_obj.get_other_values() != valid_data):
             return json_response({}, status=403)
 
-        sl = SuccessfulLogin(
-            user=user.userdata, 
-            is_active=user.is_active,
-            auth_event=auth_event
-        )
-        sl.save()
+        with transaction.atomic():
+            # lock the voter so that concurrent logins are counted once
+            UserData.objects.select_for_update().get(pk=user.userdata.pk)
+            sl = SuccessfulLogin(
+                user=user.userdata, 
+                is_active=user.is_active,
+                auth_event=auth_event
+            )
+            sl.save()
+            register_vote(sl)
 
         action = Action(
             executer=user,
@@ -778,36 +894,14 @@ class VoteStatsView(View):
         permission_required(request.user, 'AuthEvent', ['view-stats', 'edit'], pk)
 
         auth_event = AuthEvent.objects.get(pk=pk)
-        if auth_event.children_election_info:
-            parents2 = auth_event.children_election_info['natural_order']
-        else:
-            parents2 = []
-
-        q_base = SuccessfulLogin.objects\
-            .filter(
-                Q(auth_event_id=pk) |
-                Q(auth_event__parent_id=pk) |
-                Q(auth_event__parent_id__in=parents2)
-            )
-        subquery_distinct = q_base\
-            .order_by('user_id', '-created')\
-            .distinct('user_id')
-
-        q = q_base\
-            .annotate(hour=TruncHour('created'))\
-            .values('hour')\
-            .annotate(votes=Count('user_id'))\
-            .order_by('hour')\
-            .filter(id__in=subquery_distinct)
-        
         data = dict(
-            total_votes=subquery_distinct.count(),
+            total_votes=auth_event.get_num_votes(),
             votes_per_hour = [
                 dict(
-                    hour=str(obj['hour']),
-                    votes=obj['votes']
+                    hour=str(hour),
+                    votes=votes
                 )
-                for obj in q
+                for hour, votes in auth_event.get_votes_per_hour()
             ]
         )
 
@@ -1118,9 +1212,12 @@ class ACLMine(View):
 
         query = request.user.userdata.acls.filter(q)
 
-        acls = paginate(request, query,
-                       serialize_method='serialize',
-                       elements_name='perms')
+        try:
+            acls = paginate(request, query,
+                           serialize_method='serialize',
+                           elements_name='perms')
+        except InvalidCursor:
+            return json_response(status=400, error_codename="invalid_cursor")
         data.update(acls)
         return json_response(data)
 aclmine = login_required(ACLMine.as_view())
@@ -1244,11 +1341,15 @@ class Activity(View):
 
         # paginate query and return
         data = {'status': 'ok', 'activity': []}
-        activity_paged = paginate(
-            request,
-            query,
-            serialize_method='serialize',
-            elements_name='activity')
+        try:
+            activity_paged = paginate(
+                request,
+                query,
+                serialize_method='serialize',
+                elements_name='activity',
+                cursor_field='-id')
+        except InvalidCursor:
+            return json_response(status=400, error_codename="invalid_cursor")
         data.update(activity_paged)
         return json_response(data)
 
@@ -1622,22 +1723,37 @@ class AuthEventView(View):
         user, _, _ = get_login_user(request)
 
         if pk:
-            e = AuthEvent.objects.get(pk=pk)
+            etag = None
             if (user is not None and user.is_authenticated and
                 permission_required(
                     user,
                     'AuthEvent',
                     ['edit', 'view', 'view-archived'],
-                    e.id,
+                    int(pk),
                     return_bool=True)):
-                aes = e.serialize()
+                aes = AuthEvent.objects.get(pk=pk).serialize()
             else:
-                aes = e.serialize_restrict()
-
-            extend_info = plugins.call("extend_ae_info", user, e)
-            if extend_info:
-                for info in extend_info:
-                    aes.update(info.serialize())
+                # public data requested by every voter, usually cached
+                aes, etag = get_serialized_restrict(int(pk))
+
+            if settings.PLUGINS:
+                e = AuthEvent.objects.get(pk=pk)
+                extend_info = plugins.call("extend_ae_info", user, e)
+                if extend_info:
+                    # the plugins can extend it differently for each user
+                    etag = None
+                    for info in extend_info:
+                        aes.update(info.serialize())
+
+            if etag is not None:
+                if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+                    response = HttpResponse(status=304)
+                else:
+                    data['events'] = aes
+                    response = json_response(data)
+                response['ETag'] = etag
+                response['Cache-Control'] = 'no-cache'
+                return response
 
             data['events'] = aes
         else:
@@ -1659,7 +1775,7 @@ class AuthEventView(View):
                     Q(parent_id__isnull=False, children_election_info__isnull=False)
                 )
 
-            serialize_method = 'serialize_restrict'
+            restrict = True
             if (
                 user is not None and
                 user.is_authenticated and
@@ -1687,15 +1803,25 @@ class AuthEventView(View):
                         'edit' in perms_split or
                         'view-archived' in perms_split
                     ):
-                        serialize_method = 'serialize'
+                        restrict = False
 
             events = AuthEvent.objects.filter(q)
-            aes = paginate(
-                request, 
-                events,
-                serialize_method=serialize_method,
-                elements_name='events'
-            )
+            try:
+                aes = paginate(
+                    request, 
+                    events,
+                    elements_name='events'
+                )
+            except InvalidCursor:
+                return json_response(
+                    status=400,
+                    error_codename="invalid_cursor")
+            # the stats of the whole page are calculated at once
+            stats = get_auth_events_stats(aes['events'], restrict)
+            aes['events'] = [
+                e.serialize(restrict=restrict, stats=stats[e.id])
+                for e in aes['events']
+            ]
             data.update(aes)
         return json_response(data)
 
@@ -2216,11 +2342,14 @@ class BallotBoxView(View):
             "num_tally_sheets": obj.tally_sheets.count()
           }
 
-        objs = paginate(
-          request,
-          query,
-          serialize_method=serializer,
-          elements_name='object_list')
+        try:
+            objs = paginate(
+              request,
+              query,
+              serialize_method=serializer,
+              elements_name='object_list')
+        except InvalidCursor:
+            return json_response(status=400, error_codename="invalid_cursor")
         return json_response(objs)
 
     def delete(self, request, pk, ballot_box_pk):
@@ -44,6 +44,11 @@ CELERYBEAT_SCHEDULE = {
         'schedule': timedelta(seconds=5),
         'args': []
     },
+    'prune_authmethods_tables': {
+        'task': 'tasks.prune_authmethods_tables',
+        'schedule': timedelta(hours=1),
+        'args': []
+    },
 }
 
 
@@ -147,6 +152,49 @@ DATABASES = {
     }
 }
 
+# Caches
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Cache backends that are not shared between processes (see settings.py).
+# Unlike in production, locmem counts as shared here: the tests run in a
+# single process, so whatever a test invalidates or counts in a locmem cache
+# is seen by all the code it runs.
+LOCAL_CACHE_BACKENDS = [
+    'django.core.cache.backends.dummy.DummyCache',
+]
+
+# Shared cache of the permissions of each user (see settings.py). Disabled in
+# the tests because the flushes and rollbacks done between them don't
+# trigger the invalidation signals.
+ACL_CACHE = None
+ACL_CACHE_TIMEOUT = 3600
+
+# Shared cache of the public data of each auth event (see settings.py).
+# Disabled in the tests for the same reason as ACL_CACHE.
+AUTH_EVENT_CACHE = None
+AUTH_EVENT_CACHE_TIMEOUT = 3600
+
+# Maximum number of verified auth tokens kept in memory by each process, and
+# maximum number of seconds they are kept. Entries never outlive the token
+# expiration (TIMEOUT). Set the size to 0 to disable it.
+HMAC_TOKEN_CACHE_SIZE = 10000
+HMAC_TOKEN_CACHE_TTL = 300
+
+# Shared cache of the versions of the colour lists (see settings.py).
+# Disabled in the tests for the same reason as ACL_CACHE.
+COLOR_LIST_CACHE = None
+COLOR_LIST_INDEX_SIZE = 1000
+
+# Maximum number of auth event pipelines kept compiled in memory by each
+# process. Set it to 0 to compile them in each request.
+COMPILED_PIPELINES_SIZE = 1000
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
@@ -186,6 +234,10 @@ SMS_SENDER_ID = ""
 SMS_SENDER_NUMBER = ""
 SMS_VOICE_LANG_CODE = ""
 
+# Maximum number of sms sent at the same time by SMSProvider.send_many(), and
+# of pooled HTTP connections to the SMS provider
+SMS_MAX_WORKERS = 10
+
 SMS_OTP_EXPIRE_SECONDS = 300
 
 MAX_AUTH_MSG_SIZE = {
@@ -213,6 +265,93 @@ MAX_EXTRA_FIELDS = 15
 MAX_ADMIN_FIELDS = 15
 MAX_SIZE_NAME_EXTRA_FIELD = 1024
 
+# How paginated listings calculate their total count: 'exact', 'cached' (for
+# PAGINATION_COUNT_CACHE_TIMEOUT seconds) or 'estimate' (using the PostgreSQL
+# statistics, only for unfiltered listings of tables with at least
+# PAGINATION_COUNT_ESTIMATE_MIN rows). See utils.get_count().
+PAGINATION_COUNT_STRATEGY = 'exact'
+PAGINATION_COUNT_CACHE_TIMEOUT = 60
+PAGINATION_COUNT_ESTIMATE_MIN = 10000
+
+# Number of census elements inserted and checked per query when adding
+# voters to the census
+CENSUS_BULK_CHUNK_SIZE = 1000
+
+# Number of census elements fetched per query when exporting the census
+CENSUS_EXPORT_BATCH_SIZE = 1000
+
+# Number of users to which each send_codes_chunk task sends the codes. Bigger
+# sends are split in chunks sent in parallel by the celery workers
+SEND_CODES_CHUNK_SIZE = 1000
+
+# Number of codes generated and saved with a single query by each
+# send_codes_chunk task. Batches are generated right before sending their
+# codes, so that the codes of the OTP auth methods don't expire meanwhile
+SEND_CODES_BATCH_SIZE = 100
+
+# Rate limits of the messages sent through each provider ('sms' and 'email'),
+# applied with token buckets shared by all the processes: 'rate' messages per
+# second are allowed, with bursts of up to 'burst' messages. A rate of 0 means
+# no limit. 'per_event' optionally sets the limits for each auth event, which
+# are applied in addition to the global ones.
+MESSAGE_RATE_LIMITS = {
+    'sms': {
+        'rate': 0,
+        'burst': 1,
+        'per_event': {
+            'rate': 0,
+            'burst': 1
+        }
+    },
+    'email': {
+        'rate': 0,
+        'burst': 1,
+        'per_event': {
+            'rate': 0,
+            'burst': 1
+        }
+    }
+}
+
+# Shared cache of the state of the rate limits (see settings.py). The locmem
+# cache is enough, as the tests run in a single process.
+MESSAGE_RATE_LIMIT_CACHE = 'default'
+
+# Shared cache of the sliding window counters of the check_total_max and
+# check_total_connection pipelines (see settings.py). Disabled in the tests
+# because the rows counted are removed by the flushes and rollbacks done
+# between them.
+RATE_LIMIT_COUNTER_CACHE = None
+
+# Number of emails queued by the send_codes tasks before sending them, all
+# through the same connection
+EMAIL_BATCH_SIZE = 100
+
+# Retention policy of the authentication codes (Code), the sent messages
+# (Message and MsgLog) and the connections (Connection), enforced hourly by
+# the prune_authmethods_tables task. For each table, rows older than 'days'
+# days are deleted, and also the rows of the auth events that were stopped
+# more than 'finished_days' days ago. None keeps the rows, so nothing is
+# deleted unless enabled here.
+#
+# Message and Connection rows are counted by the check_total_max and
+# check_total_connection pipelines, so they must be kept for longer than
+# their periods. Those without a period count all the rows, so deleting them
+# turns their lifetime limits into limits over the last 'days' days, and the
+# totals kept in RATE_LIMIT_COUNTER_CACHE only drop to the pruned count once
+# they expire, up to two days later. MsgLog is the only record of the
+# messages sent, and a stopped election that is started again loses its
+# codes.
+AUTHMETHODS_RETENTION = {
+    'Code': {'days': None, 'finished_days': None},
+    'Message': {'days': None, 'finished_days': None},
+    'MsgLog': {'days': None, 'finished_days': None},
+    'Connection': {'days': None, 'finished_days': None},
+}
+
+# Number of rows deleted per query by prune_authmethods_tables
+AUTHMETHODS_RETENTION_BATCH_SIZE = 10000
+
 MAX_IMAGE_SIZE = 5 * 1024 * 1024 # 5 MB
 IMAGE_STORE_PATH = os.path.join(BASE_DIR, 'imgfields')
 
@@ -18,7 +18,7 @@ import logging
 from django.conf import settings
 from django.conf.urls import url
 from django.contrib.auth.models import User
-from utils import genhmac, constant_time_compare, send_codes, get_client_ip, is_valid_url
+from utils import genhmac, constant_time_compare, send_user_code, get_client_ip, is_valid_url
 
 from . import register_method
 from authmethods.utils import *
@@ -44,7 +44,8 @@ class Email:
             'mode': 'vote',
             'mode-config': None,
         },
-        'allow_user_resend': False
+        'allow_user_resend': False,
+        'sync_messages': False
     }
     PIPELINES = {
         'give_perms': [
@@ -278,7 +279,7 @@ class Email:
         validation = req.get('field-validation', 'enabled') == 'enabled'
 
         msg = ''
-        current_emails = []
+        new_census = []
         
         # cannot add voters to an election with invalid children election info
         if auth_event.children_election_info is not None:
@@ -328,12 +329,7 @@ class Email:
                         msg, req, validation, auth_event, stack_trace_str())
                     return self.error("Incorrect data", error_codename="invalid_data")
 
-            if validation:
-                msg += exist_user(census_element, auth_event)
-                if email in current_emails:
-                    msg += "Email %s repeat in this census." % email
-                current_emails.append(email)
-            else:
+            if not validation:
                 if msg:
                     LOGGER.debug(\
                         "EmailOtp.census warning\n"\
@@ -345,13 +341,9 @@ class Email:
                         msg, req, validation, auth_event, stack_trace_str())
                     msg = ''
                     continue
-                exist = exist_user(census_element, auth_event)
-                if exist and not exist.count('None'):
-                    continue
-                # By default we creates the user as active we don't check
-                # the pipeline
-                u = create_user(census_element, auth_event, True, request.user)
-                give_perms(u, auth_event)
+                new_census.append(census_element)
+        if validation:
+            msg += check_census_duplicates(req.get('census'), auth_event, ['email'])
         if msg and validation:
             LOGGER.error(\
                 "EmailOtp.census error\n"\
@@ -364,11 +356,12 @@ class Email:
             return self.error("Incorrect data", error_codename="invalid_credentials")
 
         if validation:
-            for census_element in req.get('census'):
-                # By default we creates the user as active we don't check
-                # the pipeline
-                u = create_user(census_element, auth_event, True, request.user)
-                give_perms(u, auth_event)
+            new_census = req.get('census')
+        else:
+            new_census = exclude_existing_users(new_census, auth_event)
+        # By default we creates the users as active we don't check
+        # the pipeline
+        create_users(new_census, auth_event, True, request.user)
         
         ret = {'status': 'ok'}
         LOGGER.debug(\
@@ -642,7 +635,7 @@ class Email:
             return {'status': 'ok', 'user': u}
 
         response = {'status': 'ok', 'user': u}
-        send_codes.apply_async(args=[[u.id,], get_client_ip(request),'email'])
+        send_user_code(u, get_client_ip(request), 'email')
         LOGGER.info(\
             "EmailOtp.register.\n"\
             "Sending (email) codes to user id '%r'"\
@@ -859,7 +852,7 @@ class Email:
                 msg, auth_event, req, stack_trace_str())
             return self.error("Incorrect data", error_codename="invalid_credentials")
 
-        send_codes.apply_async(args=[[u.id,], get_client_ip(request),'email'])
+        send_user_code(u, get_client_ip(request), 'email')
         LOGGER.info(\
             "EmailOtp.resend_auth_code.\n"\
             "Sending (email) codes to user id '%r'\n"\
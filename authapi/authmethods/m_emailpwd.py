@@ -62,7 +62,7 @@ class EmailPWD:
         validation = req.get('field-validation', 'enabled') == 'enabled'
 
         msg = ''
-        emails = []
+        new_census = []
         for r in req.get('census'):
             email = r.get('email')
             password = r.get('password')
@@ -75,12 +75,7 @@ class EmailPWD:
                 msg += check_field_value(self.password_definition, password)
 
             msg += check_fields_in_request(r, ae, 'census', validation=validation)
-            if validation:
-                msg += exist_user(r, ae)
-                if email in emails:
-                    msg += "Email %s repeat in this census." % email
-                emails.append(email)
-            else:
+            if not validation:
                 if msg:
                     LOGGER.debug(\
                         "EmailPWD.census warning\n"\
@@ -92,13 +87,9 @@ class EmailPWD:
                         msg, req, validation, ae, stack_trace_str())
                     msg = ''
                     continue
-                exist = exist_user(r, ae)
-                if exist and not exist.count('None'):
-                    continue
-                # By default we creates the user as active we don't check
-                # the pipeline
-                u = create_user(r, ae, True, request.user, password=password)
-                give_perms(u, ae)
+                new_census.append(r)
+        if validation:
+            msg += check_census_duplicates(req.get('census'), ae, ['email'])
         if msg and validation:
             LOGGER.error(\
                 "EmailPWD.census error\n"\
@@ -111,11 +102,14 @@ class EmailPWD:
             return self.error("Incorrect data", error_codename="invalid_credentials")
 
         if validation:
-            for r in req.get('census'):
-                # By default we creates the user as active we don't check
-                # the pipeline
-                u = create_user(r, ae, True, request.user, password=password)
-                give_perms(u, ae)
+            new_census = req.get('census')
+        else:
+            new_census = exclude_existing_users(new_census, ae)
+        # By default we creates the users as active we don't check
+        # the pipeline
+        create_users(
+            new_census, ae, True, request.user,
+            password_field='password')
         
         ret = {'status': 'ok'}
         LOGGER.debug(\
@@ -62,7 +62,7 @@ class PWD:
         validation = req.get('field-validation', 'enabled') == 'enabled'
 
         msg = ''
-        usernames = []
+        new_census = []
         for r in req.get('census'):
             username = r.get('username')
             password = r.get('password')
@@ -75,12 +75,7 @@ class PWD:
                 msg += check_field_value(self.password_definition, password)
 
             msg += check_fields_in_request(r, ae, 'census', validation=validation)
-            if validation:
-                msg += exist_user(r, ae)
-                if username in usernames:
-                    msg += "Username %s repeat in this census." % username
-                usernames.append(username)
-            else:
+            if not validation:
                 if msg:
                     LOGGER.debug(\
                         "PWD.census warning\n"\
@@ -92,13 +87,9 @@ class PWD:
                         msg, req, validation, ae, stack_trace_str())
                     msg = ''
                     continue
-                exist = exist_user(r, ae)
-                if exist and not exist.count('None'):
-                    continue
-                # By default we creates the user as active we don't check
-                # the pipeline
-                u = create_user(r, ae, True, request.user, user=username, password=password)
-                give_perms(u, ae)
+                new_census.append(r)
+        if validation:
+            msg += check_census_duplicates(req.get('census'), ae, ['username'])
         if msg and validation:
             LOGGER.error(\
                 "PWD.census error\n"\
@@ -111,11 +102,14 @@ class PWD:
             return self.error("Incorrect data", error_codename="invalid_credentials")
 
         if validation:
-            for r in req.get('census'):
-                # By default we creates the user as active we don't check
-                # the pipeline
-                u = create_user(r, ae, True, request.user, user=username, password=password)
-                give_perms(u, ae)
+            new_census = req.get('census')
+        else:
+            new_census = exclude_existing_users(new_census, ae)
+        # By default we creates the users as active we don't check
+        # the pipeline
+        create_users(
+            new_census, ae, True, request.user,
+            username_field='username', password_field='password')
         
         ret = {'status': 'ok'}
         LOGGER.debug(\
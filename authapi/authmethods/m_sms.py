@@ -21,7 +21,7 @@ from django.db.models import Q
 from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404
 from utils import (
-  genhmac, send_codes, get_client_ip, is_valid_url, constant_time_compare
+  genhmac, send_user_code, get_client_ip, is_valid_url, constant_time_compare
 )
 
 import plugins
@@ -46,7 +46,8 @@ class Sms:
             'mode': 'vote',
             'mode-config': None,
         },
-        'allow_user_resend': False
+        'allow_user_resend': False,
+        'sync_messages': False
     }
     PIPELINES = {
         'give_perms': [
@@ -283,7 +284,7 @@ class Sms:
         data = {'status': 'ok'}
 
         msg = ''
-        current_tlfs = []
+        new_census = []
 
         # cannot add voters to an election with invalid children election info
         if auth_event.children_election_info is not None:
@@ -334,22 +335,13 @@ class Sms:
                         msg, req, validation, auth_event, stack_trace_str())
                     return self.error("Incorrect data", error_codename="invalid_data")
             
-            if validation:
-                msg += exist_user(census_element, auth_event)
-                if tlf in current_tlfs:
-                    msg += "Tlf %s repeat." % tlf
-                current_tlfs.append(tlf)
-            else:
+            if not validation:
                 if msg:
                     msg = ''
                     continue
-                exist = exist_user(census_element, auth_event)
-                if exist and not exist.count('None'):
-                    continue
-                # By default we creates the user as active we don't check
-                # the pipeline
-                u = create_user(census_element, auth_event, True, request.user)
-                give_perms(u, auth_event)
+                new_census.append(census_element)
+        if validation:
+            msg += check_census_duplicates(req.get('census'), auth_event, ['tlf'])
         if msg and validation:
             LOGGER.error(\
                 "Sms.census error\n"\
@@ -362,11 +354,12 @@ class Sms:
             return self.error("Incorrect data", error_codename="invalid_credentials")
 
         if validation:
-            for census_element in req.get('census'):
-                # By default we creates the user as active we don't check
-                # the pipeline
-                u = create_user(census_element, auth_event, True, request.user)
-                give_perms(u, auth_event)
+            new_census = req.get('census')
+        else:
+            new_census = exclude_existing_users(new_census, auth_event)
+        # By default we creates the users as active we don't check
+        # the pipeline
+        create_users(new_census, auth_event, True, request.user)
 
         LOGGER.debug(\
             "Sms.census success\n"\
@@ -645,7 +638,7 @@ class Sms:
                 result, ae, req, stack_trace_str())
             return self.error("Incorrect data", error_codename="invalid_credentials")
         response = {'status': 'ok'}
-        send_codes.apply_async(args=[[u.id,], get_client_ip(request),'sms'])
+        send_user_code(u, get_client_ip(request), 'sms')
         LOGGER.info(\
             "Sms.register.\n"\
             "Sending (sms) codes to user id '%r'"\
@@ -835,7 +828,7 @@ class Sms:
                 "Stack trace: \n%s",\
                 result, auth_event, req, stack_trace_str())
             return self.error("Incorrect data", error_codename="invalid_credentials")
-        send_codes.apply_async(args=[[u.id,], get_client_ip(request),'sms'])
+        send_user_code(u, get_client_ip(request), 'sms')
         LOGGER.info(\
             "Sms.resend_auth_code.\n"\
             "Sending (sms) codes to user id '%r'\n"\
@@ -22,7 +22,7 @@ from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404
 from datetime import datetime, timedelta
 from utils import (
-  genhmac, send_codes, get_client_ip, is_valid_url, constant_time_compare
+  genhmac, send_user_code, get_client_ip, is_valid_url, constant_time_compare
 )
 
 import plugins
@@ -47,7 +47,8 @@ class SmsOtp:
             'mode': 'vote',
             'mode-config': None,
         },
-        'allow_user_resend': True
+        'allow_user_resend': True,
+        'sync_messages': False
     }
     PIPELINES = {
         'give_perms': [
@@ -286,7 +287,7 @@ class SmsOtp:
         data = {'status': 'ok'}
 
         msg = ''
-        current_tlfs = []
+        new_census = []
 
         # cannot add voters to an election with invalid children election info
         if auth_event.children_election_info is not None:
@@ -338,22 +339,13 @@ class SmsOtp:
                         msg, req, validation, auth_event, stack_trace_str())
                     return self.error("Incorrect data", error_codename="invalid_data")
             
-            if validation:
-                msg += exist_user(census_element, auth_event)
-                if tlf in current_tlfs:
-                    msg += "Tlf %s repeat." % tlf
-                current_tlfs.append(tlf)
-            else:
+            if not validation:
                 if msg:
                     msg = ''
                     continue
-                exist = exist_user(census_element, auth_event)
-                if exist and not exist.count('None'):
-                    continue
-                # By default we creates the user as active we don't check
-                # the pipeline
-                u = create_user(census_element, auth_event, True, request.user)
-                give_perms(u, auth_event)
+                new_census.append(census_element)
+        if validation:
+            msg += check_census_duplicates(req.get('census'), auth_event, ['tlf'])
         if msg and validation:
             SmsOtp.error(\
                 "Sms.census error\n"\
@@ -366,11 +358,12 @@ class SmsOtp:
             return self.error("Incorrect data", error_codename="invalid_credentials")
 
         if validation:
-            for census_element in req.get('census'):
-                # By default we creates the user as active we don't check
-                # the pipeline
-                u = create_user(census_element, auth_event, True, request.user)
-                give_perms(u, auth_event)
+            new_census = req.get('census')
+        else:
+            new_census = exclude_existing_users(new_census, auth_event)
+        # By default we creates the users as active we don't check
+        # the pipeline
+        create_users(new_census, auth_event, True, request.user)
         LOGGER.debug(\
             "SmsOtp.census success\n"\
             "response '%r'\n"\
@@ -647,7 +640,7 @@ class SmsOtp:
                 "Stack trace: \n%s",\
                 result, ae, req, stack_trace_str())
             return self.error("Incorrect data", error_codename="invalid_credentials")
-        send_codes.apply_async(args=[[u.id,], get_client_ip(request),'sms'])
+        send_user_code(u, get_client_ip(request), 'sms')
         LOGGER.info(\
             "SmsOtp.register.\n"\
             "Sending (sms) codes to user id '%r'"\
@@ -858,7 +851,7 @@ class SmsOtp:
                 "Stack trace: \n%s",\
                 result, auth_event, req, stack_trace_str())
             return self.error("Incorrect data", error_codename="invalid_credentials")
-        send_codes.apply_async(args=[[u.id,], get_client_ip(request),'sms'])
+        send_user_code(u, get_client_ip(request), 'sms')
         LOGGER.info(\
             "SmsOtp.resend_auth_code.\n"\
             "Sending (sms) codes to user id '%r'\n"\
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authmethods', '0008_auto_20150417_1136'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='code',
+            index=models.Index(fields=['user', 'created'], name='authmethods_code_latest'),
+        ),
+    ]
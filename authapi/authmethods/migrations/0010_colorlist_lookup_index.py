@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authmethods', '0009_code_latest_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='colorlist',
+            index=models.Index(fields=['auth_event_id', 'key', 'value'], name='authmethods_colorlist_lookup'),
+        ),
+    ]
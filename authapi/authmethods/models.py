@@ -13,10 +13,17 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with authapi.  If not, see <http://www.gnu.org/licenses/>.
 
+import threading
+import uuid
+from collections import OrderedDict
+from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from jsonfield import JSONField
 
 from api.models import UserData
+from utils import get_shared_cache
 
 
 class ColorList(models.Model):
@@ -35,6 +42,108 @@ class ColorList(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     auth_event_id = models.IntegerField()
 
+    class Meta:
+        indexes = [
+            # used to load the colour lists of an auth event
+            models.Index(
+                fields=['auth_event_id', 'key', 'value'],
+                name='authmethods_colorlist_lookup'
+            ),
+        ]
+
+
+def get_color_list_cache():
+    '''
+    Returns the cache used to share the versions of the colour lists of the
+    auth events, or None if the colour list index is disabled or the cache is
+    not shared by all the processes.
+    '''
+    return get_shared_cache(settings.COLOR_LIST_CACHE)
+
+
+def color_list_version_key(auth_event_id):
+    return 'color_list_version:%s' % auth_event_id
+
+
+def get_color_list_version(cache, auth_event_id):
+    version = cache.get(color_list_version_key(auth_event_id))
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(color_list_version_key(auth_event_id), version, None):
+            version = cache.get(color_list_version_key(auth_event_id))
+    return version
+
+
+def load_color_list_index(auth_event_id):
+    '''
+    Returns the colour lists of the auth event, as a dict with the set of
+    values of each (key, action)
+    '''
+    index = dict()
+    color_lists = ColorList.objects\
+        .filter(auth_event_id=auth_event_id)\
+        .values_list('key', 'action', 'value')
+    for key, action, value in color_lists:
+        index.setdefault((key, action), set()).add(value)
+    return index
+
+
+class ColorListIndex(object):
+    '''
+    Process-wide LRU cache of the colour lists of the auth events, so that
+    the whitelist and blacklist checks don't query them in each request.
+
+    Each entry is kept with the version of the colour lists of its auth
+    event, which is shared by all the processes through the cache
+    settings.COLOR_LIST_CACHE and changed on each ColorList write, and it's
+    reloaded when the version changes.
+    '''
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, auth_event_id):
+        cache = get_color_list_cache()
+        max_size = settings.COLOR_LIST_INDEX_SIZE
+        if cache is None or max_size <= 0:
+            return load_color_list_index(auth_event_id)
+
+        # read before loading, so that a write done meanwhile is not missed
+        version = get_color_list_version(cache, auth_event_id)
+        with self.lock:
+            entry = self.entries.get(auth_event_id)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(auth_event_id)
+                return entry[1]
+
+        index = load_color_list_index(auth_event_id)
+        with self.lock:
+            self.entries[auth_event_id] = (version, index)
+            self.entries.move_to_end(auth_event_id)
+            while len(self.entries) > max_size:
+                self.entries.popitem(last=False)
+        return index
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+COLOR_LIST_INDEX = ColorListIndex()
+
+
+@receiver(post_save, sender=ColorList)
+@receiver(post_delete, sender=ColorList)
+def bump_color_list_version(sender, instance, *args, **kwargs):
+    cache = get_color_list_cache()
+    if cache is not None:
+        cache.set(
+            color_list_version_key(instance.auth_event_id),
+            uuid.uuid4().hex,
+            None
+        )
+
+
 class Message(models.Model):
     ip = models.CharField(max_length=15)
     tlf = models.CharField(max_length=20)
@@ -58,3 +167,12 @@ class Code(models.Model):
     code = models.CharField(max_length=64)
     created = models.DateTimeField(auto_now_add=True)
     auth_event_id = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            # used to find the latest codes of a voter when authenticating
+            models.Index(
+                fields=['user', 'created'],
+                name='authmethods_code_latest'
+            ),
+        ]
@@ -19,8 +19,12 @@ import re
 import sys
 import requests
 import logging
+import threading
 import xmltodict
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
+from django.dispatch import receiver
+from django.core.signals import setting_changed
 from utils import stack_trace_str
 from twilio.rest import Client
 
@@ -34,8 +38,18 @@ class SMSProvider(object):
 
     default_prefix = "+34"
 
+    # process-wide instance returned by get_instance()
+    instance = None
+    instance_lock = threading.Lock()
+
     def __init__(self):
-        pass
+        # pooled HTTP connections, shared by all the messages sent
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=settings.SMS_MAX_WORKERS
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def send_sms(self, dest, msg, is_audio=False):
         '''
@@ -44,6 +58,37 @@ class SMSProvider(object):
         '''
         pass
 
+    def send_many(self, messages):
+        '''
+        Sends many sms concurrently, with at most settings.SMS_MAX_WORKERS
+        at the same time. messages is a list of dicts with the receiver,
+        content and is_audio (optional) of each sms.
+
+        Returns a list with the result of each message in the same order, a
+        dict with either the value returned by send_sms() in 'result' or the
+        exception raised in 'error'.
+        '''
+        def send(message):
+            try:
+                return dict(
+                    receiver=message['receiver'],
+                    result=self.send_sms(
+                        receiver=message['receiver'],
+                        content=message['content'],
+                        is_audio=message.get('is_audio', False)
+                    )
+                )
+            except Exception as error:
+                LOGGER.error(\
+                    "SMSProvider.send_many error\n"\
+                    "message '%r'\n"\
+                    "error '%r'",\
+                    message, error)
+                return dict(receiver=message['receiver'], error=error)
+
+        with ThreadPoolExecutor(max_workers=settings.SMS_MAX_WORKERS) as executor:
+            return list(executor.map(send, messages))
+
     def get_credit(self):
         '''
         obtains the remaining credit. Note, each provider has it's own format
@@ -75,6 +120,18 @@ class SMSProvider(object):
 
     @staticmethod
     def get_instance():
+        '''
+        Returns the instance of the SMS provider specified in the app config,
+        which is created only once per process.
+        '''
+        if SMSProvider.instance is None:
+            with SMSProvider.instance_lock:
+                if SMSProvider.instance is None:
+                    SMSProvider.instance = SMSProvider.create_instance()
+        return SMSProvider.instance
+
+    @staticmethod
+    def create_instance():
         '''
         Instance the SMS provider specified in the app config
         '''
@@ -93,21 +150,32 @@ class SMSProvider(object):
             raise Exception("invalid SMS_PROVIDER='%s' in app config" % provider)
 
 
+@receiver(setting_changed)
+def reset_sms_provider(setting, **kwargs):
+    '''
+    Creates the SMS provider again when its settings change in the tests
+    '''
+    if setting.startswith('SMS_'):
+        SMSProvider.instance = None
+
+
 class TestSMSProvider(SMSProvider):
     provider_name = "test"
     last_sms = ""
     sms_count = 0
+    sms_lock = threading.Lock()
 
     def __init__(self):
-        pass
+        super(TestSMSProvider, self).__init__()
 
     def send_sms(self, receiver, content, is_audio):
-        TestSMSProvider.sms_count += 1
-        TestSMSProvider.last_sms = dict(
-            content=content, 
-            receiver=receiver, 
-            is_audio=is_audio
-        )
+        with TestSMSProvider.sms_lock:
+            TestSMSProvider.sms_count += 1
+            TestSMSProvider.last_sms = dict(
+                content=content, 
+                receiver=receiver, 
+                is_audio=is_audio
+            )
         LOGGER.info(\
             "TestSMSProvider.send_sms\n"\
             "sending message '%r'\n"\
@@ -120,7 +188,7 @@ class ConsoleSMSProvider(SMSProvider):
     provider_name = "console"
 
     def __init__(self):
-        pass
+        super(ConsoleSMSProvider, self).__init__()
 
     def send_sms(self, receiver, content, is_audio):
         LOGGER.info(\
@@ -153,6 +221,7 @@ class AltiriaSMSProvider(SMSProvider):
     }
 
     def __init__(self):
+        super(AltiriaSMSProvider, self).__init__()
         self.domain_id = settings.SMS_DOMAIN_ID
         self.login = settings.SMS_LOGIN
         self.password = settings.SMS_PASSWORD
@@ -171,7 +240,7 @@ class AltiriaSMSProvider(SMSProvider):
             'senderId': self.sender_id
         }
 
-        r = requests.post(self.url, data=data, headers=self.headers)
+        r = self.session.post(self.url, data=data, headers=self.headers)
 
         ret = self.parse_response(r)
         LOGGER.info(\
@@ -194,7 +263,7 @@ class AltiriaSMSProvider(SMSProvider):
             'passwd': self.password,
 
         }
-        r = requests.post(self.url, data=data, headers=self.headers)
+        r = self.session.post(self.url, data=data, headers=self.headers)
 
         ret = self.parse_response(r)
         LOGGER.info(\
@@ -286,6 +355,7 @@ class EsendexSMSProvider(SMSProvider):
         </messages>"""
 
     def __init__(self):
+        super(EsendexSMSProvider, self).__init__()
         self.domain_id = settings.SMS_DOMAIN_ID
         self.login = settings.SMS_LOGIN
         self.password = settings.SMS_PASSWORD
@@ -310,7 +380,7 @@ class EsendexSMSProvider(SMSProvider):
             body=content,
             sender=self.sender_id,
             extra=extra)
-        r = requests.post(self.url, data=data, headers=self.headers, auth=self.auth)
+        r = self.session.post(self.url, data=data, headers=self.headers, auth=self.auth)
 
         ret = self.parse_response(r)
         if 'error' in ret:
@@ -392,6 +462,7 @@ class TwilioSMSProvider(SMSProvider):
         </messages>"""
 
     def __init__(self):
+        super(TwilioSMSProvider, self).__init__()
         self.domain_id = settings.SMS_DOMAIN_ID
         self.login = settings.SMS_LOGIN
         self.password = settings.SMS_PASSWORD
@@ -478,9 +549,11 @@ class TwilioSMSProvider(SMSProvider):
         ]
         # if there is a match bewteen the receiver and this regex, we can't use
         # alphanumeric sender ids
-        self.regex_blacklist = "^(\+|00)(" + "|".join(self.no_alphanumeric_countrycodes) + ")[0-9]+$"
+        self.regex_blacklist = re.compile(
+            "^(\+|00)(" + "|".join(self.no_alphanumeric_countrycodes) + ")[0-9]+$"
+        )
         # regex used to check whether sender id is alphanumeric
-        self.regex_senderid = "^(\+|00)[0-9]+$"
+        self.regex_senderid = re.compile("^(\+|00)[0-9]+$")
 
         self.auth = (self.login, self.password)
         self.client = Client(self.login, self.password)
@@ -489,8 +562,8 @@ class TwilioSMSProvider(SMSProvider):
         try:
             msg_type = 'SMS'
             extra = ""
-            if (None == re.match(self.regex_blacklist, receiver) or\
-                None != re.match(self.regex_senderid, self.sender_id)):
+            if (None == self.regex_blacklist.match(receiver) or\
+                None != self.regex_senderid.match(self.sender_id)):
                 from_ = self.sender_id
             else:
                 from_ = self.sender_number
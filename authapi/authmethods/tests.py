@@ -25,7 +25,7 @@ from api.tests import JClient, flush_db_load_fixture
 from api.models import AuthEvent, ACL, UserData
 from .m_email import Email
 from .m_sms import Sms
-from .models import Message, Code, Connection
+from .models import Message, Code, Connection, MsgLog
 
 
 class AuthMethodTestCase(TestCase):
@@ -67,6 +67,27 @@ class AuthMethodTestCase(TestCase):
         r = json.loads(response.content.decode('utf-8'))
         self.assertTrue(r['auth-token'].startswith('khmac:///sha-256'))
 
+    def test_ping_verified_token_cache(self):
+        from unittest import mock
+        from utils import verifyhmac
+        from api.decorators import VERIFIED_TOKENS
+        VERIFIED_TOKENS.clear()
+        c = JClient()
+        response = c.authenticate(self.aeid, test_data.pwd_auth)
+        self.assertEqual(response.status_code, 200)
+
+        with mock.patch('api.decorators.verifyhmac', wraps=verifyhmac) as verify:
+            for i in range(3):
+                response = c.get('/api/auth-event/%s/ping/' % self.aeid, {})
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(verify.call_count, 1)
+
+        # a removed user can't use its cached token
+        User.objects.filter(pk=self.userid).delete()
+        response = c.get('/api/auth-event/%s/ping/' % self.aeid, {})
+        self.assertEqual(response.status_code, 403)
+        VERIFIED_TOKENS.clear()
+
 
 class AuthMethodEmailTestCase(TestCase):
     def setUpTestData():
@@ -337,6 +358,100 @@ class AuthMethodSmsTestCase(TestCase):
         e = re.search(test_url, o.groups()[0])
         self.assertTrue(e.group(0) == test_url.replace('\\',''))
 
+    @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True,
+                       CELERY_ALWAYS_EAGER=True,
+                       BROKER_BACKEND='memory')
+    def test_method_sms_register_async_delivery(self):
+        from authmethods.sms_provider import TestSMSProvider
+        from utils import send_code_msg
+        sms_count0 = TestSMSProvider.sms_count
+        data = {'tlf': '+34666666667', 'code': 'AAAAAAAA',
+                    'email': 'test1@test.com', 'dni': '11111111H'}
+        response = self.c.register(self.aeid, data)
+        self.assertEqual(response.status_code, 200)
+
+        # the code and the message are saved in the request, but the message
+        # is sent by a worker after the transaction commits
+        user = User.objects.get(email=data['email'])
+        self.assertEqual(Code.objects.filter(user=user.userdata).count(), 1)
+        msg_log = MsgLog.objects.get(authevent_id=self.aeid, receiver=data['tlf'])
+        self.assertEqual(TestSMSProvider.sms_count, sms_count0)
+        send_code_msg(msg_log.id, 'sms')
+        self.assertEqual(TestSMSProvider.sms_count, sms_count0 + 1)
+        self.assertEqual(TestSMSProvider.last_sms['content'], msg_log.msg['msg'])
+
+        # sync_messages keeps sending it in the request
+        ae = AuthEvent.objects.get(pk=self.aeid)
+        ae.auth_method_config['config']['sync_messages'] = True
+        ae.save()
+        data = {'tlf': '+34666666668', 'code': 'AAAAAAAA',
+                    'email': 'test3@test.com', 'dni': '22222222J'}
+        response = self.c.register(self.aeid, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(TestSMSProvider.sms_count, sms_count0 + 2)
+        self.assertEqual(TestSMSProvider.last_sms['receiver'], data['tlf'])
+
+
+class SMSProviderTestCase(TestCase):
+    def setUp(self):
+        import threading
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+
+        class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        received = self.received = []
+        class AltiriaHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                body = self.rfile.read(length).decode('utf-8')
+                received.append(body)
+                self.send_response(200)
+                self.end_headers()
+                if 'dest=%2B34000000000' in body:
+                    self.wfile.write(b'ERROR errNum:015\n')
+                else:
+                    self.wfile.write(b'OK dest:34666666666\n')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), AltiriaHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_send_many(self):
+        from .sms_provider import SMSProvider, AltiriaSMSProvider
+        with self.settings(SMS_PROVIDER='altiria', SMS_URL=self.url, SMS_MAX_WORKERS=3):
+            provider = SMSProvider.get_instance()
+            self.assertTrue(isinstance(provider, AltiriaSMSProvider))
+            self.assertTrue(provider is SMSProvider.get_instance())
+
+            receivers = ['+3466666666%d' % i for i in range(9)] + ['+34000000000']
+            results = provider.send_many([
+                dict(receiver=receiver, content='code %d' % i)
+                for i, receiver in enumerate(receivers)
+            ])
+            self.assertEqual(len(self.received), 10)
+            self.assertEqual(
+                [result['receiver'] for result in results],
+                receivers
+            )
+            self.assertEqual(
+                [result['result']['lines'][0]['error'] for result in results],
+                [False] * 9 + [True]
+            )
+
+        # the provider is created again when the settings change
+        self.assertFalse(isinstance(SMSProvider.get_instance(), AltiriaSMSProvider))
+
 
 class ExtraFieldPipelineTestCase(TestCase):
     def setUpTestData():
@@ -695,6 +810,93 @@ class ExternalCheckPipelineTestCase(TestCase):
         mdata = u.userdata.metadata
         self.assertEqual(mdata['external_data']['custom'], True)
 
+
+class ColorListIndexTestCase(TestCase):
+    def setUp(self):
+        ae = AuthEvent(auth_method='sms',
+                auth_method_config=test_data.authmethod_config_sms_default,
+                status='started')
+        ae.save()
+        self.ae = ae
+
+    @override_settings(COLOR_LIST_CACHE='default')
+    def test_color_list_index(self):
+        from django.core.cache import cache
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .models import ColorList, COLOR_LIST_INDEX
+        from .utils import check_blacklisted, check_whitelisted
+        cache.clear()
+        COLOR_LIST_INDEX.clear()
+        ColorList(action=ColorList.ACTION_BLACKLIST, key=ColorList.KEY_TLF,
+                  value='+34666666666', auth_event_id=self.ae.pk).save()
+        data = dict(ip_addr='127.0.0.1', tlf='+34666666666', auth_event=self.ae)
+
+        # the colour lists are loaded once for all the checks
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(check_whitelisted(dict(data), field='ip'), 0)
+            self.assertEqual(check_blacklisted(dict(data), field='ip'), 0)
+            result = check_blacklisted(dict(data), field='tlf')
+            self.assertEqual(result['error_codename'], 'blacklisted')
+        self.assertEqual(len(queries), 1)
+
+        # and reloaded when they change
+        ColorList(action=ColorList.ACTION_WHITELIST, key=ColorList.KEY_IP,
+                  value='127.0.0.1', auth_event_id=self.ae.pk).save()
+        ip_data = dict(data)
+        self.assertEqual(check_whitelisted(ip_data, field='ip'), 0)
+        self.assertTrue(ip_data['whitelisted'])
+        self.assertEqual(check_blacklisted(ip_data, field='tlf'), 0)
+
+        # a cache of each process is not used, as the changes done in one
+        # process would not be seen by the others
+        with override_settings(
+            LOCAL_CACHE_BACKENDS=['django.core.cache.backends.locmem.LocMemCache']
+        ):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(check_whitelisted(dict(data), field='ip'), 0)
+                self.assertEqual(check_blacklisted(dict(data), field='ip'), 0)
+            self.assertEqual(len(queries), 2)
+
+
+class CompiledPipelinesTestCase(TestCase):
+    def setUp(self):
+        ae = AuthEvent(auth_method='sms',
+                auth_method_config=test_data.authmethod_config_sms_default,
+                status='started')
+        ae.save()
+        self.ae = AuthEvent.objects.get(pk=ae.pk)
+
+    def test_compiled_pipelines(self):
+        from django.test import RequestFactory
+        from .models import ColorList
+        from .utils import COMPILED_PIPELINES, check_pipeline, check_blacklisted
+        COMPILED_PIPELINES.clear()
+        pipeline = [["check_blacklisted", {"field": "tlf"}]]
+        self.ae.auth_method_config['pipeline']['register-pipeline'] = pipeline
+        request = RequestFactory().post(
+            '/', json.dumps({'tlf': '+34666666666'}),
+            content_type='application/json')
+
+        # compiled once while the configuration doesn't change
+        self.assertEqual(check_pipeline(request, self.ae), 0)
+        compiled = COMPILED_PIPELINES.get(self.ae, 'register')
+        self.assertEqual(compiled, [(check_blacklisted, {"field": "tlf"})])
+        self.assertIs(COMPILED_PIPELINES.get(self.ae, 'register'), compiled)
+
+        # failed checks return their error data
+        ColorList(action=ColorList.ACTION_BLACKLIST, key=ColorList.KEY_TLF,
+                  value='+34666666666', auth_event_id=self.ae.pk).save()
+        result = check_pipeline(request, self.ae)
+        self.assertEqual(result['status'], 400)
+        self.assertEqual(result['error_codename'], 'blacklisted')
+        self.assertEqual(result['tlf'], '+34666666666')
+
+        # unknown checks are not evaluated
+        pipeline.append(["__import__", {"name": "os"}])
+        response = check_pipeline(request, self.ae)
+        self.assertEqual(response.status_code, 400)
+
 ''' 
 class AuthMethodOpenIDConnectTestCase(TestCase):
     def setUpTestData():
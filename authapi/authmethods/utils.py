@@ -20,16 +20,20 @@ import os
 import copy
 import binascii
 import logging
+import threading
+from collections import OrderedDict
 from base64 import decodestring
 from datetime import timedelta, datetime
 from django.conf import settings
 from django.contrib.auth.models import User, AnonymousUser
 from django.contrib.auth.signals import user_logged_in
 from django.utils import timezone
+from django.db import transaction
 from django.db.models import Q
+from django.contrib.postgres.fields.jsonb import KeyTextTransform
 
-from .models import ColorList, Message, Code
-from api.models import ACL
+from .models import ColorList, Message, Code, Connection, COLOR_LIST_INDEX
+from api.models import ACL, bump_auth_event_version
 from captcha.models import Captcha
 from captcha.decorators import valid_captcha
 from contracts import CheckException, JSONContractEncoder
@@ -40,7 +44,8 @@ from utils import (
     constant_time_compare,
     permission_required,
     genhmac,
-    stack_trace_str
+    stack_trace_str,
+    SlidingWindowCounter
 )
 from pipelines.base import execute_pipeline, PipeReturnvalue
 
@@ -66,9 +71,11 @@ def error(message="", status=400, field=None, error_codename=None):
     return json_response(status=400, message=message, field=field, error_codename=error_codename)
 
 
-def random_username():
+def random_username(check_unique=True):
     # 30 hex digits random username
     username = binascii.b2a_hex(os.urandom(14)).decode('utf-8')
+    if not check_unique:
+        return username
     try:
         User.objects.get(username=username)
         return random_username()
@@ -93,20 +100,36 @@ def date_constraint(val):
     return True
 
 # Pipeline
+def pipe_error(message, error_codename):
+    '''
+    Returns the result of a pipeline check that failed, with the same data
+    as the error() response
+    '''
+    return dict(
+        status=400,
+        message=message,
+        field=None,
+        error_codename=error_codename
+    )
+
+
+def is_color_listed(data, key, action, value):
+    ''' Returns whether the value is in the colour list of the auth event '''
+    color_list = COLOR_LIST_INDEX.get(data['auth_event'].id)
+    return value in color_list.get((key, action), ())
+
+
 def check_tlf_whitelisted(data):
     ''' If tlf is whitelisted, accept '''
     if data.get('whitelisted', False) == True:
         return RET_PIPE_CONTINUE
 
     tlf = data['tlf']
-    try:
-        item = ColorList.objects.get(key=ColorList.KEY_TLF, value=tlf, auth_event_id=data['auth_event'].id)
-        if item.action == ColorList.ACTION_WHITELIST:
-            data['whitelisted'] = True
-        else:
-            data["tlf_blacklisted"] = True
-    except:
-        data["tlf_blacklisted"] = False
+    if is_color_listed(data, ColorList.KEY_TLF, ColorList.ACTION_WHITELIST, tlf):
+        data['whitelisted'] = True
+    else:
+        data["tlf_blacklisted"] = is_color_listed(
+            data, ColorList.KEY_TLF, ColorList.ACTION_BLACKLIST, tlf)
     return RET_PIPE_CONTINUE
 
 
@@ -117,16 +140,12 @@ def check_ip_whitelisted(data):
     if data.get('whitelisted', False) == True:
         return RET_PIPE_CONTINUE
 
-    ip_addr = data['ip_addr']
-    try:
-        item = ColorList.objects.filter(key=ColorList.KEY_IP, value=ip_addr[:15],
-                                        auth_event_id=data['auth_event'].id)
-        for item in items:
-            if item.action == ColorList.ACTION_WHITELIST:
-                data['whitelisted'] = True
-                break
-    except:
-        pass
+    ip_addr = data['ip_addr'][:15]
+    if is_color_listed(data, ColorList.KEY_IP, ColorList.ACTION_WHITELIST, ip_addr):
+        data['whitelisted'] = True
+    else:
+        data["ip_blacklisted"] = is_color_listed(
+            data, ColorList.KEY_IP, ColorList.ACTION_BLACKLIST, ip_addr)
     return RET_PIPE_CONTINUE
 
 
@@ -139,16 +158,12 @@ def check_tlf_blacklisted(data):
     # we don't have do new queries
     if 'tlf_blacklisted' in data:
         if data['tlf_blacklisted']:
-            return error("Blacklisted", error_codename="blacklisted")
+            return pipe_error("Blacklisted", error_codename="blacklisted")
         return RET_PIPE_CONTINUE
 
     tlf = data['tlf']
-    try:
-        item = ColorList.objects.filter(key=ColorList.KEY_TLF, value=tlf,
-                action=ColorList.ACTION_BLACKLIST, auth_event_id=data['auth_event'].id)[0]
-        return error("Blacklisted", error_codename="blacklisted")
-    except:
-        pass
+    if is_color_listed(data, ColorList.KEY_TLF, ColorList.ACTION_BLACKLIST, tlf):
+        return pipe_error("Blacklisted", error_codename="blacklisted")
     return RET_PIPE_CONTINUE
 
 
@@ -161,20 +176,42 @@ def check_ip_blacklisted(data):
     # we don't have do new queries
     if 'ip_blacklisted' in data:
         if data['ip_blacklisted'] is True:
-            return error("Blacklisted", error_codename="blacklisted")
+            return pipe_error("Blacklisted", error_codename="blacklisted")
         return RET_PIPE_CONTINUE
 
-    ip_addr = data['ip_addr']
-    try:
-        item = ColorList.objects.filter(key=ColorList.KEY_IP, value=ip_addr[:15],
-                action=ColorList.ACTION_BLACKLIST,
-                auth_event_id=data['auth_event'].id)[0]
-        return error("Blacklisted", error_codename="blacklisted")
-    except:
-        pass
+    ip_addr = data['ip_addr'][:15]
+    if is_color_listed(data, ColorList.KEY_IP, ColorList.ACTION_BLACKLIST, ip_addr):
+        return pipe_error("Blacklisted", error_codename="blacklisted")
     return RET_PIPE_CONTINUE
 
 
+def get_message_counter(auth_event_id, field, value):
+    '''
+    Returns the SlidingWindowCounter of the messages sent in the auth event
+    to the given ip or tlf (field)
+    '''
+    return SlidingWindowCounter(
+        'message:%d:%s:%s' % (auth_event_id, field, value),
+        Message.objects.filter(**{
+            'auth_event_id': auth_event_id,
+            field: value
+        })
+    )
+
+
+def count_message(message):
+    '''
+    Updates the counters of the ip and tlf of a new message, checked by
+    check_total_max
+    '''
+    for field in ['ip', 'tlf']:
+        get_message_counter(
+            message.auth_event_id,
+            field,
+            getattr(message, field)
+        ).add()
+
+
 def check_tlf_total_max(data, **kwargs):
     '''
     if tlf has been sent >= MAX_SMS_LIMIT (in a period time) failed-sms
@@ -187,14 +224,10 @@ def check_tlf_total_max(data, **kwargs):
 
     ip_addr = data['ip_addr']
     tlf = data['tlf']
-    if period:
-        time_threshold = timezone.now() - timedelta(seconds=period)
-        item = Message.objects.filter(tlf=tlf, created__gt=time_threshold,
-                                      auth_event_id=data['auth_event'].id)
-    else:
-        item = Message.objects.filter(tlf=tlf, auth_event_id=data['auth_event'].id)
+    num_messages = get_message_counter(data['auth_event'].id, 'tlf', tlf)\
+        .count(period)
 
-    if len(item) >= total_max:
+    if num_messages >= total_max:
         c1 = ColorList(action=ColorList.ACTION_BLACKLIST,
                        key=ColorList.KEY_IP, value=ip_addr[:15],
                        auth_event_id=data['auth_event'].id)
@@ -203,7 +236,7 @@ def check_tlf_total_max(data, **kwargs):
                        key=ColorList.KEY_TLF, value=tlf,
                        auth_event_id=data['auth_event'].id)
         c2.save()
-        return error("Blacklisted", error_codename="blacklisted")
+        return pipe_error("Blacklisted", error_codename="blacklisted")
     return RET_PIPE_CONTINUE
 
 
@@ -226,18 +259,13 @@ def check_ip_total_max(data, **kwargs):
         return RET_PIPE_CONTINUE
 
     ip_addr = data['ip_addr']
-    if period:
-        time_threshold = timezone.now() - timedelta(seconds=period)
-        item = Message.objects.filter(
-            ip=ip_addr[:15],
-            created__gt=time_threshold,
-            auth_event_id=data['auth_event'].id)
-    else:
-        item = Message.objects.filter(
-            ip=ip_addr[:15],
-            auth_event_id=data['auth_event'].id)
+    num_messages = get_message_counter(
+        data['auth_event'].id,
+        'ip',
+        ip_addr[:15]
+    ).count(period)
 
-    if len(item) >= total_max:
+    if num_messages >= total_max:
         cl = ColorList(
           action=ColorList.ACTION_BLACKLIST,
           key=ColorList.KEY_IP,
@@ -247,33 +275,33 @@ def check_ip_total_max(data, **kwargs):
         cl.save()
         LOGGER.debug(
           "check_ip_total_max: blacklisted\n"\
-          "returns 'Error Blacklisted' because len(item) >= total_max\n"\
+          "returns 'Error Blacklisted' because num_messages >= total_max\n"\
           "data '%r'\n" \
           "kwargs '%r'\n" \
-          "len(item) '%r'\n" \
+          "num_messages '%r'\n" \
           "total_max '%r'\n" \
           "ip_addr '%r'\n" \
           "cl.id '%r'\n",
           data,
           kwargs,
-          len(item),
+          num_messages,
           total_max,
           ip_addr[:15],
           cl.id
         )
-        return error("Blacklisted", error_codename="blacklisted")
+        return pipe_error("Blacklisted", error_codename="blacklisted")
     
     LOGGER.debug(
       "check_ip_total_max: ok\n"\
-      "returns 'RET_PIPE_CONTINUE' because len(item) < total_max\n"\
+      "returns 'RET_PIPE_CONTINUE' because num_messages < total_max\n"\
       "data '%r'\n" \
       "kwargs '%r'\n" \
-      "len(item) '%r'\n" \
+      "num_messages '%r'\n" \
       "total_max '%r'\n" \
       "ip_addr '%r'\n",
       data,
       kwargs,
-      len(item),
+      num_messages,
       total_max,
       ip_addr[:15],
     )
@@ -287,7 +315,7 @@ def check_sms_code(data, **kwargs):
         code = Code.objects.get(user=u.pk, code=data['code'],
                 created__gt=time_thr, auth_event_id=data['auth_event'].id)
     except:
-        return error('Invalid code.', error_codename='check_sms_code')
+        return pipe_error('Invalid code.', error_codename='check_sms_code')
     return RET_PIPE_CONTINUE
 
 
@@ -323,13 +351,21 @@ def check_total_max(data, **kwargs):
     return check
 
 def check_total_connection(data, **kwargs):
-    conn = Connection.objects.filter(tlf=req.get('tlf'),
-                                     auth_event_id=data['auth_event'].id).count()
-    if conn >= kwargs.get('times'):
-        return error('Exceeded the level os attempts',
+    auth_event_id = data['auth_event'].id
+    counter = SlidingWindowCounter(
+        'connection:%d:%s' % (auth_event_id, data['tlf']),
+        Connection.objects.filter(tlf=data['tlf'], auth_event_id=auth_event_id)
+    )
+    if counter.count() >= kwargs.get('times'):
+        return pipe_error('Exceeded the level os attempts',
                 error_codename='check_total_connection')
-    conn = Connection(ip=data['ip'], tlf=data['tlf'])
+    conn = Connection(
+        ip=data['ip_addr'][:15],
+        tlf=data['tlf'],
+        auth_event_id=auth_event_id
+    )
     conn.save()
+    counter.add()
     return RET_PIPE_CONTINUE
 
 def normalize_dni(dni):
@@ -400,13 +436,88 @@ def canonize_extra_field(extra, req):
         if isinstance(field_value, str):
             req[field_name] = field_value.lower().strip() not in ["", "false"]
 
-def check_pipeline(request, ae, step='register', default_pipeline=None):
-    req = json.loads(request.body.decode('utf-8'))
+# checks that can be used in the pipelines of the auth events
+PIPES = dict()
 
-    if ae.extra_fields:
-        for extra_field in ae.extra_fields:
-            canonize_extra_field(extra_field, req)
+def register_pipe(name, func):
+    PIPES[name] = func
+
+register_pipe('check_whitelisted', check_whitelisted)
+register_pipe('check_blacklisted', check_blacklisted)
+register_pipe('check_total_max', check_total_max)
+register_pipe('check_total_connection', check_total_connection)
+register_pipe('check_sms_code', check_sms_code)
 
+
+def compile_pipeline(pipeline):
+    '''
+    Resolves the names of the checks of a pipeline to the registered
+    functions, returning a list of (function, kwargs). Raises KeyError if a
+    check is not registered.
+    '''
+    return [(PIPES[name], kwargs) for name, kwargs in pipeline]
+
+
+class CompiledPipelines(object):
+    '''
+    Process-wide LRU cache of the compiled pipelines of the auth events, so
+    that each one is only compiled again when its configuration changes.
+    Each entry is kept with a copy of the configuration it was compiled
+    from.
+    '''
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, ae, step, default_pipeline=None):
+        '''
+        Returns the compiled pipeline of the given step of the auth event, or
+        None if it has no pipeline for it.
+        '''
+        pipeline = ae.auth_method_config.get('pipeline').get('%s-pipeline' % step)
+        if pipeline is None:
+            pipeline = default_pipeline
+        if pipeline is None:
+            return None
+
+        key = (ae.pk, step)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == pipeline:
+                self.entries.move_to_end(key)
+                return entry[1]
+
+        compiled = compile_pipeline(pipeline)
+        max_size = settings.COMPILED_PIPELINES_SIZE
+        if max_size > 0:
+            with self.lock:
+                self.entries[key] = (copy.deepcopy(pipeline), compiled)
+                self.entries.move_to_end(key)
+                while len(self.entries) > max_size:
+                    self.entries.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+COMPILED_PIPELINES = CompiledPipelines()
+
+
+def check_pipeline(request, ae, step='register', default_pipeline=None):
+    try:
+        pipeline = COMPILED_PIPELINES.get(ae, step, default_pipeline)
+    except KeyError as e:
+        LOGGER.error(
+            "check_pipeline: invalid check %r in the %s pipeline of "\
+            "authevent '%r'",
+            e.args[0], step, ae)
+        return error(message="invalid pipeline", status=400, error_codename="invalid-pipeline")
+    if pipeline is None:
+        return error(message="no pipeline", status=400, error_codename="no-pipeline")
+
+    req = json.loads(request.body.decode('utf-8'))
     data = {
         'ip_addr': get_client_ip(request),
         'tlf': req.get('tlf', None),
@@ -414,18 +525,16 @@ def check_pipeline(request, ae, step='register', default_pipeline=None):
         'auth_event': ae
     }
 
-    pipeline = ae.auth_method_config.get('pipeline').get('%s-pipeline' % step)
-    if pipeline is None:
-        if default_pipeline is None:
-            return error(message="no pipeline", status=400, error_codename="no-pipeline")
-        pipeline = default_pipeline
-
+    # only the fields used by the checks need to be canonized
+    if ae.extra_fields:
+        for extra_field in ae.extra_fields:
+            if extra_field.get('name') in ('tlf', 'code'):
+                canonize_extra_field(extra_field, data)
 
-    for pipe in pipeline:
-        check = getattr(eval(pipe[0]), '__call__')(data, **pipe[1])
+    for func, kwargs in pipeline:
+        check = func(data, **kwargs)
         if check:
-            data.update(json.loads(check.content.decode('utf-8')))
-            data['status'] = check.status_code
+            data.update(check)
             if data.get('auth_event'):
                 data.pop('auth_event')
             if data.get('code'):
@@ -609,6 +718,125 @@ def exist_user(req, ae, get_repeated=False):
 
     return msg
 
+def get_census_keys(req, ae):
+    '''
+    Returns the list of values of a census element that must be unique within
+    the auth event, as (kind, name, value) tuples, where kind is one of
+    'email', 'tlf', 'username' or 'unique' (for the unique extra fields).
+    '''
+    keys = []
+    if req.get('email'):
+        keys.append(('email', 'email', req.get('email')))
+    if req.get('tlf'):
+        keys.append(('tlf', 'tlf', get_cannonical_tlf(req['tlf'])))
+    if req.get('username'):
+        keys.append(('username', 'username', req.get('username')))
+
+    for extra in (ae.extra_fields or []):
+        reg_name = extra.get('name')
+        if extra.get('unique') and reg_name and req.get(reg_name):
+            value = req.get(reg_name)
+            # compared with the text stored in the metadata json
+            if not isinstance(value, str):
+                value = json.dumps(value)
+            keys.append(('unique', reg_name, value))
+    return keys
+
+
+def get_existing_census_keys(keys, ae):
+    '''
+    Returns the set of the given census keys (see get_census_keys()) that are
+    already used by a user, with one query per kind of key and chunk of
+    settings.CENSUS_BULK_CHUNK_SIZE values.
+    '''
+    from api.models import UserData
+
+    grouped = dict()
+    for kind, name, value in keys:
+        grouped.setdefault((kind, name), set()).add(value)
+
+    existing = set()
+    chunk_size = settings.CENSUS_BULK_CHUNK_SIZE
+    for (kind, name), values in grouped.items():
+        values = list(values)
+        for start in range(0, len(values), chunk_size):
+            chunk = values[start:start + chunk_size]
+            if kind == 'email':
+                query = User.objects\
+                    .filter(userdata__event=ae, email__in=chunk)\
+                    .values_list('email', flat=True)
+            elif kind == 'tlf':
+                query = UserData.objects\
+                    .filter(event=ae, tlf__in=chunk)\
+                    .values_list('tlf', flat=True)
+            elif kind == 'username':
+                # usernames are unique among all the auth events
+                query = User.objects\
+                    .filter(username__in=chunk)\
+                    .values_list('username', flat=True)
+            else:
+                query = UserData.objects\
+                    .filter(event=ae, user__is_active=True)\
+                    .annotate(unique_value=KeyTextTransform(name, 'metadata'))\
+                    .filter(unique_value__in=chunk)\
+                    .values_list('unique_value', flat=True)
+            existing.update((kind, name, value) for value in query)
+    return existing
+
+
+def exclude_existing_users(census, ae):
+    '''
+    Returns the census elements that don't collide with an existing user or
+    with a previous element of the same census, which is what checking
+    exist_user() before creating each one of them would do.
+    '''
+    census_keys = [get_census_keys(req, ae) for req in census]
+    existing = get_existing_census_keys(
+        [key for keys in census_keys for key in keys],
+        ae
+    )
+
+    seen = set()
+    ret = []
+    for req, keys in zip(census, census_keys):
+        if any(key in existing or key in seen for key in keys):
+            continue
+        seen.update(keys)
+        ret.append(req)
+    return ret
+
+
+def check_census_duplicates(census, ae, repeat_kinds):
+    '''
+    Returns the error messages for the census elements that collide with an
+    existing user (like exist_user() does), or that repeat within the same
+    census a value of one of the given kinds of census keys (see
+    get_census_keys()). Repetitions are detected with in-memory sets and the
+    existing users with get_existing_census_keys(), so the cost doesn't grow
+    quadratically with the size of the census.
+    '''
+    labels = {'email': 'Email', 'tlf': 'Tel', 'username': 'Username'}
+    census_keys = [get_census_keys(req, ae) for req in census]
+    existing = get_existing_census_keys(
+        [key for keys in census_keys for key in keys],
+        ae
+    )
+
+    msg = ''
+    seen = set()
+    for keys in census_keys:
+        for key in keys:
+            kind, name, value = key
+            label = labels.get(kind, name)
+            if key in existing:
+                msg += "%s %s repeat." % (label, value)
+            if kind in repeat_kinds:
+                if key in seen:
+                    msg += "%s %s repeat in this census." % (label, value)
+                seen.add(key)
+    return msg
+
+
 def get_cannonical_tlf(tlf):
     from authmethods.sms_provider import SMSProvider
     con = SMSProvider.get_instance()
@@ -616,6 +844,18 @@ def get_cannonical_tlf(tlf):
 
 
 def edit_user(user, req, ae):
+    fill_user(user, user.userdata, req, ae)
+    user.save()
+    user.userdata.save()
+    return user
+
+
+def fill_user(user, userdata, req, ae):
+    '''
+    Moves the data of the request/census element req to the user and its
+    user data, without saving them. What remains in req is stored as the user
+    data metadata.
+    '''
     if ae.auth_method == 'user-and-password':
         req.pop('username')
         req.pop('password')
@@ -627,7 +867,7 @@ def edit_user(user, req, ae):
         user.email = req.get('email')
         req.pop('email')
     if req.get('tlf'):
-        user.userdata.tlf = get_cannonical_tlf(req['tlf'])
+        userdata.tlf = get_cannonical_tlf(req['tlf'])
         req.pop('tlf')
 
     if ae.extra_fields:
@@ -636,7 +876,7 @@ def edit_user(user, req, ae):
                 user.email = req.get(extra.get('name'))
                 req.pop(extra.get('name'))
             elif extra.get('type') == 'tlf' and req.get(extra.get('name')):
-                user.userdata.tlf = get_cannonical_tlf(req[extra.get('name')])
+                userdata.tlf = get_cannonical_tlf(req[extra.get('name')])
                 req.pop(extra.get('name'))
             elif extra.get('type') == 'password':
                 user.set_password(req.get(extra.get('name')))
@@ -650,26 +890,24 @@ def edit_user(user, req, ae):
                     #f.write(decodestring(img.encode()))
                     f.write(img)
                 req[extra.get('name')] = fname
-    user.save()
 
     if ae.children_election_info is not None:
-        user.userdata.children_event_id_list = req.get('children_event_id_list')
+        userdata.children_event_id_list = req.get('children_event_id_list')
 
-    user.userdata.metadata = req
-    user.userdata.save()
-    return user
+    userdata.metadata = req
 
 
-def generate_username(req, ae):
+def generate_username(req, ae, check_unique=True):
     '''
     Generates username by:
     a) if any user field is marked as userid_field, then the username will be:
       sha256(userid_field1:userid_field2:..:auth_event_id:shared_secret)
-    b) in any other case, use a random username
+    b) in any other case, use a random username. If check_unique is False,
+      it's not checked that the random username is not already used.
     '''
     userid_fields = []
     if not ae.extra_fields:
-        return random_username()
+        return random_username(check_unique)
 
     for extra in ae.extra_fields:
         if 'userid_field' in extra.keys() and extra.get('userid_field'):
@@ -679,7 +917,7 @@ def generate_username(req, ae):
             userid_fields.append(val)
 
     if len(userid_fields) == 0:
-        return random_username()
+        return random_username(check_unique)
 
     userid_fields.append(str(ae.id))
     userid_fields.append(settings.SHARED_SECRET.decode("utf-8"))
@@ -821,12 +1059,14 @@ def get_required_fields_on_auth(req, ae, q):
 
     return q
 
-def give_perms(u, ae):
-    pipe = ae.auth_method_config.get('pipeline')
-    if not pipe:
-        return 'Bad config'
-    give_perms = pipe.get('give_perms', [])
-    for perms in give_perms:
+def get_perms_to_give(u, ae):
+    '''
+    Returns the list of (object_type, perm, object_id) that the give_perms
+    pipeline of the auth event grants to the user u
+    '''
+    pipe = ae.auth_method_config.get('pipeline') or {}
+    ret = []
+    for perms in pipe.get('give_perms', []):
         obj = perms.get('object_type')
         obj_id = perms.get('object_id', 0)
         if obj_id == 'UserDataId':
@@ -834,15 +1074,123 @@ def give_perms(u, ae):
         elif obj_id == 'AuthEventId':
             obj_id = ae.pk
         for perm in perms.get('perms'):
-            acl, created = ACL.objects.get_or_create(
-                user=u.userdata, 
-                object_type=obj, 
-                perm=perm, 
-                object_id=obj_id
-            )
-            acl.save()
+            if (obj, perm, obj_id) not in ret:
+                ret.append((obj, perm, obj_id))
+    return ret
+
+def give_perms(u, ae):
+    pipe = ae.auth_method_config.get('pipeline')
+    if not pipe:
+        return 'Bad config'
+    for obj, perm, obj_id in get_perms_to_give(u, ae):
+        acl, created = ACL.objects.get_or_create(
+            user=u.userdata, 
+            object_type=obj, 
+            perm=perm, 
+            object_id=obj_id
+        )
+        acl.save()
     return ''
 
+def generate_usernames(census, ae, username_field=None):
+    '''
+    Returns the usernames for the given census elements, like
+    generate_username() does, but checking that the random usernames are not
+    already used with a single query.
+    '''
+    if username_field:
+        return [req.get(username_field) for req in census]
+
+    usernames = [
+        generate_username(req, ae, check_unique=False)
+        for req in census
+    ]
+    used = set(
+        User.objects\
+            .filter(username__in=usernames)\
+            .values_list('username', flat=True)
+    )
+    if not used:
+        return usernames
+
+    # with userid fields the usernames are not random, and a repeated one
+    # means the user already exists
+    userid_fields = [
+        extra
+        for extra in (ae.extra_fields or [])
+        if extra.get('userid_field')
+    ]
+    if userid_fields:
+        return usernames
+    return [
+        random_username() if username in used else username
+        for username in usernames
+    ]
+
+def create_users(census, ae, active, creator, username_field=None, password_field=None):
+    '''
+    Creates the users of the given census elements, the same way as calling
+    create_user() and give_perms() for each one of them, but inserting the
+    users, user datas, actions and acls with bulk_create in chunks of
+    settings.CENSUS_BULK_CHUNK_SIZE elements, within a single transaction.
+
+    The census elements must be already validated. username_field and
+    password_field name the census element fields to use as the username
+    and password of the users, if any.
+    '''
+    from api.models import Action, UserData
+
+    is_anon = creator is None or isinstance(creator, AnonymousUser)
+    chunk_size = settings.CENSUS_BULK_CHUNK_SIZE
+
+    with transaction.atomic():
+        for start in range(0, len(census), chunk_size):
+            chunk = census[start:start + chunk_size]
+            usernames = generate_usernames(chunk, ae, username_field)
+
+            users = []
+            userdatas = []
+            actions_metadata = []
+            for req, username in zip(chunk, usernames):
+                user = User(username=username, is_active=active)
+                if password_field and req.get(password_field):
+                    user.set_password(req.get(password_field))
+                userdata = UserData(event=ae)
+
+                # needs to be obtained before fill_user() modifies req
+                actions_metadata.append(get_trimmed_user_req(req, ae))
+                fill_user(user, userdata, req, ae)
+                users.append(user)
+                userdatas.append(userdata)
+
+            # the post_save signal that creates the user data of each user
+            # is not sent by bulk_create, so we create them here
+            User.objects.bulk_create(users)
+            for user, userdata in zip(users, userdatas):
+                userdata.user = user
+                userdata.search_text = userdata.get_search_text()
+            UserData.objects.bulk_create(userdatas)
+
+            Action.objects.bulk_create([
+                Action(
+                    executer=user if is_anon else creator,
+                    receiver=user,
+                    action_name='user:register' if is_anon else 'user:added-to-census',
+                    event=ae,
+                    metadata=metadata)
+                for user, metadata in zip(users, actions_metadata)
+            ])
+
+            ACL.objects.bulk_create([
+                ACL(user=userdata, object_type=obj, perm=perm, object_id=obj_id)
+                for user, userdata in zip(users, userdatas)
+                for obj, perm, obj_id in get_perms_to_give(user, ae)
+            ])
+
+    # bulk_create doesn't send the signals that invalidate the cached census
+    # size of the auth event
+    bump_auth_event_version(ae.pk)
+
 def verify_children_election_info(
     auth_event,
     user,
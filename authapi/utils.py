@@ -16,6 +16,8 @@
 # along with authapi.  If not, see <http://www.gnu.org/licenses/>.
 
 import hmac
+import base64
+import hashlib
 import datetime
 import dateutil.parser
 import json
@@ -26,14 +28,19 @@ import re
 from logging import getLogger
 import inspect
 import traceback
+import uuid
 
+from celery import group
 from djcelery import celery
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
-from django.core.exceptions import PermissionDenied
-from django.core.mail import send_mail, EmailMessage
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.core.mail import send_mail, EmailMessage, get_connection
 from django.core.paginator import Paginator
+from django.core.cache import cache, caches
+from django.core.exceptions import EmptyResultSet
+from django.db import connection, transaction
 from django.conf import settings
 from django.http import HttpResponse
 from django.utils import timezone
@@ -72,6 +79,21 @@ class ErrorCodes(IntEnum):
 def reproducible_json_dumps(s):
     return json.dumps(s, indent=4, ensure_ascii=False, sort_keys=True, separators=(',', ': '))
 
+def get_shared_cache(name):
+    '''
+    Returns the cache with the given name (from settings.CACHES) if it's
+    shared by all the processes, or None if no name is given or if its
+    backend is one of settings.LOCAL_CACHE_BACKENDS. Data that is invalidated
+    or counted by each process, like the permissions of the users, must only
+    be kept in a shared cache, or the changes done in one process would not
+    be seen by the others.
+    '''
+    if not name:
+        return None
+    if settings.CACHES[name]['BACKEND'] in settings.LOCAL_CACHE_BACKENDS:
+        return None
+    return caches[name]
+
 def parse_json_request(request):
     '''
     Returns the request body as a parsed json object
@@ -101,15 +123,19 @@ def permission_required(user, object_type, permission, object_id=0, return_bool=
     else:
         raise Exception("invalid permission type")
 
+    # all the checks below are answered by the same permissions snapshot,
+    # loaded with a single query
+    userdata = user.userdata
     if object_id:
         for perm in permissions:
-            if user.userdata.has_perms(object_type, permission, 0):
+            if userdata.has_perms(object_type, perm, 0):
                 return True
 
     found = False
     for perm in permissions:
-        if user.userdata.has_perms(object_type, perm, object_id):
+        if userdata.has_perms(object_type, perm, object_id):
             found = True
+            break
 
     if not found:
         if return_bool:
@@ -120,16 +146,76 @@ def permission_required(user, object_type, permission, object_id=0, return_bool=
     if return_bool:
         return True
 
-def paginate(request, queryset, serialize_method=None, elements_name='elements'):
+def estimate_table_count(model):
+    '''
+    Returns the number of rows of the table of the model as estimated by
+    PostgreSQL statistics, or -1 if there are none
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+            [model._meta.db_table]
+        )
+        row = cursor.fetchone()
+    return row[0] if row else -1
+
+def get_count(queryset, strategy=None):
+    '''
+    Returns the number of elements of the queryset and the strategy used to
+    calculate it, which is settings.PAGINATION_COUNT_STRATEGY by default:
+     - 'exact': a COUNT query.
+     - 'cached': the exact count, cached for
+       settings.PAGINATION_COUNT_CACHE_TIMEOUT seconds and keyed by the SQL
+       of the query, which includes all its filters.
+     - 'estimate': the table row estimate from the PostgreSQL statistics. It
+       only applies to unfiltered queries over tables with at least
+       settings.PAGINATION_COUNT_ESTIMATE_MIN rows, otherwise it falls back
+       to the exact count.
+    '''
+    if strategy is None:
+        strategy = settings.PAGINATION_COUNT_STRATEGY
+
+    if strategy == 'estimate':
+        if not queryset.query.where and not queryset.query.distinct:
+            estimate = estimate_table_count(queryset.model)
+            if estimate >= max(settings.PAGINATION_COUNT_ESTIMATE_MIN, 1):
+                return estimate, 'estimate'
+        return queryset.count(), 'exact'
+
+    if strategy == 'cached':
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return 0, 'exact'
+        key = 'paginate_count:' + hashlib.sha256(
+            ('%s %r' % (sql, params)).encode('utf-8')
+        ).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, settings.PAGINATION_COUNT_CACHE_TIMEOUT)
+        return count, 'cached'
+
+    return queryset.count(), 'exact'
+
+def paginate(request, queryset, serialize_method=None, elements_name='elements', cursor_field='id', count_strategy=None):
     '''
     Function to paginate a queryset using the request params
     ?page=1&n=10
+
+    If the ?cursor= param is present (initially empty), uses keyset
+    pagination instead (see paginate_cursor()), seeking on cursor_field.
+    Raises InvalidCursor if the cursor is not valid.
+
+    The total count is calculated with get_count() and count_strategy, and
+    total_count_strategy says which strategy was used.
     '''
 
     index = request.GET.get('page', 1)
     elements = request.GET.get('n', 10)
     order = request.GET.get('order', None)
-    if order:
+    cursor = request.GET.get('cursor', None)
+    if order and cursor is None:
         queryset = queryset.order_by(order)
 
     try:
@@ -147,9 +233,6 @@ def paginate(request, queryset, serialize_method=None, elements_name='elements')
     if elements > 200:
         elements = 200
 
-    p = Paginator(queryset, elements)
-    page = p.page(pageindex)
-
     def serialize(obj):
       if serialize_method is None:
           return obj
@@ -158,10 +241,37 @@ def paginate(request, queryset, serialize_method=None, elements_name='elements')
       elif isinstance(serialize_method, types.FunctionType):
           return serialize_method(obj)
 
+    if cursor is not None:
+        return paginate_cursor(
+            request,
+            queryset,
+            serialize,
+            elements_name,
+            cursor,
+            cursor_field,
+            elements,
+            count_strategy)
+
+    total_count, used_count_strategy = get_count(queryset, count_strategy)
+    if used_count_strategy != 'exact':
+        return paginate_approximate(
+            queryset,
+            serialize,
+            elements_name,
+            pageindex,
+            elements,
+            total_count,
+            used_count_strategy)
+
+    p = Paginator(queryset, elements)
+    p.count = total_count
+    page = p.page(pageindex)
+
     return {
         elements_name: [serialize(obj) for obj in page.object_list],
         'page': pageindex,
         'total_count': p.count,
+        'total_count_strategy': used_count_strategy,
         'page_range': list(p.page_range),
         'start_index': page.start_index(),
         'end_index': page.end_index(),
@@ -169,6 +279,105 @@ def paginate(request, queryset, serialize_method=None, elements_name='elements')
         'has_previous': page.has_previous(),
     }
 
+def paginate_approximate(queryset, serialize, elements_name, pageindex, elements, total_count, count_strategy):
+    '''
+    Same as paginate() when the total count is not exact ('estimate' or
+    'cached'): the count is only reported, and the page is taken from the
+    real rows with one extra row to know if there's a next page, so that
+    all the rows can be reached even if the count is lower than the real
+    one.
+    '''
+    offset = (pageindex - 1) * elements
+    objs = list(queryset[offset:offset + elements + 1])
+    has_next = len(objs) > elements
+    objs = objs[:elements]
+
+    num_pages = max(-(-total_count // elements), 1)
+    if objs:
+        num_pages = max(num_pages, pageindex + (1 if has_next else 0))
+
+    return {
+        elements_name: [serialize(obj) for obj in objs],
+        'page': pageindex,
+        'total_count': total_count,
+        'total_count_strategy': count_strategy,
+        'page_range': list(range(1, num_pages + 1)),
+        'start_index': offset + 1 if objs else 0,
+        'end_index': offset + len(objs),
+        'has_next': has_next,
+        'has_previous': pageindex > 1,
+    }
+
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8'))\
+        .decode('utf-8')
+
+class InvalidCursor(Exception):
+    '''
+    Raised by paginate() when the ?cursor= param is malformed or tampered, so
+    that the view returns an error instead of restarting from the first page
+    '''
+    pass
+
+def decode_cursor(cursor):
+    '''
+    Returns the value stored in a cursor, or None if it's empty. Raises
+    InvalidCursor if it's invalid.
+    '''
+    if not cursor:
+        return None
+    try:
+        value = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8')
+        )
+    except:
+        raise InvalidCursor()
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise InvalidCursor()
+    return value
+
+def paginate_cursor(request, queryset, serialize, elements_name, cursor, cursor_field, elements, count_strategy=None):
+    '''
+    Keyset pagination: the queryset is ordered by cursor_field (a unique and
+    indexed column, '-' prefixed for descending order) and the page starts
+    right after the value stored in the opaque cursor, so there are no
+    offsets to scan. The returned next_cursor is used to request the next
+    page. The total count is only calculated when asked for with
+    ?count=true.
+    '''
+    field = cursor_field.lstrip('-')
+    descending = cursor_field.startswith('-')
+    queryset = queryset.order_by(cursor_field)
+
+    page_queryset = queryset
+    last_value = decode_cursor(cursor)
+    if last_value is not None:
+        lookup = '%s__%s' % (field, 'lt' if descending else 'gt')
+        try:
+            page_queryset = queryset.filter(**{lookup: last_value})
+        except (TypeError, ValueError, ValidationError):
+            raise InvalidCursor()
+
+    objs = list(page_queryset[:elements + 1])
+    has_next = len(objs) > elements
+    objs = objs[:elements]
+
+    data = {
+        elements_name: [serialize(obj) for obj in objs],
+        'has_next': has_next,
+        'next_cursor': (
+            encode_cursor(getattr(objs[-1], field))
+            if has_next
+            else None
+        ),
+    }
+    if request.GET.get('count', None) == 'true':
+        data['total_count'], data['total_count_strategy'] = get_count(
+            queryset,
+            count_strategy
+        )
+    return data
+
 def genhmac(key, msg):
     timestamp = int(datetime.datetime.now().timestamp())
     msg = "%s:%s" % (msg, str(timestamp))
@@ -255,10 +464,253 @@ def generate_code(userdata, size=settings.SIZE_CODE):
     c.save()
     return code
 
+def generate_codes(userdata_list, size=settings.SIZE_CODE):
+    """
+    Same as generate_code for a list of userdata, saving all the codes with
+    a single query. Returns a dict with the code of each userdata id.
+    """
+    from authmethods.models import Code
+    codes = dict(
+        (userdata.id, random_code(size, "2346789"))
+        for userdata in userdata_list
+    )
+    Code.objects.bulk_create([
+        Code(
+            user=userdata,
+            code=codes[userdata.id],
+            auth_event_id=userdata.event_id
+        )
+        for userdata in userdata_list
+    ])
+    return codes
+
+def msg_needs_code(msg):
+    """ Returns whether the message template includes the code. """
+    return "__URL2__" in msg or "__CODE__" in msg
+
 # Separate code into groups of 4 digits with hyphens ("-")
 def format_code(code):
     return '-'.join(code[i:i+4] for i in range(0, len(code), 4))
 
+class TokenBucket(object):
+    '''
+    Token bucket rate limiter shared by all the processes through the cache
+    settings.MESSAGE_RATE_LIMIT_CACHE: up to burst tokens can be taken at
+    once, and they are refilled at rate tokens per second. The state of the
+    bucket is updated holding a lock made with cache.add(), which is atomic
+    in the shared cache backends.
+
+    Raises ImproperlyConfigured if the cache is not shared by all the
+    processes, as each one would then apply the limits on its own, unless
+    the bucket is local: then its state is kept in the instance, and only
+    limits its own user.
+    '''
+    def __init__(self, key, rate, burst=1, local=False):
+        self.key = 'token_bucket:%s' % key
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.local = local
+        self.state = None
+        if local:
+            self.cache = None
+        else:
+            self.cache = get_shared_cache(settings.MESSAGE_RATE_LIMIT_CACHE)
+            if self.cache is None:
+                raise ImproperlyConfigured(
+                    'the message rate limits need a MESSAGE_RATE_LIMIT_CACHE '
+                    'shared by all the processes'
+                )
+
+    def take_from(self, state):
+        '''
+        Returns the new state of the bucket after trying to take a token from
+        the given one, and the number of seconds to wait as in try_take()
+        '''
+        now = time.time()
+        tokens, updated = state if state is not None else (self.burst, now)
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0
+        else:
+            wait = (1 - tokens) / self.rate
+        return (tokens, now), wait
+
+    def try_take(self):
+        '''
+        Takes a token if there's any, returning 0. Otherwise returns the
+        number of seconds until there will be one.
+        '''
+        if self.local:
+            self.state, wait = self.take_from(self.state)
+            return wait
+
+        lock_key = self.key + ':lock'
+        while not self.cache.add(lock_key, 1, 1):
+            sleep(0.001)
+        try:
+            state, wait = self.take_from(self.cache.get(self.key))
+            # expires once it would be full again anyway
+            self.cache.set(
+                self.key,
+                state,
+                int(self.burst / self.rate) + 1
+            )
+            return wait
+        finally:
+            self.cache.delete(lock_key)
+
+    def take(self):
+        '''
+        Takes a token, waiting until there's one
+        '''
+        while True:
+            wait = self.try_take()
+            if not wait:
+                return
+            sleep(wait)
+
+
+def take_message_token(provider, auth_event_id=None):
+    '''
+    Waits until one more message can be sent through the provider ('sms' or
+    'email') within its rate limits in settings.MESSAGE_RATE_LIMITS, both the
+    global one and the one of the auth event if configured.
+    '''
+    limits = settings.MESSAGE_RATE_LIMITS.get(provider, dict())
+    event_limits = limits.get('per_event')
+    if (
+        auth_event_id is not None and
+        event_limits and
+        event_limits.get('rate', 0) > 0
+    ):
+        TokenBucket(
+            '%s:%s' % (provider, auth_event_id),
+            event_limits['rate'],
+            event_limits.get('burst', 1)
+        ).take()
+    if limits.get('rate', 0) > 0:
+        TokenBucket(
+            provider,
+            limits['rate'],
+            limits.get('burst', 1)
+        ).take()
+
+
+class SlidingWindowCounter(object):
+    '''
+    Counts the rows of a queryset (with a 'created' field) created within a
+    sliding window of time, using counters kept in the cache
+    settings.RATE_LIMIT_COUNTER_CACHE that are updated with add() when a
+    row is created. This way counting costs the same however many rows the
+    table has.
+
+    Rows are counted in buckets of a minute and of an hour. Windows of up to
+    two hours are summed from the minute buckets and windows of up to two
+    days from the hour buckets, weighting the oldest bucket by the part of
+    it within the window. The queryset is counted instead for longer windows,
+    for those that started before the counters existed, and for all of them
+    if the cache is not set or not shared by all the processes. Without a
+    window, the total is counted, and the counter is initialized from the
+    queryset.
+    '''
+    # bucket size and maximum window of the counters, in seconds
+    BUCKETS = ((60, 2 * 3600), (3600, 2 * 24 * 3600))
+    TOTAL_TIMEOUT = 2 * 24 * 3600
+
+    def __init__(self, name, queryset):
+        self.queryset = queryset
+        self.key = 'window_counter:%s' % hashlib.sha1(
+            name.encode('utf-8')
+        ).hexdigest()
+        self.cache = get_shared_cache(settings.RATE_LIMIT_COUNTER_CACHE)
+
+    def get_since(self, now):
+        '''
+        Returns since when the counters have counted all the rows
+        '''
+        since_key = self.key + ':since'
+        self.cache.add(since_key, now, None)
+        return self.cache.get(since_key, now)
+
+    def add(self):
+        '''
+        Counts a new row
+        '''
+        if self.cache is None:
+            return
+        now = time.time()
+        self.get_since(now)
+        for size, max_window in self.BUCKETS:
+            key = '%s:%d:%d' % (self.key, size, now // size)
+            timeout = max_window + size
+            if not self.cache.add(key, 1, timeout):
+                try:
+                    self.cache.incr(key)
+                except ValueError:
+                    # expired meanwhile
+                    self.cache.add(key, 1, timeout)
+        try:
+            self.cache.incr(self.key + ':total')
+        except ValueError:
+            # the total is initialized from the queryset when counted
+            pass
+
+    def count(self, period=None):
+        '''
+        Returns the number of rows created in the last period seconds, or in
+        total if no period is given. It's an approximation when taken from
+        the counters.
+        '''
+        now = time.time()
+        if not period:
+            total = None
+            if self.cache is not None:
+                total = self.cache.get(self.key + ':total')
+            if total is None:
+                total = self.queryset.count()
+                if self.cache is not None:
+                    self.cache.add(
+                        self.key + ':total',
+                        total,
+                        self.TOTAL_TIMEOUT
+                    )
+            return total
+
+        start = now - period
+        sizes = [
+            size
+            for size, max_window in self.BUCKETS
+            if period <= max_window
+        ]
+        if (
+            self.cache is None or
+            not sizes or
+            start < self.get_since(now)
+        ):
+            return self.queryset\
+                .filter(
+                    created__gt=datetime.datetime.fromtimestamp(
+                        start,
+                        timezone.utc
+                    )
+                )\
+                .count()
+
+        size = sizes[0]
+        first = int(start // size)
+        keys = [
+            '%s:%d:%d' % (self.key, size, bucket)
+            for bucket in range(first, int(now // size) + 1)
+        ]
+        counts = self.cache.get_many(keys)
+        oldest_weight = 1 - (start - first * size) / size
+        return (
+            counts.get(keys[0], 0) * oldest_weight +
+            sum(counts.get(key, 0) for key in keys[1:])
+        )
+
+
 def email_to_str(email):
     return '''to: %s
 subject: %s
@@ -275,6 +727,90 @@ def send_email(email):
         LOGGER.error('Email NOT sent: \n%s', email_to_str(email))
 
 
+class BatchEmailSender(object):
+    '''
+    Sends emails reusing the same connection for all of them, instead of
+    opening a new one per email like send_email(). Emails are queued with
+    send() and sent when flush() is called, with close() or when the queue
+    reaches settings.EMAIL_BATCH_SIZE emails. If sending an email fails, it
+    reconnects and retries it once. on_sent, if given, is called after each
+    email is sent.
+
+    A token of the email rate limits (see take_message_token()) is taken
+    right before sending each email, so that they leave at the configured
+    rate instead of in bursts of queued emails.
+
+    Use it as a context manager:
+
+        with BatchEmailSender() as email_sender:
+            email_sender.send(email)
+
+    If the with block raises an exception, the queued emails are discarded
+    instead of sent, so that the caller can retry them without sending them
+    twice.
+    '''
+    def __init__(self, connection=None, on_sent=None):
+        self.connection = connection or get_connection()
+        self.on_sent = on_sent
+        self.pending = []
+        self.is_open = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None:
+            self.discard()
+        self.close()
+
+    def send(self, email, auth_event_id=None):
+        '''
+        Queues the email, sent within the rate limits of the auth event if
+        given
+        '''
+        self.pending.append((email, auth_event_id))
+        if len(self.pending) >= settings.EMAIL_BATCH_SIZE:
+            self.flush()
+
+    def send_one(self, email):
+        try:
+            # opened when needed, but kept open: otherwise the backend opens
+            # and closes a connection in each send_messages() call
+            if not self.is_open:
+                self.connection.open()
+                self.is_open = True
+            self.connection.send_messages([email])
+        except Exception:
+            LOGGER.info('Email connection failed, reconnecting')
+            self.connection.close()
+            self.connection.open()
+            self.is_open = True
+            self.connection.send_messages([email])
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        for email, auth_event_id in pending:
+            take_message_token('email', auth_event_id)
+            try:
+                self.send_one(email)
+                LOGGER.info('Email sent: \n%s', email_to_str(email))
+            except:
+                LOGGER.error('Email NOT sent: \n%s', email_to_str(email))
+            if self.on_sent is not None:
+                self.on_sent()
+
+    def discard(self):
+        pending, self.pending = self.pending, []
+        for email, auth_event_id in pending:
+            LOGGER.error('Email NOT sent (discarded): \n%s', email_to_str(email))
+
+    def close(self):
+        self.flush()
+        if self.is_open:
+            self.connection.close()
+            self.is_open = False
+
+
 @celery.task
 def send_mail(subject, msg, receiver):
     email = EmailMessage(
@@ -283,6 +819,7 @@ def send_mail(subject, msg, receiver):
         settings.DEFAULT_FROM_EMAIL,
         [receiver]
     )
+    take_message_token('email')
     send_email(email)
 
 
@@ -310,7 +847,7 @@ def template_replace_data(templ, data):
         ret = ret.replace("__%s__" % key.upper(), str(value))
     return ret
 
-def send_code(user, ip, config=None, auth_method_override=None, code=None, save_message=True):
+def send_code(user, ip, config=None, auth_method_override=None, code=None, save_message=True, email_sender=None, async_delivery=False):
     '''
     Sends the code for authentication in the related auth event, to the user
     in a message sent via sms and/or email, depending on the authentication 
@@ -321,9 +858,14 @@ def send_code(user, ip, config=None, auth_method_override=None, code=None, save_
     The message will be automatically completed with the base message in
     settings.
 
+    Emails are sent with email_sender (a BatchEmailSender) if given. With
+    async_delivery, the messages are only rendered and saved, and then
+    delivered by the send_code_msg task once the transaction commits.
+
     NOTE: You are responsible of not calling this on a stopped auth event
     '''
     from authmethods.models import Message, MsgLog
+    from authmethods.utils import count_message
     # Check if the client is requesting to use an authentication method
     # different from the default one for this election
     if auth_method_override is not None:
@@ -349,7 +891,7 @@ def send_code(user, ip, config=None, auth_method_override=None, code=None, save_
         subject = config.get('subject')
 
     # only generate the code if required
-    needs_code = "__URL2__" in msg or "__CODE__" in msg
+    needs_code = msg_needs_code(msg)
     if needs_code and code is None:
         code = generate_code(user.userdata)
 
@@ -416,42 +958,105 @@ def send_code(user, ip, config=None, auth_method_override=None, code=None, save_
     cm.save()
 
     if auth_method in ["sms", "sms-otp"]:
-        send_sms_code(receiver, msg)
+        provider = 'sms'
+    else:
+        provider = 'email'
+
+    if async_delivery:
+        transaction.on_commit(
+            lambda: send_code_msg.apply_async(args=[cm.id, provider])
+        )
+    else:
+        deliver_code_msg(cm, provider, email_sender)
+
+    if provider == 'sms':
         if save_message:
           m = Message(tlf=receiver[:20], ip=ip[:15], auth_event_id=event_id)
           m.save()
+          count_message(m)
 
         # also send via email if possible and only if there was no override (to 
         # remove infinite looping). Do not save message twice.
         if user.userdata.event.auth_method in ["sms", "sms-otp"] and\
             user.email:
-            send_code(user, ip, config, 'email', code, save_message=False)
+            send_code(user, ip, config, 'email', code, save_message=False, email_sender=email_sender, async_delivery=async_delivery)
             
     else: # email or email-otp
+        if save_message:
+          m = Message(tlf=receiver[:20], ip=ip[:15], auth_event_id=event_id)
+          m.save()
+          count_message(m)
+
+        # also send via sms if possible and only if there was no override (to 
+        # remove infinite looping). Do not save message twice.
+        if user.userdata.event.auth_method in ["email", "email-otp"] and\
+            user.email:
+            send_code(user, ip, config, 'sms', code, save_message=False, email_sender=email_sender, async_delivery=async_delivery)
+
+
+def deliver_code_msg(msg_log, provider, email_sender=None):
+    '''
+    Delivers the message rendered by send_code and saved in msg_log, via
+    'sms' or 'email' depending on the provider.
+    '''
+    if provider == 'sms':
+        take_message_token('sms', msg_log.authevent_id)
+        send_sms_code(msg_log.receiver, msg_log.msg['msg'])
+    else:
         # TODO: Allow HTML messages for emails
         from api.models import ACL
         acl = ACL.objects.filter(
             object_type='AuthEvent',
             perm__in=['edit', 'unarchive'],
-            object_id=event_id
+            object_id=msg_log.authevent_id
         ).first()
         email = EmailMessage(
-            subject,
-            msg,
+            msg_log.msg['subject'],
+            msg_log.msg['msg'],
             settings.DEFAULT_FROM_EMAIL,
-            [receiver],
+            [msg_log.receiver],
             headers = {'Reply-To': acl.user.user.email}
         )
-        send_email(email)
-        if save_message:
-          m = Message(tlf=receiver[:20], ip=ip[:15], auth_event_id=event_id)
-          m.save()
+        if email_sender is not None:
+            email_sender.send(email, msg_log.authevent_id)
+        else:
+            take_message_token('email', msg_log.authevent_id)
+            send_email(email)
 
-        # also send via sms if possible and only if there was no override (to 
-        # remove infinite looping). Do not save message twice.
-        if user.userdata.event.auth_method in ["email", "email-otp"] and\
-            user.email:
-            send_code(user, ip, config, 'sms', code, save_message=False)
+
+@celery.task
+def send_code_msg(msg_log_id, provider):
+    '''
+    Delivers a message saved by send_code with async_delivery.
+    '''
+    from authmethods.models import MsgLog
+    deliver_code_msg(MsgLog.objects.get(pk=msg_log_id), provider)
+
+
+def send_user_code(user, ip, auth_method):
+    '''
+    Sends the authentication code requested by a user, when registering or
+    asking for it again. The code and the message are saved before returning,
+    but the message is delivered by a celery worker so that a slow provider
+    doesn't block the request, unless the 'sync_messages' option is set in
+    the config of the auth event.
+    '''
+    from api.models import Action
+    auth_event = user.userdata.event
+    conf = auth_event.auth_method_config.get('config', {})
+    action = Action(
+        executer=None,
+        receiver=user,
+        action_name='user:send-auth',
+        event=auth_event,
+        metadata=dict())
+    action.save()
+    send_code(
+        user,
+        ip,
+        auth_method_override=auth_method,
+        async_delivery=not conf.get('sync_messages', False)
+    )
 
 
 def send_msg(data, msg, subject=''):
@@ -459,6 +1064,7 @@ def send_msg(data, msg, subject=''):
         from authmethods.models import Message
         auth_method = 'sms'
         receiver = data['tlf']
+        take_message_token('sms')
         send_sms_code(receiver, msg)
         m = Message(tlf=receiver, auth_event_id=0)
         m.save()
@@ -472,6 +1078,7 @@ def send_msg(data, msg, subject=''):
             settings.DEFAULT_FROM_EMAIL,
             [receiver],
         )
+        take_message_token('email')
         send_email(email)
 
 
@@ -484,34 +1091,151 @@ def get_client_ip(request):
     return ip
 
 
+def get_send_codes_bucket():
+    '''
+    Returns the TokenBucket shared by all the send_codes tasks if any plugin
+    sets a minimum delay in seconds between codes in extend_send_codes, or
+    None otherwise.
+
+    Without a shared MESSAGE_RATE_LIMIT_CACHE the bucket is local, so each
+    task just waits the delay between its own codes, and send_codes then
+    sends all the codes in a single chunk.
+    '''
+    delays = [delay for delay in plugins.call("extend_send_codes") if delay > 0]
+    if not delays:
+        return None
+    local = get_shared_cache(settings.MESSAGE_RATE_LIMIT_CACHE) is None
+    return TokenBucket('send_codes', 1.0 / max(delays), local=local)
+
+
 @celery.task
 def send_codes(users, ip, auth_method, config=None, sender_uid=None, eid=None):
-    from api.models import Action, AuthEvent
-
-    # delay between send code calls
-    delay = 0
-    extend_info = plugins.call("extend_send_codes")
-    if extend_info:
-        for info in extend_info:
-             delay = info
-
-
-    sender = User.objects.get(pk=sender_uid) if sender_uid else None
-    auth_event = AuthEvent.objects.get(pk=eid) if eid else None
-
-    ''' Massive send_code with celery task.  '''
-    user_objs = User.objects.filter(id__in=users)
-    for user in user_objs:
-        action = Action(
-                executer=sender,
-                receiver=user,
-                action_name='user:send-auth',
-                event=auth_event,
-                metadata=dict())
-        action.save()
-        send_code(user, ip, config, auth_method)
-        if delay > 0:
-            sleep(delay)
+    '''
+    Massive send_code with celery task. The users are split in chunks of
+    settings.SEND_CODES_CHUNK_SIZE users, each one sent by an independent
+    send_codes_chunk task so that they are spread among the workers.
+    '''
+    from api.models import SendCodesChunk
+
+    batch = uuid.uuid4().hex
+    chunk_size = max(settings.SEND_CODES_CHUNK_SIZE, 1)
+    send_codes_bucket = get_send_codes_bucket()
+    if send_codes_bucket is not None and send_codes_bucket.local:
+        # the delay between codes can't be kept by parallel chunks
+        chunk_size = max(len(users), 1)
+    chunks = SendCodesChunk.objects.bulk_create([
+        SendCodesChunk(
+            batch=batch,
+            auth_event_id=eid,
+            sender_id=sender_uid,
+            ip=ip,
+            auth_method=auth_method,
+            config=config,
+            users=list(users[i:i + chunk_size])
+        )
+        for i in range(0, len(users), chunk_size)
+    ])
+
+    if len(chunks) == 1:
+        send_codes_chunk(chunks[0].id)
+    elif chunks:
+        group(send_codes_chunk.s(chunk.id) for chunk in chunks).apply_async()
+
+
+@celery.task
+def send_codes_chunk(chunk_id):
+    '''
+    Sends the codes to the users of a SendCodesChunk, recording the progress
+    after each one. If the chunk failed or its worker died, calling this
+    again resumes it from the first user that was not sent its code.
+
+    The codes are generated in batches of settings.SEND_CODES_BATCH_SIZE
+    users, saving each batch with a single query.
+    '''
+    from api.models import Action, SendCodesChunk
+
+    chunk = SendCodesChunk.objects\
+        .select_related('sender', 'auth_event')\
+        .get(pk=chunk_id)
+    if chunk.status == 'done':
+        return
+
+    chunk_query = SendCodesChunk.objects.filter(pk=chunk.pk)
+    chunk_query.update(status='running', updated=timezone.now())
+    pending_users = chunk.users[chunk.sent:]
+    user_objs = User.objects\
+        .select_related('userdata__event')\
+        .in_bulk(pending_users)
+    batch_size = max(settings.SEND_CODES_BATCH_SIZE, 1)
+    codes = dict()
+    # flushing the queued emails can take a while if they are rate limited,
+    # so the chunk is kept from looking stalled meanwhile
+    def heartbeat():
+        chunk_query.update(updated=timezone.now())
+
+    try:
+        send_codes_bucket = get_send_codes_bucket()
+        with BatchEmailSender(on_sent=heartbeat) as email_sender:
+            for index, user_id in enumerate(pending_users):
+                sent = chunk.sent + index + 1
+                # users removed from the census are skipped
+                user = user_objs.get(user_id)
+                if user is not None:
+                    if chunk.config is None:
+                        conf = user.userdata.event.auth_method_config.get('config')
+                    else:
+                        conf = chunk.config
+                    code = None
+                    if msg_needs_code(conf.get('msg')):
+                        if user.userdata.id not in codes:
+                            # generated shortly before being sent, as they
+                            # might expire
+                            codes = generate_codes([
+                                user_objs[batch_user_id].userdata
+                                for batch_user_id in pending_users[index:index + batch_size]
+                                if batch_user_id in user_objs
+                            ])
+                        code = codes[user.userdata.id]
+
+                    if send_codes_bucket is not None:
+                        send_codes_bucket.take()
+                    action = Action(
+                            executer=chunk.sender,
+                            receiver=user,
+                            action_name='user:send-auth',
+                            event=chunk.auth_event,
+                            metadata=dict())
+                    action.save()
+                    send_code(
+                        user,
+                        chunk.ip,
+                        chunk.config,
+                        chunk.auth_method,
+                        code=code,
+                        email_sender=email_sender
+                    )
+
+                    # the SMS are sent right away, so the queued emails are
+                    # sent too for the user to be recorded as sent, or
+                    # resuming the chunk would send the SMS again
+                    if email_sender.pending and user.userdata.tlf:
+                        email_sender.flush()
+
+                # queued emails are not sent yet, and they are discarded if
+                # the chunk fails, so that resuming it sends them only once
+                if not email_sender.pending:
+                    chunk_query.update(sent=sent, updated=timezone.now())
+                else:
+                    heartbeat()
+    except Exception:
+        chunk_query.update(status='failed', updated=timezone.now())
+        raise
+
+    chunk_query.update(
+        sent=len(chunk.users),
+        status='done',
+        updated=timezone.now()
+    )
 
 
 # CHECKERS AUTHEVENT